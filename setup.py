@@ -20,6 +20,8 @@ setup(
         "djangorestframework",
         "djangorestframework-filters",
         "django-reversion",
+        "futures; python_version < '3'",
+        "jsonschema",
         "redis",
     ],
     packages=find_packages(),
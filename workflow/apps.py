@@ -2,6 +2,9 @@
 import logging
 from django.apps import AppConfig
 from django.conf import settings
+from django.db.models.signals import (m2m_changed,
+                                      post_delete,
+                                      post_save, )
 from reversion import revisions as reversion
 
 
@@ -25,6 +28,20 @@ class WorkflowApp(AppConfig):
         reversion.register(TransitionTask)
         reversion.register(AvailableTask)
 
+        # compiled graphs are kept until their FSM's version changes
+        for model in (Transition, TransitionTask, AvailableTask):
+            post_save.connect(receivers.bump_on_graph_change, sender=model)
+            post_delete.connect(receivers.bump_on_graph_change, sender=model)
+        post_save.connect(receivers.bump_on_graph_change, sender=State)
+        m2m_changed.connect(receivers.bump_on_permissions_change,
+                            sender=Transition.permissions.through)
+
+        try:
+            from .registry import registry
+            registry.populate()
+        except Exception as ex:
+            logger.warning('Task registry population failed. %s', ex)
+
         if hasattr(settings, 'WORKFLOW_AUTO_LOAD') and settings.WORKFLOW_AUTO_LOAD:
             logging.debug('Autoloading tasks.')
             try:
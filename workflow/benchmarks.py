@@ -0,0 +1,251 @@
+# coding: utf-8
+'''Throughput and latency benchmarks of the workflow.
+
+Builds a synthetic machine, controls ``objects`` instances of a model
+using StateControllerMixIn and measures the transition path. Used by
+the ``workflow_benchmark`` management command, which stores the
+results as JSON so runs of different commits can be compared.
+'''
+import json
+import time
+import uuid
+import random
+import subprocess
+from contextlib import contextmanager
+from django.db import connection
+from django.utils import timezone
+from celery import current_app
+from .choices import INNER_STATE_IDLE
+from .fsm import GoFSMUpdater
+from .instrumentation import QueryCounter
+from .models import (StateMachine,
+                     State,
+                     AvailableTask,
+                     StateController,
+                     prefetch_controllers, )
+from .tasks import BaseTask
+
+
+class BenchmarkTask(BaseTask):
+
+    '''does nothing; stands for the tasks of a transition'''
+
+    name = 'Benchmark Task'
+    public = False
+
+    def _run(self):
+        return True
+
+
+current_app.tasks.register(BenchmarkTask)
+
+
+class Measure(object):
+
+    '''wall time and queries of a block of code'''
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+        self.count = 0
+
+    @contextmanager
+    def __call__(self):
+        start = time.time()
+        with QueryCounter(connection) as ctx:
+            yield
+        self.seconds += time.time() - start
+        self.queries += ctx.count
+        self.count += 1
+
+    def as_dict(self):
+        count = self.count or 1
+        return {'count': self.count,
+                'seconds': self.seconds,
+                'seconds_per_call': self.seconds / count,
+                'queries_per_call': float(self.queries) / count}
+
+
+@contextmanager
+def eager():
+    previous = current_app.conf.task_always_eager
+    current_app.conf.task_always_eager = True
+    try:
+        yield
+    finally:
+        current_app.conf.task_always_eager = previous
+
+
+@contextmanager
+def local_broker():
+    '''an in-memory broker with a worker running in this process'''
+    from celery.contrib.testing.worker import start_worker
+    conf = current_app.conf
+    previous = (conf.broker_url, conf.result_backend, conf.task_always_eager)
+    conf.broker_url = 'memory://'
+    conf.result_backend = 'cache+memory://'
+    conf.task_always_eager = False
+    try:
+        with start_worker(current_app, pool='solo', perform_ping_check=False):
+            yield
+    finally:
+        conf.broker_url, conf.result_backend, conf.task_always_eager = previous
+
+
+def representation(prefix, nodes, links, tasks):
+    '''GoJS representation of a machine with a s0 <-> s1 <-> ... chain
+    and extra random links, up to links transitions in total'''
+    rng = random.Random(nodes * 7919 + links)
+    node_data = [{'key': i, 'text': '{0}{1}'.format(prefix, i)} for i in range(nodes)]
+    node_data[0]['type'] = 'initial'
+
+    edges = []
+    for i in range(nodes - 1):
+        edges.extend([(i, i + 1), (i + 1, i)])
+    seen = set(edges)
+    while len(edges) < links and len(seen) < nodes * (nodes - 1):
+        edge = (rng.randrange(nodes), rng.randrange(nodes))
+        if edge[0] != edge[1] and edge not in seen:
+            seen.add(edge)
+            edges.append(edge)
+
+    link_data = [{'from': a, 'to': b, 'text': '{0}-{1}'.format(a, b), 'tasks': tasks}
+                 for a, b in edges]
+    return {'representation': json.dumps({'nodeDataArray': node_data,
+                                          'linkDataArray': link_data})}
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip().decode('utf-8')
+    except Exception:
+        return None
+
+
+class WorkflowBenchmark(object):
+
+    def __init__(self, model, nodes=10, links=None, objects=100, tasks=1,
+                 transitions=2, broker=False, user=None):
+        self.model = model
+        self.nodes = max(nodes, 2)
+        self.links = links or self.nodes * 2
+        self.objects = objects
+        self.tasks = tasks
+        self.transitions = transitions
+        self.broker = broker
+        self.user = user
+        self.prefix = 'bench-{0}-'.format(uuid.uuid4().hex[:8])
+
+    def build_machine(self, measure):
+        task = AvailableTask.objects.create(name=BenchmarkTask.name,
+                                            klass='{0}.{1}'.format(BenchmarkTask.__module__,
+                                                                   BenchmarkTask.__name__))
+        self.available_task = task
+        machine = StateMachine.objects.create(name=self.prefix)
+        data = representation(self.prefix, self.nodes, self.links, [task.id] * self.tasks)
+        with measure():
+            GoFSMUpdater().update(machine, data)
+        # a second save of an unchanged graph measures the diff path
+        with measure():
+            GoFSMUpdater().update(machine, data)
+        return machine
+
+    def create_objects(self, machine, measure):
+        controlled = []
+        for i in range(self.objects):
+            obj = self.model()
+            with measure():
+                obj.save(state_machine=machine)
+            controlled.append(obj)
+        return controlled
+
+    def wait_idle(self, controlled, timeout=600):
+        ids = [c.controller.id for c in controlled]
+        deadline = time.time() + timeout
+        while StateController.objects.filter(id__in=ids).exclude(inner_state=INNER_STATE_IDLE).exists():
+            if time.time() > deadline:
+                raise RuntimeError('Transitions did not finish in {0} seconds.'.format(timeout))
+            time.sleep(0.05)
+
+    def drive(self, machine, controlled, measure):
+        states = {s.code: s for s in State.objects.filter(code__startswith=self.prefix)}
+        targets = [states['{0}1'.format(self.prefix)], states['{0}0'.format(self.prefix)]]
+        start = time.time()
+        for step in range(self.transitions):
+            target = targets[step % 2]
+            for obj in controlled:
+                obj.invalidate_controller()
+                with measure():
+                    obj.change_to(target)
+            if self.broker:
+                self.wait_idle(controlled)
+        return time.time() - start
+
+    def measure_next_for_user(self, machine, controlled, measure_next, measure_available):
+        user = self.user
+        if user is None:
+            return
+        for obj in prefetch_controllers(controlled):
+            with measure_next():
+                obj.next_for_user(user)
+            with measure_available():
+                obj.transitions_available_to(user)
+
+    def cleanup(self, machine, controlled):
+        StateController.objects.filter(machine=machine).delete()
+        self.model.objects.filter(pk__in=[c.pk for c in controlled]).delete()
+        machine.transitions.all().delete()
+        StateMachine.objects.filter(pk=machine.pk).delete()
+        State.objects.filter(code__startswith=self.prefix).delete()
+        self.available_task.delete()
+
+    def run(self):
+        update = Measure()
+        create = Measure()
+        change = Measure()
+        next_for_user = Measure()
+        available_to = Measure()
+
+        machine = self.build_machine(update)
+        controlled = []
+        try:
+            controlled = self.create_objects(machine, create)
+            runner = local_broker if self.broker else eager
+            with runner():
+                elapsed = self.drive(machine, controlled, change)
+            self.measure_next_for_user(machine, controlled, next_for_user, available_to)
+        finally:
+            self.cleanup(machine, controlled)
+
+        transitions = self.transitions * len(controlled)
+        return {
+            'commit': current_commit(),
+            'date': timezone.now().isoformat(),
+            'parameters': {'model': self.model._meta.label,
+                           'nodes': self.nodes,
+                           'links': self.links,
+                           'objects': self.objects,
+                           'tasks': self.tasks,
+                           'transitions': self.transitions,
+                           'broker': 'memory' if self.broker else 'eager'},
+            'fsm_update': update.as_dict(),
+            'initialize': create.as_dict(),
+            'change_to': change.as_dict(),
+            'transitions_per_second': transitions / elapsed if elapsed else None,
+            'next_for_user': next_for_user.as_dict(),
+            'transitions_available_to': available_to.as_dict(),
+        }
+
+
+def compare(previous, current):
+    '''{metric: current / previous} of the per call timings and queries'''
+    ratios = {}
+    for key, value in current.items():
+        if not isinstance(value, dict) or key not in previous:
+            continue
+        for metric in ('seconds_per_call', 'queries_per_call'):
+            before = previous[key].get(metric)
+            after = value.get(metric)
+            if before and after is not None:
+                ratios['{0}.{1}'.format(key, metric)] = after / before
+    return ratios
@@ -5,3 +5,29 @@ INNER_STATE_RUNNING = 'running'
 
 INNER_STATE_CHOICES = ((INNER_STATE_IDLE, _('Idle')),
                        (INNER_STATE_RUNNING, _('Running')), )
+
+EXECUTION_DEFAULT = ''
+EXECUTION_CELERY = 'celery'
+EXECUTION_SYNC = 'sync'
+EXECUTION_THREAD = 'thread'
+
+EXECUTION_CHOICES = ((EXECUTION_DEFAULT, _('Default')),
+                     (EXECUTION_CELERY, _('Celery')),
+                     (EXECUTION_SYNC, _('Synchronous')),
+                     (EXECUTION_THREAD, _('Thread Pool')), )
+
+RESULT_RUNNING = 'running'
+RESULT_SUCCESS = 'success'
+RESULT_FAILURE = 'failure'
+
+RESULT_CHOICES = ((RESULT_RUNNING, _('Running')),
+                  (RESULT_SUCCESS, _('Success')),
+                  (RESULT_FAILURE, _('Failure')), )
+
+DATA_POLICY_COPY = 'copy'
+DATA_POLICY_EMPTY = 'empty'
+DATA_POLICY_MERGE = 'merge'
+
+DATA_POLICY_CHOICES = ((DATA_POLICY_COPY, _('Copy the data of the previous state')),
+                       (DATA_POLICY_EMPTY, _('Start with empty data')),
+                       (DATA_POLICY_MERGE, _('Copy the data of the previous state over the defaults')), )
@@ -0,0 +1,192 @@
+# coding: utf-8
+'''Read-through cache of StateController.current_data.
+
+Entries are keyed by (controller id, state id) and hold the id, version,
+base and materialized payload of the latest data of that state. The
+cache is chosen with ``WORKFLOW_DATA_CACHE`` (a dotted path; nothing is
+cached when it is not set):
+
+* ``LocalDataCache``: an LRU of ``WORKFLOW_DATA_CACHE_SIZE`` entries in
+  this process. Other processes cannot invalidate it, so its entries
+  expire after ``WORKFLOW_DATA_CACHE_LOCAL_TIMEOUT`` seconds.
+* ``DjangoDataCache``: the ``WORKFLOW_DATA_CACHE_ALIAS`` django cache,
+  shared by every process.
+* ``TieredDataCache``: a LocalDataCache in front of a DjangoDataCache.
+
+Entries are dropped whenever a StateControllerData is saved, patched
+or created for the key, and the previous state's entry when the
+controller changes state.
+'''
+import time
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+
+DEFAULT_SIZE = 1024
+DEFAULT_LOCAL_TIMEOUT = 5
+DEFAULT_TIMEOUT = 300
+
+
+def entry_of(data):
+    '''the cached representation of a StateControllerData'''
+    return {'id': data.pk,
+            'version': data.version,
+            'base_id': data.base_id,
+            'date_created': data.date_created,
+            'data': data.data}
+
+
+class DataCache(object):
+
+    def get(self, controller_id, state_id):
+        '''the entry of the key or None'''
+        raise NotImplementedError
+
+    def set(self, controller_id, state_id, entry):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        '''drops the (controller id, state id) keys'''
+        raise NotImplementedError
+
+    def delete(self, controller_id, state_id):
+        self.delete_many([(controller_id, state_id)])
+
+    def clear(self):
+        pass
+
+
+class LocalDataCache(DataCache):
+
+    def __init__(self, max_size=None, timeout=None):
+        self.max_size = max_size or getattr(settings, 'WORKFLOW_DATA_CACHE_SIZE', DEFAULT_SIZE)
+        self.timeout = timeout or getattr(settings,
+                                          'WORKFLOW_DATA_CACHE_LOCAL_TIMEOUT',
+                                          DEFAULT_LOCAL_TIMEOUT)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, controller_id, state_id):
+        key = (controller_id, state_id)
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires < time.time():
+                return None
+            self._entries[key] = item
+        # callers edit the payload before saving it
+        return deepcopy(entry)
+
+    def set(self, controller_id, state_id, entry):
+        key = (controller_id, state_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, deepcopy(entry))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoDataCache(DataCache):
+
+    def __init__(self, alias=None, timeout=None):
+        self.cache = caches[alias or getattr(settings, 'WORKFLOW_DATA_CACHE_ALIAS', 'default')]
+        self.timeout = timeout or getattr(settings, 'WORKFLOW_DATA_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+    def key(self, controller_id, state_id):
+        return 'workflow:data:{0}:{1}'.format(controller_id, state_id)
+
+    def get(self, controller_id, state_id):
+        return self.cache.get(self.key(controller_id, state_id))
+
+    def set(self, controller_id, state_id, entry):
+        self.cache.set(self.key(controller_id, state_id), entry, self.timeout)
+
+    def delete_many(self, keys):
+        self.cache.delete_many([self.key(*key) for key in keys])
+
+
+class TieredDataCache(DataCache):
+
+    def __init__(self, local=None, shared=None):
+        self.local = local or LocalDataCache()
+        self.shared = shared or DjangoDataCache()
+
+    def get(self, controller_id, state_id):
+        entry = self.local.get(controller_id, state_id)
+        if entry is None:
+            entry = self.shared.get(controller_id, state_id)
+            if entry is not None:
+                self.local.set(controller_id, state_id, entry)
+        return entry
+
+    def set(self, controller_id, state_id, entry):
+        self.shared.set(controller_id, state_id, entry)
+        self.local.set(controller_id, state_id, entry)
+
+    def delete_many(self, keys):
+        self.shared.delete_many(keys)
+        self.local.delete_many(keys)
+
+    def clear(self):
+        self.local.clear()
+
+
+_cache = None
+_configured = False
+_cache_lock = threading.Lock()
+
+
+def get_data_cache():
+    '''the process wide data cache or None when caching is off'''
+    global _cache, _configured
+    if not _configured:
+        with _cache_lock:
+            path = getattr(settings, 'WORKFLOW_DATA_CACHE', None)
+            _cache = import_string(path)() if path else None
+            _configured = True
+    return _cache
+
+
+def set_data_cache(cache):
+    global _cache, _configured
+    with _cache_lock:
+        _cache = cache
+        _configured = True
+
+
+def reset_data_cache():
+    '''the next get_data_cache() reads the settings again'''
+    global _cache, _configured
+    with _cache_lock:
+        _cache = None
+        _configured = False
+
+
+def invalidate(keys):
+    '''drops the (controller id, state id) keys from the cache, again
+    on commit if in a transaction: others may cache the old data
+    until then'''
+    cache = get_data_cache()
+    if cache is None or not keys:
+        return
+
+    keys = list(keys)
+    cache.delete_many(keys)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: cache.delete_many(keys))
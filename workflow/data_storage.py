@@ -0,0 +1,110 @@
+# coding: utf-8
+'''Delta encoding of StateControllerData.
+
+With ``WORKFLOW_DATA_STORAGE = 'delta'`` the data created for a new
+state references the snapshot (``base``) of the previous state instead
+of copying it, and edits are stored as a JSON merge patch (RFC 7386)
+against that snapshot. A row whose patch grows beyond
+``WORKFLOW_DATA_COMPACTION_RATIO`` times the size of its snapshot is
+compacted back into a snapshot of its own.
+'''
+import json
+from copy import deepcopy
+from django.conf import settings
+
+
+STORAGE_FULL = 'full'
+STORAGE_DELTA = 'delta'
+
+DEFAULT_COMPACTION_RATIO = 0.5
+
+
+def storage_mode():
+    return getattr(settings, 'WORKFLOW_DATA_STORAGE', STORAGE_FULL)
+
+
+def compaction_ratio():
+    return getattr(settings, 'WORKFLOW_DATA_COMPACTION_RATIO', DEFAULT_COMPACTION_RATIO)
+
+
+def _encodable(value):
+    '''merge patches use null to remove keys, so objects holding
+    null values cannot be represented'''
+    if value is None:
+        return False
+    if isinstance(value, dict):
+        return all(_encodable(v) for v in value.values())
+    return True
+
+
+class _NotEncodable(Exception):
+    pass
+
+
+def _diff(source, target):
+    patch = {}
+    for key in source:
+        if key not in target:
+            patch[key] = None
+
+    for key, value in target.items():
+        if key in source and source[key] == value:
+            continue
+        if key in source and isinstance(source[key], dict) and isinstance(value, dict):
+            patch[key] = _diff(source[key], value)
+        elif _encodable(value):
+            patch[key] = value
+        else:
+            raise _NotEncodable()
+    return patch
+
+
+def diff(source, target):
+    '''merge patch turning source into target, or None
+    when target cannot be expressed as a patch'''
+    if not isinstance(source, dict) or not isinstance(target, dict):
+        return None
+    try:
+        return _diff(source, target)
+    except _NotEncodable:
+        return None
+
+
+def apply(source, patch):
+    '''applies a merge patch to a copy of source'''
+    if not isinstance(patch, dict):
+        return deepcopy(patch)
+
+    result = deepcopy(source) if isinstance(source, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply(result.get(key), value)
+    return result
+
+
+def should_compact(base, patch):
+    '''if patch is too big to be worth keeping as a delta'''
+    if not patch:
+        return False
+    return len(json.dumps(patch)) > compaction_ratio() * len(json.dumps(base))
+
+
+def compact(queryset=None, ratio=None):
+    '''turns the delta rows of queryset whose patch outgrew ratio
+    into snapshots. Returns the number of rows compacted.'''
+    from .models import StateControllerData
+    if queryset is None:
+        queryset = StateControllerData.objects.all()
+    ratio = compaction_ratio() if ratio is None else ratio
+
+    compacted = 0
+    rows = queryset.filter(base__isnull=False).select_related('base')
+    for row in rows.iterator():
+        if len(json.dumps(row.patch or {})) > ratio * len(json.dumps(row.base.data)):
+            StateControllerData.objects.filter(pk=row.pk).update(data=row.data,
+                                                                 base=None,
+                                                                 patch=None)
+            compacted += 1
+    return compacted
@@ -0,0 +1,28 @@
+# coding: utf-8
+import json
+
+
+class VersionConflict(Exception):
+
+    '''the row was changed by someone else since the
+    version the caller based its change on'''
+    pass
+
+
+class LeaseLost(Exception):
+
+    '''the controller was reaped, or claimed by another run,
+    while the run that claimed it was still working'''
+    pass
+
+
+class SchemaValidationError(ValueError):
+
+    '''the data does not match the schema of the transition.
+    errors holds one dict per violation, with its path,
+    message, validator and schema_path'''
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(SchemaValidationError, self).__init__(
+            u'Schema Invalid: {0}'.format(json.dumps(errors)))
@@ -0,0 +1,149 @@
+# coding: utf-8
+'''Persistence of TransitionExecution and TaskExecution records.
+
+Inline pipelines and bulk changes collect the timings of their tasks
+in an ExecutionRecorder and write them with two bulk queries when the
+transition ends. Chained transitions, whose tasks run in separate
+celery messages, get their TransitionExecution when dispatched and
+each task appends its own TaskExecution. Nothing is written with
+``WORKFLOW_RECORD_EXECUTIONS = False``.
+'''
+import time
+import traceback
+from contextlib import contextmanager
+from django.conf import settings
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from .choices import (RESULT_FAILURE,
+                      RESULT_SUCCESS, )
+
+
+def recording():
+    return getattr(settings, 'WORKFLOW_RECORD_EXECUTIONS', True)
+
+
+def describe(exc):
+    '''the error stored for a failed task'''
+    return u'{0}: {1}\n{2}'.format(exc.__class__.__name__,
+                                   exc,
+                                   traceback.format_exc())
+
+
+def _elapsed_since_start():
+    '''seconds since the started_at of the row being updated'''
+    return RawSQL('EXTRACT(EPOCH FROM (%s - started_at))', [timezone.now()])
+
+
+@contextmanager
+def _timed(record):
+    '''times the block into record, keeping its error if it raises'''
+    start = time.time()
+    try:
+        yield record
+    except Exception as ex:
+        record.result = RESULT_FAILURE
+        record.error = describe(ex)
+        raise
+    finally:
+        record.duration = time.time() - start
+
+
+def _task_record(task, phase, task_id=None):
+    from .models import TaskExecution
+    return TaskExecution(name=task.name,
+                         phase=phase,
+                         task_id=task_id,
+                         result=RESULT_SUCCESS,
+                         started_at=timezone.now())
+
+
+class ExecutionRecorder(object):
+
+    '''collects the tasks run by one transition of controller'''
+
+    def __init__(self, controller, previous, next, transition=None, trace_id=None, task_id=None):
+        from .models import TransitionExecution
+        if transition is None:
+            transition = controller.machine.graph.transition(previous.id, next.id)
+        self.start = time.time()
+        self.tasks = []
+        self.execution = TransitionExecution(controller=controller,
+                                             transition_id=getattr(transition, 'id', None),
+                                             from_state=previous,
+                                             to_state=next,
+                                             trace_id=trace_id or '',
+                                             task_id=task_id,
+                                             started_at=timezone.now())
+
+    def task(self, task, phase):
+        '''context manager timing task as one of the transition's'''
+        record = _task_record(task, phase, self.execution.task_id)
+        self.tasks.append(record)
+        return _timed(record)
+
+    def finish(self):
+        '''the transition failed if any of its tasks did'''
+        failed = [t for t in self.tasks if t.result == RESULT_FAILURE]
+        self.execution.result = RESULT_FAILURE if failed else RESULT_SUCCESS
+        self.execution.error = failed[0].error if failed else ''
+        self.execution.duration = time.time() - self.start
+
+    def save(self):
+        save_executions([self])
+
+
+def save_executions(recorders):
+    '''writes the executions of recorders and their
+    tasks with two queries, whatever their number'''
+    from .models import TransitionExecution, TaskExecution
+    if not recorders or not recording():
+        return
+
+    for recorder in recorders:
+        recorder.finish()
+    executions = TransitionExecution.objects.bulk_create([r.execution for r in recorders])
+
+    tasks = []
+    for recorder, execution in zip(recorders, executions):
+        for task in recorder.tasks:
+            task.execution_id = execution.pk
+            tasks.append(task)
+    TaskExecution.objects.bulk_create(tasks)
+
+
+def start_execution(controller, next, trace_id=None):
+    '''creates the TransitionExecution of a chained transition
+    and returns its id, or None when executions are not recorded'''
+    if not recording():
+        return None
+
+    recorder = ExecutionRecorder(controller, controller.current_state, next, trace_id=trace_id)
+    recorder.execution.save()
+    return recorder.execution.pk
+
+
+@contextmanager
+def record_task(execution_id, task, phase, task_id=None):
+    '''records task as a TaskExecution of a chained transition. Its
+    failure, or the success of the commit phase, ends the transition'''
+    from .instrumentation import PHASE_COMMIT
+    from .models import TransitionExecution
+    if not execution_id or not recording():
+        yield
+        return
+
+    record = _task_record(task, phase, task_id)
+    record.execution_id = execution_id
+    try:
+        with _timed(record):
+            yield
+    finally:
+        record.save()
+        executions = TransitionExecution.objects.filter(pk=execution_id)
+        if record.result == RESULT_FAILURE:
+            executions.update(result=RESULT_FAILURE,
+                              error=record.error,
+                              duration=_elapsed_since_start())
+        elif phase == PHASE_COMMIT:
+            executions.update(result=RESULT_SUCCESS,
+                              duration=_elapsed_since_start())
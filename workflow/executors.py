@@ -0,0 +1,105 @@
+# coding: utf-8
+'''Strategies to execute the celery signature of a transition.
+
+``celery`` sends it to the broker, ``sync`` runs it in the calling
+process and ``thread`` runs it in a process wide thread pool. Every
+executor returns an object with an ``id``, like celery's AsyncResult.
+
+``celery`` and ``thread`` run the job on another connection, so inside
+a transaction they only send it once the transaction commits, when the
+claim and the execution it reports to are visible. A rollback drops it.
+'''
+import uuid
+import logging
+import threading
+from django.conf import settings
+from django.db import connections, transaction
+from .choices import (EXECUTION_CELERY,
+                      EXECUTION_SYNC,
+                      EXECUTION_THREAD, )
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREAD_POOL_SIZE = 4
+
+
+class Executor(object):
+
+    def execute(self, job):
+        raise NotImplementedError
+
+
+class CeleryExecutor(Executor):
+
+    def execute(self, job):
+        result = job.freeze()
+        transaction.on_commit(job.delay)
+        return result
+
+
+class SyncExecutor(Executor):
+
+    '''runs the job in this process; returns celery's EagerResult'''
+
+    def execute(self, job):
+        return job.apply()
+
+
+class ThreadResult(object):
+
+    '''result of a job running in the thread pool'''
+
+    def __init__(self, id, future=None):
+        self.id = id
+        self.future = future
+
+    def ready(self):
+        return self.future is not None and self.future.done()
+
+    def get(self, timeout=None):
+        return self.future.result(timeout).get()
+
+
+class ThreadPoolExecutor(Executor):
+
+    def __init__(self, max_workers=None):
+        from concurrent.futures import ThreadPoolExecutor as Pool
+        self.pool = Pool(max_workers=max_workers or getattr(settings,
+                                                            'WORKFLOW_THREAD_POOL_SIZE',
+                                                            DEFAULT_THREAD_POOL_SIZE))
+
+    def _apply(self, job):
+        try:
+            return job.apply()
+        finally:
+            connections.close_all()
+
+    def execute(self, job):
+        result = ThreadResult(str(uuid.uuid4()))
+
+        def submit():
+            result.future = self.pool.submit(self._apply, job)
+        transaction.on_commit(submit)
+        return result
+
+
+EXECUTORS = {
+    EXECUTION_CELERY: CeleryExecutor,
+    EXECUTION_SYNC: SyncExecutor,
+    EXECUTION_THREAD: ThreadPoolExecutor,
+}
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def get_executor(name):
+    '''the process wide executor called name'''
+    if name not in EXECUTORS:
+        raise ValueError('Unknown execution strategy {0}'.format(name))
+
+    with _lock:
+        if name not in _executors:
+            _executors[name] = EXECUTORS[name]()
+        return _executors[name]
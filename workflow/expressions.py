@@ -0,0 +1,28 @@
+# coding: utf-8
+import json
+from django.contrib.postgres.fields import JSONField
+from django.db.models import Func, Value
+
+
+class JSONBValue(Value):
+
+    '''a python value sent to postgres as jsonb'''
+
+    def __init__(self, value):
+        super(JSONBValue, self).__init__(value, output_field=JSONField())
+
+    def as_sql(self, compiler, connection):
+        return '%s::jsonb', [json.dumps(self.value)]
+
+
+class JSONBConcat(Func):
+
+    '''jsonb || jsonb: merges the top level keys of the right
+    hand side into the left hand side, inside the database'''
+
+    arg_joiner = ' || '
+    template = '(%(expressions)s)'
+
+    def __init__(self, *expressions, **extra):
+        extra.setdefault('output_field', JSONField())
+        super(JSONBConcat, self).__init__(*expressions, **extra)
@@ -3,7 +3,10 @@ import rest_framework_filters
 from .models import (StateMachine,
                      Action,
                      AvailableTask,
-                     TransitionLog,)
+                     TransitionLog,
+                     DailyTransitionCount,
+                     TransitionExecution,
+                     TaskExecution, )
 
 
 class ActionFilter(rest_framework_filters.FilterSet):
@@ -44,3 +47,47 @@ class TransitionLogFilter(rest_framework_filters.FilterSet):
         fields = {
             'controller': ['exact']
         }
+
+
+class DailyTransitionCountFilter(rest_framework_filters.FilterSet):
+
+    class Meta:
+
+        model = DailyTransitionCount
+        fields = {
+            'machine': ['exact', 'in'],
+            'from_state': ['exact'],
+            'to_state': ['exact'],
+            'day': ['exact', 'gte', 'lte'],
+        }
+
+
+class TransitionExecutionFilter(rest_framework_filters.FilterSet):
+
+    class Meta:
+
+        model = TransitionExecution
+        fields = {
+            'controller': ['exact'],
+            'transition': ['exact', 'in'],
+            'result': ['exact'],
+            'trace_id': ['exact'],
+            'started_at': ['gte', 'lte'],
+            'duration': ['gte', 'lte'],
+        }
+
+
+class TaskExecutionFilter(rest_framework_filters.FilterSet):
+
+    class Meta:
+
+        model = TaskExecution
+        fields = {
+            'execution': ['exact'],
+            'execution__transition': ['exact', 'in'],
+            'name': ['exact', 'icontains'],
+            'phase': ['exact'],
+            'result': ['exact'],
+            'started_at': ['gte', 'lte'],
+            'duration': ['gte', 'lte'],
+        }
@@ -7,7 +7,8 @@ from .models import (StateController,
                      State,
                      Transition,
                      AvailableTask,
-                     TransitionTask,)
+                     TransitionTask,
+                     deferred_version_bumps, )
 
 
 class FSMUpdater(object):
@@ -21,6 +22,9 @@ class FSMUpdater(object):
 
 class GoFSMUpdater(FSMUpdater):
 
+    # transition fields the representation does not hold
+    kept_fields = ('execution', 'data_schema')
+
     # issues #69
     # def validate_controlled(self, instance, data):
 
@@ -51,58 +55,171 @@ class GoFSMUpdater(FSMUpdater):
         fsm.representation = json.dumps(representation)
         fsm.save()
 
+    def _resolve_states(self, codes):
+        '''returns {code: State}, creating the missing
+        states with a single bulk insert'''
+        states = {s.code: s for s in State.objects.filter(code__in=codes)}
+        missing = [State(code=code) for code in codes if code not in states]
+        if missing:
+            State.objects.bulk_create(missing)
+            states.update({s.code: s for s in missing})
+        return states
+
+    def _resolve(self, model, ids, label):
+        '''fetches every referenced row of model in one query'''
+        ids = set(int(pk) for pk in ids)
+        objects = model.objects.in_bulk(ids)
+        missing = ids - set(objects.keys())
+        if missing:
+            raise ValidationError(u'Unknown {0}: {1}'.format(label,
+                                                            ', '.join(str(m) for m in sorted(missing))))
+        return objects
+
+    def _existing_transitions(self, instance):
+        '''{(from, to): (id, name, tasks, permissions)} of the stored graph
+        and {(from, to): fields} of the fields the representation does
+        not hold, which recreated transitions keep'''
+        tasks = {}
+        for transition_id, task_id in TransitionTask.objects.filter(transition__machine=instance) \
+                                                            .order_by('transition', 'order') \
+                                                            .values_list('transition_id', 'task_id'):
+            tasks.setdefault(transition_id, []).append(task_id)
+
+        permissions = {}
+        for transition_id, permission_id in Transition.permissions.through.objects \
+                                                      .filter(transition__machine=instance) \
+                                                      .values_list('transition_id', 'permission_id'):
+            permissions.setdefault(transition_id, set()).add(permission_id)
+
+        existing = {}
+        kept = {}
+        rows = instance.transitions.values_list('id',
+                                                'name',
+                                                'from_state_id',
+                                                'to_state_id',
+                                                *self.kept_fields)
+        for row in rows:
+            pk, name, from_state_id, to_state_id = row[:4]
+            existing[(from_state_id, to_state_id)] = (pk,
+                                                      name,
+                                                      tuple(tasks.get(pk, ())),
+                                                      frozenset(permissions.get(pk, ())))
+            kept[(from_state_id, to_state_id)] = dict(zip(self.kept_fields, row[4:]))
+        return existing, kept
+
+    def _update_actions(self, nodes, states):
+        '''replaces the actions of every node\'s state, touching
+        only the rows that actually changed'''
+        wanted_ids = set()
+        for node in nodes:
+            wanted_ids.update(int(a) for a in node.get('actions', list()))
+        actions = Action.objects.in_bulk(wanted_ids)
+
+        wanted = set()
+        for node in nodes:
+            state = states[node['text']]
+            for action_id in node.get('actions', list()):
+                if int(action_id) in actions:
+                    wanted.add((state.id, int(action_id)))
+
+        Through = State.actions.through
+        state_ids = [states[node['text']].id for node in nodes]
+        stale = []
+        current = set()
+        for pk, state_id, action_id in Through.objects.filter(state_id__in=state_ids) \
+                                                      .values_list('id', 'state_id', 'action_id'):
+            if (state_id, action_id) in wanted:
+                current.add((state_id, action_id))
+            else:
+                stale.append(pk)
+
+        if stale:
+            Through.objects.filter(id__in=stale).delete()
+        Through.objects.bulk_create([Through(state_id=state_id, action_id=action_id)
+                                     for state_id, action_id in wanted - current])
+
     def update(self, instance, data):
+        '''synchronizes the FSM graph with its GoJS representation.
+
+        The stored transitions are diffed against the representation, so
+        unchanged transitions are kept and the number of queries does
+        not depend on the size of the graph. The version is bumped once,
+        at the end, instead of for every row changed.'''
+        with deferred_version_bumps():
+            return self._update(instance, data)
+
+    def _update(self, instance, data):
         if 'representation' not in data:
             return None
 
-        instance.transitions.all().delete()
         representation = json.loads(data['representation'])
-        states = {s['key']: s['text'] for s in representation['nodeDataArray']}
-
-        for rep_transition in representation['linkDataArray']:
-            from_node = rep_transition['from']
-            to_node = rep_transition['to']
-
-            try:
-                from_state = State.objects.get(code=states[from_node])
-            except:
-                from_state = State.objects.create(code=states[from_node])
-            try:
-                to_state = State.objects.get(code=states[to_node])
-            except:
-                to_state = State.objects.create(code=states[to_node])
-
-            transition = Transition.objects.create(name=rep_transition['text'],
-                                                   machine=instance,
-                                                   from_state=from_state,
-                                                   to_state=to_state)
-            if 'tasks' in rep_transition:
-                tasks = [AvailableTask.objects.get(pk=int(t)) for t in rep_transition['tasks']]
-                for task in tasks:
-                    TransitionTask.objects.create(transition=transition,
-                                                  task=task)
-
-            if 'permissions' in rep_transition:
-                permissions = [Permission.objects.get(pk=int(p))
-                               for p in rep_transition['permissions']]
-                for permission in permissions:
-                    transition.permissions.add(permission)
-
-        for state_rep in representation['nodeDataArray']:
-            state_type = state_rep.get('type', 'common')
-            state = State.objects.get(code=state_rep['text'])
-            state.actions.clear()
-            for action_id in state_rep.get('actions', list()):
-                try:
-                    action = Action.objects.get(id=action_id)
-                    state.actions.add(action)
-                except Action.DoesNotExist:
-                    pass
-            if state_type == 'initial':
-                instance.initial_state = state
-                instance.save()
+        nodes = representation['nodeDataArray']
+        links = representation['linkDataArray']
+        codes = {s['key']: s['text'] for s in nodes}
+
+        states = self._resolve_states(set(codes.values()))
+
+        task_ids = set()
+        permission_ids = set()
+        for link in links:
+            task_ids.update(link.get('tasks', list()))
+            permission_ids.update(link.get('permissions', list()))
+        self._resolve(AvailableTask, task_ids, 'tasks')
+        self._resolve(Permission, permission_ids, 'permissions')
+
+        wanted = {}
+        for link in links:
+            from_state = states[codes[link['from']]]
+            to_state = states[codes[link['to']]]
+            edge = (from_state.id, to_state.id)
+            if edge in wanted:
+                raise ValidationError(u'Duplicated transition from {0} to {1}.'.format(from_state.code,
+                                                                                        to_state.code))
+            wanted[edge] = (link['text'],
+                            tuple(int(t) for t in link.get('tasks', list())),
+                            frozenset(int(p) for p in link.get('permissions', list())))
+
+        existing, kept = self._existing_transitions(instance)
+        removed = set(pk for edge, (pk, name, tasks, permissions) in existing.items()
+                      if wanted.get(edge) != (name, tasks, permissions))
+        added = [edge for edge, value in wanted.items()
+                 if edge not in existing or existing[edge][0] in removed]
+
+        if removed:
+            Transition.objects.filter(id__in=removed).delete()
+
+        transitions = [Transition(name=wanted[edge][0],
+                                  machine=instance,
+                                  from_state_id=edge[0],
+                                  to_state_id=edge[1],
+                                  **kept.get(edge, {}))
+                       for edge in added]
+        Transition.objects.bulk_create(transitions)
+
+        transition_tasks = []
+        transition_permissions = []
+        PermissionThrough = Transition.permissions.through
+        for transition in transitions:
+            name, tasks, permissions = wanted[(transition.from_state_id, transition.to_state_id)]
+            transition_tasks.extend(TransitionTask(transition=transition,
+                                                   task_id=task_id,
+                                                   order=order)
+                                    for order, task_id in enumerate(tasks))
+            transition_permissions.extend(PermissionThrough(transition_id=transition.id,
+                                                            permission_id=permission_id)
+                                          for permission_id in permissions)
+        TransitionTask.objects.bulk_create(transition_tasks)
+        PermissionThrough.objects.bulk_create(transition_permissions)
+
+        self._update_actions(nodes, states)
+
+        initial = [node for node in nodes if node.get('type', 'common') == 'initial']
+        if initial:
+            instance.initial_state = states[initial[-1]['text']]
+            instance.save()
 
         if not instance.initial_state:
             raise ValidationError(u'You need to define an initial state for this FSM.')
 
+        instance.bump_version()
         return instance
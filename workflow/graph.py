@@ -0,0 +1,156 @@
+# coding: utf-8
+'''Compiled, in-memory representation of a StateMachine graph.
+
+Reading a machine's transitions, tasks and permissions from the database
+on every state change is wasteful: graphs change rarely and are read all
+the time. ``get_graph`` compiles a machine once per process and keeps it
+until the machine's ``version`` changes (``GoFSMUpdater.update`` bumps it).
+'''
+import threading
+from collections import namedtuple
+
+
+class CompiledTransition(namedtuple('CompiledTransition',
+                                    ['id',
+                                     'name',
+                                     'from_state_id',
+                                     'to_state_id',
+                                     'tasks',
+                                     'permissions',
+                                     'execution',
+                                     'data_schema',
+                                     'schema_hash'])):
+
+    '''Immutable view of a Transition.
+
+    ``tasks`` is the ordered tuple of task class paths,
+    ``permissions`` a tuple of ``app_label.codename`` strings,
+    ``execution`` the transition's execution strategy, if any, and
+    ``data_schema`` the JSON schema of the transition or else of its
+    target state, with its ``schema_hash``.'''
+
+    __slots__ = ()
+
+    def is_available(self, user):
+        '''determines if this transition can
+        be executed by this user'''
+        if not self.permissions:
+            return True
+
+        return user.has_perms(self.permissions)
+
+
+class CompiledGraph(object):
+
+    '''Immutable adjacency view of a StateMachine.'''
+
+    def __init__(self, machine_id, version, initial_state_id, transitions, execution=''):
+        self.machine_id = machine_id
+        self.version = version
+        self.initial_state_id = initial_state_id
+        self.execution = execution
+
+        adjacency = {}
+        for transition in transitions:
+            adjacency.setdefault(transition.from_state_id, []).append(transition)
+
+        self._adjacency = {k: tuple(v) for k, v in adjacency.items()}
+        self._by_id = {t.id: t for t in transitions}
+        self._by_edge = {(t.from_state_id, t.to_state_id): t for t in transitions}
+
+    def next(self, from_state_id):
+        '''all transitions leaving from_state_id'''
+        return self._adjacency.get(from_state_id, ())
+
+    def transition(self, from_state_id, to_state_id):
+        '''the transition between two states or None'''
+        return self._by_edge.get((from_state_id, to_state_id))
+
+    def get(self, transition_id):
+        return self._by_id.get(transition_id)
+
+    def tasks(self, transition_id):
+        return self._by_id[transition_id].tasks
+
+    def permissions(self, transition_id):
+        return self._by_id[transition_id].permissions
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+
+_graphs = {}
+_lock = threading.Lock()
+
+
+def compile_graph(machine):
+    '''builds a CompiledGraph for machine using
+    three queries, regardless of the graph size'''
+    from .models import Transition, TransitionTask
+    from .schemas import schema_hash
+
+    transitions = Transition.objects.filter(machine_id=machine.id) \
+                                    .values_list('id', 'name', 'from_state_id', 'to_state_id', 'execution',
+                                                 'data_schema', 'to_state__data_schema')
+
+    tasks = {}
+    transition_tasks = TransitionTask.objects.filter(transition__machine_id=machine.id) \
+                                             .order_by('transition', 'order') \
+                                             .values_list('transition_id', 'task__klass')
+    for transition_id, klass in transition_tasks:
+        tasks.setdefault(transition_id, []).append(klass)
+
+    permissions = {}
+    through = Transition.permissions.through.objects.filter(transition__machine_id=machine.id) \
+                                                    .values_list('transition_id',
+                                                                 'permission__content_type__app_label',
+                                                                 'permission__codename')
+    for transition_id, app_label, codename in through:
+        permissions.setdefault(transition_id, []).append('{0}.{1}'.format(app_label, codename))
+
+    compiled = []
+    for pk, name, from_state_id, to_state_id, execution, schema, state_schema in transitions:
+        # the transition's schema overrides the target state's
+        schema = schema or state_schema or None
+        compiled.append(CompiledTransition(id=pk,
+                                           name=name,
+                                           from_state_id=from_state_id,
+                                           to_state_id=to_state_id,
+                                           tasks=tuple(tasks.get(pk, ())),
+                                           permissions=tuple(sorted(permissions.get(pk, ()))),
+                                           execution=execution,
+                                           data_schema=schema,
+                                           schema_hash=schema_hash(schema) if schema else None))
+
+    return CompiledGraph(machine.id,
+                         machine.version,
+                         machine.initial_state_id,
+                         compiled,
+                         machine.execution)
+
+
+def get_graph(machine):
+    '''returns the compiled graph for machine, compiling
+    it only when this process has not seen its current version'''
+    graph = _graphs.get(machine.id)
+    if graph is not None and graph.version == machine.version:
+        return graph
+
+    graph = compile_graph(machine)
+    with _lock:
+        current = _graphs.get(machine.id)
+        if current is None or current.version <= graph.version:
+            _graphs[machine.id] = graph
+    return graph
+
+
+def invalidate(machine_id=None):
+    '''drops compiled graphs from this process'''
+    with _lock:
+        if machine_id is None:
+            _graphs.clear()
+        else:
+            _graphs.pop(machine_id, None)
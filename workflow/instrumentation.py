@@ -0,0 +1,218 @@
+# coding: utf-8
+'''Timing and query counting of the transition path.
+
+Each phase of a transition (the change request, the TaskRunner, every
+validation and task, and the final state change) is measured and sent
+as an event to the sink configured in ``WORKFLOW_INSTRUMENTATION_SINK``
+(a dotted path; nothing is measured when it is not set). Events share
+the ``transition_id`` of the transition they belong to.
+'''
+import re
+import time
+import uuid
+import socket
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+PHASE_REQUEST = 'request'
+PHASE_RUNNER = 'runner'
+PHASE_DISPATCH = 'dispatch'
+PHASE_VALIDATION = 'validation'
+PHASE_TASK = 'task'
+PHASE_COMMIT = 'commit'
+
+
+def new_transition_id():
+    return uuid.uuid4().hex
+
+
+class Sink(object):
+
+    # counting queries forces django to record every
+    # statement of the phase, so sinks may opt out
+    capture_queries = True
+
+    def emit(self, event):
+        '''event: dict with phase, transition_id, seconds,
+        queries (or None) and any tags of the phase'''
+        raise NotImplementedError
+
+
+class LoggingSink(Sink):
+
+    def emit(self, event):
+        tags = {k: v for k, v in event.items()
+                if k not in ('phase', 'transition_id', 'seconds', 'queries')}
+        logger.info('workflow %s %s %.6fs %s queries %s',
+                    event['phase'],
+                    event['transition_id'],
+                    event['seconds'],
+                    event['queries'],
+                    tags)
+
+
+class StatsdSink(Sink):
+
+    '''sends timers and counters to a statsd daemon over UDP'''
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or getattr(settings, 'WORKFLOW_STATSD_HOST', 'localhost'),
+                        port or getattr(settings, 'WORKFLOW_STATSD_PORT', 8125))
+        self.prefix = prefix or getattr(settings, 'WORKFLOW_STATSD_PREFIX', 'workflow')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def metric(self, event):
+        parts = [self.prefix, event['phase']]
+        if event.get('task'):
+            parts.append(re.sub(r'[^\w.-]+', '_', event['task']))
+        return '.'.join(parts)
+
+    def emit(self, event):
+        name = self.metric(event)
+        lines = ['{0}.duration:{1:.3f}|ms'.format(name, event['seconds'] * 1000)]
+        if event['queries'] is not None:
+            lines.append('{0}.queries:{1}|h'.format(name, event['queries']))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except socket.error as ex:
+            logger.debug('statsd unreachable. %s', ex)
+
+
+class MemorySink(Sink):
+
+    '''keeps the events in memory, for tests'''
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def phases(self, transition_id=None):
+        return [e['phase'] for e in self.events
+                if transition_id is None or e['transition_id'] == transition_id]
+
+    def clear(self):
+        with self._lock:
+            del self.events[:]
+
+
+_sink = None
+_configured = False
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    '''the process wide sink or None when instrumentation is off'''
+    global _sink, _configured
+    if not _configured:
+        with _sink_lock:
+            path = getattr(settings, 'WORKFLOW_INSTRUMENTATION_SINK', None)
+            _sink = import_string(path)() if path else None
+            _configured = True
+    return _sink
+
+
+def set_sink(sink):
+    '''replaces the process wide sink; None turns instrumentation off'''
+    global _sink, _configured
+    with _sink_lock:
+        _sink = sink
+        _configured = True
+
+
+def reset_sink():
+    '''the next get_sink() reads the settings again'''
+    global _sink, _configured
+    with _sink_lock:
+        _sink = None
+        _configured = False
+
+
+class QueryCounter(object):
+
+    '''Counts the queries run on connection inside the block.
+
+    Queries are counted by an execute wrapper, which logs nothing.
+    Django versions without execute wrappers only count queries by
+    logging them, so the block gets a log of its own, unbounded unlike
+    the connection's, which is kept afterwards only if it was being
+    kept anyway (DEBUG, or an enclosing counter).'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = None
+        self.wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.count = 0
+        if hasattr(self.connection, 'execute_wrapper'):
+            self.wrapper = self.connection.execute_wrapper(self)
+            self.wrapper.__enter__()
+            return self
+
+        self.log = self.connection.queries_log
+        self.kept = self.connection.queries_logged
+        self.forced = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.connection.queries_log = deque()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.wrapper is not None:
+            self.wrapper.__exit__(exc_type, exc_value, traceback)
+            self.wrapper = None
+            return
+
+        block = self.connection.queries_log
+        self.count = len(block)
+        self.connection.queries_log = self.log
+        self.connection.force_debug_cursor = self.forced
+        if self.kept:
+            self.log.extend(block)
+
+
+@contextmanager
+def timer(phase, transition_id=None, **tags):
+    '''measures the wall time and queries of the block as phase;
+    blocks that raise are reported with failed=True'''
+    sink = get_sink()
+    if sink is None:
+        yield
+        return
+
+    start = time.time()
+    ctx = QueryCounter(connection) if sink.capture_queries else None
+    failed = True
+    try:
+        if ctx is not None:
+            with ctx:
+                yield
+        else:
+            yield
+        failed = False
+    finally:
+        event = dict(tags,
+                     phase=phase,
+                     transition_id=transition_id,
+                     seconds=time.time() - start,
+                     queries=ctx.count if ctx is not None else None,
+                     failed=failed)
+        try:
+            sink.emit(event)
+        except Exception as ex:
+            logger.warning('Instrumentation sink failed. %s', ex)
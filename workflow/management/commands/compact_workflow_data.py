@@ -0,0 +1,18 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+from workflow import data_storage
+
+
+class Command(BaseCommand):
+
+    help = 'Turns delta encoded state data with large patches back into snapshots.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ratio',
+                            type=float,
+                            default=None,
+                            help='Patch to snapshot size ratio above which a row is compacted.')
+
+    def handle(self, *args, **options):
+        compacted = data_storage.compact(ratio=options['ratio'])
+        self.stdout.write('{0} rows compacted.'.format(compacted))
@@ -0,0 +1,45 @@
+# coding: utf-8
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from workflow import partitions
+
+
+class Command(BaseCommand):
+
+    help = 'Partitions the transition log by month, applies its retention policy and rolls it up by day.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert',
+                            action='store_true',
+                            default=False,
+                            help='Recreate the log table partitioned by month. Locks the table.')
+        parser.add_argument('--ahead',
+                            type=int,
+                            default=None,
+                            help='Months of partitions created ahead of the current one.')
+        parser.add_argument('--retention',
+                            type=int,
+                            default=None,
+                            help='Months of logs kept; older partitions are dropped.')
+        parser.add_argument('--rollup-days',
+                            type=int,
+                            default=2,
+                            help='Days, up to today, whose daily counts are recomputed.')
+
+    def handle(self, *args, **options):
+        if options['convert']:
+            if partitions.convert(options['ahead']):
+                self.stdout.write('Transition log partitioned by month.')
+            else:
+                self.stdout.write('Transition log is already partitioned.')
+
+        today = timezone.localtime(timezone.now()).date()
+        for days in reversed(range(options['rollup_days'])):
+            partitions.rollup(today - timedelta(days=days))
+
+        if partitions.is_partitioned():
+            for name in partitions.ensure_partitions(options['ahead']):
+                self.stdout.write('Created {0}.'.format(name))
+            for name in partitions.drop_expired(options['retention']):
+                self.stdout.write('Dropped {0}.'.format(name))
@@ -0,0 +1,64 @@
+# coding: utf-8
+import json
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from workflow.benchmarks import WorkflowBenchmark, compare
+
+
+class Command(BaseCommand):
+
+    help = ('Measures queries and wall time of the transition path on a synthetic '
+            'state machine and stores the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model',
+                            help='app_label.Model using StateControllerMixIn, creatable without arguments.')
+        parser.add_argument('--nodes', type=int, default=10)
+        parser.add_argument('--links', type=int, default=None,
+                            help='Transitions in the machine. Defaults to twice the nodes.')
+        parser.add_argument('--objects', type=int, default=100)
+        parser.add_argument('--tasks', type=int, default=1,
+                            help='Tasks in each transition.')
+        parser.add_argument('--transitions', type=int, default=2,
+                            help='Transitions made by each object.')
+        parser.add_argument('--broker', action='store_true',
+                            help='Use an in-memory broker and worker instead of eager mode.')
+        parser.add_argument('--user', default=None,
+                            help='Username used to measure next_for_user.')
+        parser.add_argument('--output', default=None,
+                            help='File the JSON results are written to.')
+        parser.add_argument('--compare', default=None,
+                            help='JSON results of a previous run to compare with.')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as ex:
+            raise CommandError(str(ex))
+
+        user = None
+        if options['user']:
+            user = get_user_model().objects.get(**{get_user_model().USERNAME_FIELD: options['user']})
+
+        benchmark = WorkflowBenchmark(model,
+                                      nodes=options['nodes'],
+                                      links=options['links'],
+                                      objects=options['objects'],
+                                      tasks=options['tasks'],
+                                      transitions=options['transitions'],
+                                      broker=options['broker'],
+                                      user=user)
+        results = benchmark.run()
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+            results['comparison'] = {'commit': previous.get('commit'),
+                                     'ratios': compare(previous, results)}
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,56 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+INDEX_USAGE = '''
+SELECT s.relname,
+       s.indexrelname,
+       s.idx_scan,
+       s.idx_tup_read,
+       pg_relation_size(s.indexrelid),
+       t.seq_scan
+FROM pg_stat_user_indexes s
+JOIN pg_stat_user_tables t ON t.relid = s.relid
+WHERE s.relname LIKE %s
+ORDER BY s.relname, s.idx_scan DESC, s.indexrelname
+'''
+
+
+def size(value):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if value < 1024:
+            return '{0:.0f}{1}'.format(value, unit)
+        value /= 1024.0
+    return '{0:.1f}TB'.format(value)
+
+
+class Command(BaseCommand):
+
+    help = 'Reports how often the indexes of the workflow tables were used since the statistics were reset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table',
+                            default='workflow_',
+                            help='Prefix of the tables to report.')
+        parser.add_argument('--unused',
+                            action='store_true',
+                            default=False,
+                            help='Only report indexes that were never scanned.')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute(INDEX_USAGE, [options['table'].replace('_', '\\_') + '%'])
+            rows = cursor.fetchall()
+
+        if options['unused']:
+            rows = [r for r in rows if r[2] == 0]
+
+        line = u'{0:<36} {1:<52} {2:>12} {3:>14} {4:>8}'
+        self.stdout.write(line.format('table', 'index', 'scans', 'tuples read', 'size'))
+        table = None
+        for relname, indexname, scans, tuples, bytes_, seq_scans in rows:
+            if relname != table:
+                table = relname
+                self.stdout.write(u'{0} ({1} sequential scans)'.format(relname, seq_scans))
+            self.stdout.write(line.format('', indexname, scans, tuples, size(bytes_)))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0004_auto_20170220_1706'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statemachine',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Incremented every time the FSM graph changes.', verbose_name='Version'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0005_statemachine_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statecontrollerdata',
+            name='base',
+            field=models.ForeignKey(blank=True, help_text='Snapshot this data is a patch of, when delta encoded.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflow.StateControllerData', verbose_name='Base Snapshot'),
+        ),
+        migrations.AddField(
+            model_name='statecontrollerdata',
+            name='patch',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='JSON merge patch applied to the base snapshot.', null=True, verbose_name='Patch'),
+        ),
+    ]
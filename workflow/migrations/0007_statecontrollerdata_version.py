@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0006_statecontrollerdata_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statecontrollerdata',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Incremented on every change, for optimistic concurrency.', verbose_name='Version'),
+        ),
+    ]
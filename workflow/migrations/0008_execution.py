@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0007_statecontrollerdata_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statemachine',
+            name='execution',
+            field=models.CharField(blank=True, choices=[('', 'Default'), ('celery', 'Celery'), ('sync', 'Synchronous'), ('thread', 'Thread Pool')], default='', help_text='How the transitions of this FSM are executed.', max_length=16, verbose_name='Execution'),
+        ),
+        migrations.AddField(
+            model_name='transition',
+            name='execution',
+            field=models.CharField(blank=True, choices=[('', 'Default'), ('celery', 'Celery'), ('sync', 'Synchronous'), ('thread', 'Thread Pool')], default='', help_text='How this transition is executed. Overrides the FSM.', max_length=16, verbose_name='Execution'),
+        ),
+    ]
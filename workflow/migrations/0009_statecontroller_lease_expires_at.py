@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0008_execution'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statecontroller',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When a running controller is considered stuck.', null=True, verbose_name='Lease Expires At'),
+        ),
+    ]
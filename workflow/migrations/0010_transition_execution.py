@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0009_statecontroller_lease_expires_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransitionExecution',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date Created')),
+                ('trace_id', models.CharField(blank=True, db_index=True, help_text='transition_id of the instrumentation events of the run.', max_length=32, verbose_name='Trace Id')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='Task Id')),
+                ('result', models.CharField(choices=[('running', 'Running'), ('success', 'Success'), ('failure', 'Failure')], default='running', max_length=16, verbose_name='Result')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('started_at', models.DateTimeField(verbose_name='Started At')),
+                ('duration', models.FloatField(blank=True, help_text='In seconds.', null=True, verbose_name='Duration')),
+                ('controller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='executions', to='workflow.StateController', verbose_name='State Controller')),
+                ('from_state', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflow.State', verbose_name='From State')),
+                ('to_state', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflow.State', verbose_name='To State')),
+                ('transition', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='executions', to='workflow.Transition', verbose_name='Transition')),
+            ],
+            options={
+                'verbose_name': 'Transition Execution',
+                'verbose_name_plural': 'Transition Executions',
+                'ordering': ('-date_created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='TaskExecution',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Name')),
+                ('phase', models.CharField(max_length=16, verbose_name='Phase')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='Task Id')),
+                ('result', models.CharField(choices=[('running', 'Running'), ('success', 'Success'), ('failure', 'Failure')], max_length=16, verbose_name='Result')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('started_at', models.DateTimeField(verbose_name='Started At')),
+                ('duration', models.FloatField(help_text='In seconds.', verbose_name='Duration')),
+                ('execution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='workflow.TransitionExecution', verbose_name='Transition Execution')),
+            ],
+            options={
+                'verbose_name': 'Task Execution',
+                'verbose_name_plural': 'Task Executions',
+                'ordering': ('started_at', 'id'),
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='transitionexecution',
+            index_together=set([('transition', 'date_created', 'result')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='taskexecution',
+            index_together=set([('started_at', 'duration'), ('name', 'started_at')]),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# the indexes are built CONCURRENTLY so large log and data
+# tables stay writable while the migration runs
+
+
+def concurrent_index(name, table, columns, where=None):
+    sql = 'CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} ({2})'.format(name, table, columns)
+    if where:
+        sql += ' WHERE {0}'.format(where)
+    return migrations.RunSQL(sql, 'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('workflow', '0010_transition_execution'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                concurrent_index('workflow_statecontroller_machine_state_idx',
+                                 'workflow_statecontroller',
+                                 'machine_id, current_state_id'),
+                concurrent_index('workflow_statecontrollerdata_lookup_idx',
+                                 'workflow_statecontrollerdata',
+                                 'controller_id, state_id, date_created DESC'),
+                concurrent_index('workflow_transitionlog_controller_date_idx',
+                                 'workflow_transitionlog',
+                                 'controller_id, date_created DESC'),
+            ],
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='statecontroller',
+                    index_together=set([('machine', 'current_state')]),
+                ),
+                migrations.AlterIndexTogether(
+                    name='statecontrollerdata',
+                    index_together=set([('controller', 'state', 'date_created')]),
+                ),
+                migrations.AlterIndexTogether(
+                    name='transitionlog',
+                    index_together=set([('controller', 'date_created')]),
+                ),
+            ],
+        ),
+        # the composite indexes lead with controller_id, which
+        # makes the single column foreign key indexes redundant
+        migrations.AlterField(
+            model_name='statecontrollerdata',
+            name='controller',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='data', to='workflow.StateController', verbose_name='State Controller'),
+        ),
+        migrations.AlterField(
+            model_name='transitionlog',
+            name='controller',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transition_logs', to='workflow.StateController', verbose_name='State Controller'),
+        ),
+        # reaping and the "already running" checks only look at the
+        # few running controllers; django cannot declare partial indexes
+        concurrent_index('workflow_statecontroller_running_idx',
+                         'workflow_statecontroller',
+                         'lease_expires_at',
+                         where="inner_state = 'running'"),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0011_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTransitionCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='Day')),
+                ('count', models.PositiveIntegerField(verbose_name='Count')),
+                ('from_state', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflow.State', verbose_name='From State')),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflow.StateMachine', verbose_name='State Machine')),
+                ('to_state', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflow.State', verbose_name='To State')),
+            ],
+            options={
+                'verbose_name': 'Daily Transition Count',
+                'verbose_name_plural': 'Daily Transition Counts',
+                'ordering': ('-day',),
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='dailytransitioncount',
+            index_together=set([('machine', 'day'), ('day',)]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0012_dailytransitioncount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='state',
+            name='data_policy',
+            field=models.CharField(choices=[('copy', 'Copy the data of the previous state'), ('empty', 'Start with empty data'), ('merge', 'Copy the data of the previous state over the defaults')], default='copy', help_text='How the data of this state is created when entering it.', max_length=16, verbose_name='Data Policy'),
+        ),
+        migrations.AddField(
+            model_name='state',
+            name='data_defaults',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, help_text='Top level keys added to the data, when missing, by the merge policy.', verbose_name='Data Defaults'),
+        ),
+    ]
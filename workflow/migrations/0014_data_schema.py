@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0013_state_data_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='state',
+            name='data_schema',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='JSON schema the data must match to enter this state.', null=True, verbose_name='Data Schema'),
+        ),
+        migrations.AddField(
+            model_name='transition',
+            name='data_schema',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='JSON schema the data must match to run this transition. Overrides the schema of the target state.', null=True, verbose_name='Data Schema'),
+        ),
+    ]
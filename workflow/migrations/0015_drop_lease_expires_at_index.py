@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0014_data_schema'),
+    ]
+
+    # the partial workflow_statecontroller_running_idx index of
+    # 0011_lookup_indexes serves reaping, which only looks at the
+    # few running controllers
+    operations = [
+        migrations.AlterField(
+            model_name='statecontroller',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, help_text='When a running controller is considered stuck.', null=True, verbose_name='Lease Expires At'),
+        ),
+    ]
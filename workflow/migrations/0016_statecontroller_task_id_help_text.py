@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0015_drop_lease_expires_at_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='statecontroller',
+            name='task_id',
+            field=models.CharField(blank=True, help_text='Transition id of the run that currently holds this controller.', max_length=64, null=True, verbose_name='Task ID'),
+        ),
+    ]
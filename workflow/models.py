@@ -1,8 +1,18 @@
 # coding: utf-8
+import logging
+import threading
 from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import Permission
 from django.contrib.gis.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.db.models import (OuterRef,
+                              Subquery, )
 from django.contrib.postgres.fields import JSONField
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -12,14 +22,29 @@ from common.models import (DomainModelMixIn,
                            DateUpdatedMixIn,
                            CreatedByMixIn,
                            CompiledDescriptionMixIn, )
-from .choices import (INNER_STATE_CHOICES,
+from .choices import (DATA_POLICY_CHOICES,
+                      DATA_POLICY_COPY,
+                      EXECUTION_CHOICES,
+                      EXECUTION_DEFAULT,
+                      INNER_STATE_CHOICES,
                       INNER_STATE_IDLE,
-                      INNER_STATE_RUNNING, )
-from .signals import (before_state_change,
-                      after_state_change,
+                      INNER_STATE_RUNNING,
+                      RESULT_CHOICES,
+                      RESULT_RUNNING, )
+from . import data_cache
+from . import data_storage
+from .exceptions import VersionConflict
+from .expressions import JSONBConcat, JSONBValue
+from .signals import (after_state_change,
+                      after_state_change_batch,
+                      controllers_initialized,
+                      controllers_reaped,
                       initialize_state_machine, )
 
 
+logger = logging.getLogger(__name__)
+
+
 class StateMachine(DateCreatedMixIn,
                    DateUpdatedMixIn,
                    CreatedByMixIn,
@@ -36,12 +61,46 @@ class StateMachine(DateCreatedMixIn,
                                help_text=_('Graphic representation of the FSM graph in JSON.'),
                                null=True)
 
+    version = models.PositiveIntegerField(verbose_name=_('Version'),
+                                          help_text=_('Incremented every time the FSM graph changes.'),
+                                          default=0)
+
+    execution = models.CharField(verbose_name=_('Execution'),
+                                 help_text=_('How the transitions of this FSM are executed.'),
+                                 choices=EXECUTION_CHOICES,
+                                 default=EXECUTION_DEFAULT,
+                                 blank=True,
+                                 max_length=16)
+
+    @property
+    def graph(self):
+        '''compiled, process-cached view of this FSM graph'''
+        from .graph import get_graph
+        return get_graph(self)
+
+    def bump_version(self):
+        '''marks the FSM graph as changed, invalidating
+        every compiled copy of it'''
+        StateMachine.objects.filter(pk=self.pk).update(version=models.F('version') + 1)
+        self.version = StateMachine.objects.filter(pk=self.pk) \
+                                           .values_list('version', flat=True)[0]
+
     def next(self, current_state):
-        return self.transitions.filter(from_state=current_state)
+        '''the CompiledTransitions leaving current_state (a State or
+        its id), read from the compiled graph'''
+        return self.graph.next(getattr(current_state, 'pk', current_state))
 
     def next_for_user(self, current_state, user):
-        transitions = self.next(current_state)
-        return [t for t in transitions if t.is_available(user)]
+        '''the CompiledTransitions from current_state that user can
+        execute, resolved against the compiled graph'''
+        return [t for t in self.next(current_state) if t.is_available(user)]
+
+    def transitions_available_to(self, current_state, user):
+        '''ids of the states user can reach from current_state,
+        resolved against the compiled graph'''
+        current_state_id = getattr(current_state, 'pk', current_state)
+        return set(t.to_state_id for t in self.graph.next(current_state_id)
+                   if t.is_available(user))
 
     def __unicode__(self):
 
@@ -74,6 +133,22 @@ class State(DomainModelMixIn,
 
     actions = models.ManyToManyField(Action)
 
+    data_policy = models.CharField(verbose_name=_('Data Policy'),
+                                   help_text=_('How the data of this state is created when entering it.'),
+                                   choices=DATA_POLICY_CHOICES,
+                                   default=DATA_POLICY_COPY,
+                                   max_length=16)
+
+    data_defaults = JSONField(verbose_name=_('Data Defaults'),
+                              help_text=_('Top level keys added to the data, when missing, by the merge policy.'),
+                              default=dict,
+                              blank=True)
+
+    data_schema = JSONField(verbose_name=_('Data Schema'),
+                            help_text=_('JSON schema the data must match to enter this state.'),
+                            null=True,
+                            blank=True)
+
     class Meta:
 
         verbose_name = _('State')
@@ -104,15 +179,33 @@ class Transition(DateCreatedMixIn,
                                    through='workflow.TransitionTask',
                                    related_name='transitions')
 
+    execution = models.CharField(verbose_name=_('Execution'),
+                                 help_text=_('How this transition is executed. Overrides the FSM.'),
+                                 choices=EXECUTION_CHOICES,
+                                 default=EXECUTION_DEFAULT,
+                                 blank=True,
+                                 max_length=16)
+
+    data_schema = JSONField(verbose_name=_('Data Schema'),
+                            help_text=_('JSON schema the data must match to run this transition. '
+                                        'Overrides the schema of the target state.'),
+                            null=True,
+                            blank=True)
+
+    @property
+    def permission_names(self):
+        '''"app_label.codename" of every permission required.
+        Uses prefetched permissions when available.'''
+        return ["{0}.{1}".format(p.content_type.app_label, p.codename)
+                for p in self.permissions.all()]
+
     def is_available(self, user):
         '''determines if this transition can
         be executed by this user'''
-        if self.permissions.all().count() <= 0:
+        perms = self.permission_names
+        if not perms:
             return True
 
-        perms = ["{0}.{1}".format(p.content_type.app_label, p.codename)
-                 for p in self.permissions.all()]
-
         return user.has_perms(perms)
 
     def __unicode__(self):
@@ -170,6 +263,99 @@ class TransitionTask(DateCreatedMixIn,
         verbose_name_plural = _('Tasks')
 
 
+DEFAULT_LEASE_SECONDS = 600
+
+
+_bumps = threading.local()
+
+
+@contextmanager
+def deferred_version_bumps():
+    '''skips the version bumps of the graph changes made by this
+    thread inside the block; the caller bumps the version once done'''
+    _bumps.deferred = getattr(_bumps, 'deferred', 0) + 1
+    try:
+        yield
+    finally:
+        _bumps.deferred -= 1
+
+
+def bump_machine_versions(**lookups):
+    '''marks the graphs of the FSMs matching lookups as changed.
+    Called by the receivers of Transition, TransitionTask and
+    AvailableTask changes'''
+    from .graph import invalidate
+    if getattr(_bumps, 'deferred', 0):
+        return []
+
+    ids = list(StateMachine.objects.filter(**lookups).values_list('pk', flat=True))
+    if ids:
+        StateMachine.objects.filter(pk__in=ids).update(version=models.F('version') + 1)
+        for pk in ids:
+            invalidate(pk)
+    return ids
+
+
+def lease_expiry():
+    '''expiry of a lease taken now'''
+    seconds = getattr(settings, 'WORKFLOW_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+    return timezone.now() + timedelta(seconds=seconds)
+
+
+class StateControllerManager(models.Manager):
+
+    def heartbeat(self, controller_ids, run_id=None):
+        '''renews the lease of many controllers running for run_id'''
+        return self.filter(id__in=controller_ids,
+                           inner_state=INNER_STATE_RUNNING,
+                           task_id=run_id) \
+                   .update(lease_expires_at=lease_expiry())
+
+    def reap(self):
+        '''resets the running controllers whose lease expired, or that
+        never had one, to idle with a single UPDATE and sends
+        controllers_reaped. Returns the ids of the reaped controllers.'''
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {0} SET inner_state = %s, task_id = NULL, lease_expires_at = NULL '
+                           'WHERE inner_state = %s '
+                           'AND (lease_expires_at < %s OR lease_expires_at IS NULL) '
+                           'RETURNING id, content_type_id, object_id'.format(self.model._meta.db_table),
+                           [INNER_STATE_IDLE, INNER_STATE_RUNNING, timezone.now()])
+            rows = cursor.fetchall()
+
+        if not rows:
+            return []
+
+        mirror_controllers_state([(ct, obj) for pk, ct, obj in rows],
+                                 inner_state=INNER_STATE_IDLE)
+        controller_ids = [pk for pk, ct, obj in rows]
+        logger.warning('Reaped %s stuck controllers.', len(controller_ids))
+        controllers_reaped.send_robust(sender=self.model,
+                                       controllers=controller_ids)
+        return controller_ids
+
+    def for_objects(self, queryset):
+        '''controllers of the objects in queryset. Accepts
+        querysets of controlled objects or of controllers.'''
+        if queryset.model is self.model:
+            return queryset
+
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        return self.filter(content_type_id=content_type.id,
+                           object_id__in=queryset.values('pk'))
+
+    def bulk_change_to(self, queryset, next, user=None):
+        '''changes the state of every object in queryset to next.
+
+        Objects that are running or that have no transition to next
+        (available to user, when given) are rejected. Returns a
+        BulkChangeResult with the celery group result and the number
+        of accepted and the ids of the rejected objects.'''
+        from .task_runner import BulkTaskRunner
+        runner = BulkTaskRunner(self.for_objects(queryset), next, user=user)
+        return runner.run()
+
+
 class StateController(models.Model):
 
     content_type = models.ForeignKey(ContentType)
@@ -187,7 +373,7 @@ class StateController(models.Model):
 
     task_id = models.CharField(max_length=64,
                                verbose_name=_('Task ID'),
-                               help_text=_('Task ID that this controller is currently running.'),
+                               help_text=_('Transition id of the run that currently holds this controller.'),
                                null=True,
                                blank=True)
 
@@ -196,9 +382,26 @@ class StateController(models.Model):
                                    default=INNER_STATE_IDLE,
                                    max_length=32)
 
+    # indexed by the partial workflow_statecontroller_running_idx index
+    lease_expires_at = models.DateTimeField(verbose_name=_('Lease Expires At'),
+                                            help_text=_('When a running controller is considered stuck.'),
+                                            null=True,
+                                            blank=True)
+
+    objects = StateControllerManager()
+
     def next(self):
+        '''the CompiledTransitions leaving the current state'''
+        return self.machine.next(self.current_state_id)
 
-        return self.machine.transitions.filter(from_state=self.current_state)
+    def mirror(self, **fields):
+        '''copies fields (current_state, inner_state) to the
+        controlled object, when it keeps a denormalized state'''
+        return mirror_controlled_state(self.content_type_id, [self.object_id], **fields)
+
+    def transitions_available_to(self, user):
+        '''ids of the states user can reach from the current state'''
+        return self.machine.transitions_available_to(self.current_state_id, user)
 
     def can_change_to(self, next):
         '''Validates if it's a valid
@@ -214,38 +417,156 @@ class StateController(models.Model):
 
         return True
 
-    def change_to(self, next):
-        '''changes the state to the next one'''
+    def claim(self, run_id=None):
+        '''flips this controller to running with a single conditional
+        UPDATE, which only succeeds while it is idle and still in the
+        state this instance knows. run_id, stored as the task_id,
+        identifies the run that owns the controller until it is idle
+        again. Returns if the claim was won.'''
+        lease = lease_expiry()
+        won = StateController.objects.filter(pk=self.pk,
+                                             inner_state=INNER_STATE_IDLE,
+                                             current_state_id=self.current_state_id) \
+                                     .update(inner_state=INNER_STATE_RUNNING,
+                                             task_id=run_id,
+                                             lease_expires_at=lease)
+        if won:
+            self.inner_state = INNER_STATE_RUNNING
+            self.task_id = run_id
+            self.lease_expires_at = lease
+        return won == 1
+
+    def owned(self, run_id=None):
+        '''this controller, while still running for run_id'''
+        return StateController.objects.filter(pk=self.pk,
+                                              inner_state=INNER_STATE_RUNNING,
+                                              task_id=run_id)
+
+    def heartbeat(self, run_id=None):
+        '''renews the lease of this controller while it runs for
+        run_id. Returns False if it was reaped or claimed again.'''
+        lease = lease_expiry()
+        renewed = self.owned(run_id).update(lease_expires_at=lease)
+        if renewed:
+            self.lease_expires_at = lease
+        return renewed == 1
+
+    def change_to(self, next, transition_id=None):
+        '''changes the state to the next one. transition_id
+        tags the instrumentation events of the transition'''
         from .task_runner import TaskRunner
         if not self.can_change_to(next):
             return False
 
-        before_state_change.send_robust(sender=self.__class__,
-                                        controlled=self.content_object,
-                                        controller=self,
-                                        current=self.current_state,
-                                        next=next)
-
-        task_runner = TaskRunner(self, next)
+        task_runner = TaskRunner(self, next, transition_id=transition_id)
         return task_runner.run()
 
     @property
     def current_data(self):
-        return self.data.filter(state=self.current_state).latest('date_created')
+        '''latest data of the current state, materialized and cached
+        on this controller and in the configured data cache'''
+        cached = getattr(self, '_current_data_cache', None)
+        if cached is not None and cached.state_id == self.current_state_id:
+            return cached
+
+        cache = data_cache.get_data_cache()
+        entry = cache.get(self.id, self.current_state_id) if cache is not None else None
+        if entry is not None:
+            data = StateControllerData.from_cache(self, self.current_state_id, entry)
+        else:
+            data = self.data.filter(state_id=self.current_state_id) \
+                            .select_related('base') \
+                            .latest('date_created')
+            if cache is not None:
+                cache.set(self.id, self.current_state_id, data_cache.entry_of(data))
+        self._current_data_cache = data
+        return data
+
+    def current_data_version(self):
+        '''(id, version) of the latest data of the current state,
+        without reading the data itself, or None'''
+        cached = getattr(self, '_current_data_cache', None)
+        if cached is not None and cached.state_id == self.current_state_id:
+            return cached.pk, cached.version
+
+        cache = data_cache.get_data_cache()
+        entry = cache.get(self.id, self.current_state_id) if cache is not None else None
+        if entry is not None:
+            return entry['id'], entry['version']
+
+        rows = list(self.data.filter(state_id=self.current_state_id)
+                             .order_by('-date_created')
+                             .values_list('id', 'version')[:1])
+        return rows[0] if rows else None
 
     class Meta:
 
         unique_together = (('content_type', 'object_id'), )
+        index_together = (('machine', 'current_state'), )
         verbose_name = _('State Controller')
         verbose_name_plural = _('State Controllers')
 
 
+class StateControllerDataManager(models.Manager):
+
+    def patch(self, controller, changes, version=None, data_id=None):
+        '''merges the top level keys of changes into the current data
+        of controller with a single UPDATE, without loading the
+        document. When version (and data_id) are given, the update
+        only happens if the current data is still that row at that
+        version, raising VersionConflict otherwise.
+        Returns (data id, new version).'''
+        rows = list(self.filter(controller_id=controller.id,
+                                state_id=controller.current_state_id)
+                        .order_by('-date_created')
+                        .values_list('id', 'version', 'base_id')[:1])
+        if not rows:
+            raise self.model.DoesNotExist()
+
+        pk, current_version, base_id = rows[0]
+        if data_id is not None and data_id != pk:
+            raise VersionConflict()
+
+        queryset = self.filter(pk=pk)
+        if version is not None:
+            queryset = queryset.filter(version=version)
+
+        fields = {'version': models.F('version') + 1,
+                  'date_updated': timezone.now()}
+        if base_id is None:
+            fields['data'] = JSONBConcat(models.F('data'), JSONBValue(changes))
+        elif all(v is not None and not isinstance(v, dict) for v in changes.values()):
+            # top level scalars and lists mean the same in a merge patch
+            fields['patch'] = JSONBConcat(Coalesce(models.F('patch'), JSONBValue({})),
+                                          JSONBValue(changes))
+        else:
+            instance = self.select_related('base').get(pk=pk)
+            data = instance.data
+            data.update(changes)
+            patch = data_storage.diff(instance.base.data, data)
+            if patch is None:
+                fields.update(data=data, base=None, patch=None)
+            else:
+                fields['patch'] = patch
+            queryset = queryset.filter(version=instance.version)
+
+        if not queryset.update(**fields):
+            raise VersionConflict()
+
+        controller.__dict__.pop('_current_data_cache', None)
+        invalidate_data_cache(controller.id, controller.current_state_id, pk if base_id is None else None)
+        new_version = self.filter(pk=pk).values_list('version', flat=True)[0]
+        return pk, new_version
+
+
 class StateControllerData(DateCreatedMixIn,
                           DateUpdatedMixIn):
 
+    # indexed by the (controller, state, date_created) index
     controller = models.ForeignKey(StateController,
                                    verbose_name=_('State Controller'),
-                                   related_name='data')
+                                   related_name='data',
+                                   db_index=False)
 
     state = models.ForeignKey(State,
                               verbose_name=_('State'),
@@ -254,9 +575,110 @@ class StateControllerData(DateCreatedMixIn,
     data = JSONField(verbose_name=_('State Data'),
                      default=dict)
 
+    base = models.ForeignKey('self',
+                             verbose_name=_('Base Snapshot'),
+                             help_text=_('Snapshot this data is a patch of, when delta encoded.'),
+                             related_name='+',
+                             null=True,
+                             blank=True,
+                             on_delete=models.CASCADE)
+
+    patch = JSONField(verbose_name=_('Patch'),
+                      help_text=_('JSON merge patch applied to the base snapshot.'),
+                      null=True,
+                      blank=True)
+
+    version = models.PositiveIntegerField(verbose_name=_('Version'),
+                                          help_text=_('Incremented on every change, for optimistic concurrency.'),
+                                          default=0)
+
+    objects = StateControllerDataManager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(StateControllerData, cls).from_db(db, field_names, values)
+        if instance.base_id is not None and 'data' in instance.__dict__:
+            instance.data = instance.materialize()
+        return instance
+
+    @classmethod
+    def from_cache(cls, controller, state_id, entry):
+        '''the row described by a data cache entry'''
+        instance = cls(id=entry['id'],
+                       controller=controller,
+                       state_id=state_id,
+                       data=entry['data'],
+                       base_id=entry['base_id'],
+                       version=entry['version'],
+                       date_created=entry['date_created'])
+        instance._state.adding = False
+        instance._state.db = 'default'
+        return instance
+
+    @property
+    def is_snapshot(self):
+        return self.base_id is None
+
+    def materialize(self):
+        '''the full data of this row'''
+        if self.base_id is None:
+            return self.data
+        return data_storage.apply(self.base.data, self.patch or {})
+
+    def save(self, *args, **kwargs):
+        try:
+            return self._save(*args, **kwargs)
+        finally:
+            invalidate_data_cache(self.controller_id,
+                                  self.state_id,
+                                  self.pk if self.base_id is None else None)
+
+    def delete(self, *args, **kwargs):
+        keys = (self.controller_id, self.state_id, self.pk)
+        try:
+            return super(StateControllerData, self).delete(*args, **kwargs)
+        finally:
+            invalidate_data_cache(*keys)
+
+    def _save(self, *args, **kwargs):
+        if self.pk:
+            self.version += 1
+
+        if self.base_id is None:
+            return super(StateControllerData, self).save(*args, **kwargs)
+
+        data = self.data
+        patch = data_storage.diff(self.base.data, data)
+        if patch is None or data_storage.should_compact(self.base.data, patch):
+            self.base = None
+            self.patch = None
+            return super(StateControllerData, self).save(*args, **kwargs)
+
+        self.patch = patch
+        self.data = {}
+        try:
+            return super(StateControllerData, self).save(*args, **kwargs)
+        finally:
+            self.data = data
+
     class Meta:
 
         ordering = ('-date_created', )
+        # latest data of a controller in a state (current_data)
+        index_together = (('controller', 'state', 'date_created'), )
+
+
+def invalidate_data_cache(controller_id, state_id, snapshot_id=None):
+    '''drops the cached current data of controller_id in state_id
+    and, in delta storage, of the rows based on snapshot_id'''
+    if data_cache.get_data_cache() is None:
+        return
+
+    keys = set([(controller_id, state_id)])
+    if snapshot_id is not None and data_storage.storage_mode() == data_storage.STORAGE_DELTA:
+        keys.update(StateControllerData.objects.filter(base_id=snapshot_id)
+                                               .values_list('controller_id', 'state_id'))
+    data_cache.invalidate(keys)
 
 
 class StateControllerMixIn(object):
@@ -276,15 +698,32 @@ class StateControllerMixIn(object):
 
     @property
     def controller(self):
+        '''the StateController of this object, with its machine and
+        current state. Fetched once per instance and cached.'''
+        try:
+            return self._controller_cache
+        except AttributeError:
+            pass
+
         content_type = ContentType.objects.get_for_model(self.__class__)
         try:
-            sc = StateController.objects.get(content_type_id=content_type.id,
+            sc = StateController.objects.select_related('machine', 'current_state') \
+                                        .get(content_type_id=content_type.id,
                                              object_id=self.id)
         except:
             return None
 
+        self._controller_cache = sc
         return sc
 
+    def invalidate_controller(self):
+        '''forgets the cached controller'''
+        self.__dict__.pop('_controller_cache', None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.invalidate_controller()
+        return super(StateControllerMixIn, self).refresh_from_db(*args, **kwargs)
+
     @property
     def current_data(self):
         if self.controller:
@@ -300,33 +739,211 @@ class StateControllerMixIn(object):
     @property
     def next(self):
         if self.controller:
-            return self.controller.machine.next(self.current_state)
+            return self.controller.next()
 
         return None
 
     def next_for_user(self, user):
         if self.controller and self.controller.machine:
-            return self.controller.machine.next_for_user(self.current_state,
+            return self.controller.machine.next_for_user(self.controller.current_state_id,
                                                          user)
         return None
 
+    def transitions_available_to(self, user):
+        if self.controller and self.controller.machine:
+            return self.controller.transitions_available_to(user)
+        return set()
+
     def can_change_to(self, next):
         '''Validates if it's a valid
         transition'''
         return self.controller.can_change_to(next)
 
-    def change_to(self, next):
+    def change_to(self, next, transition_id=None):
         '''Changes the state machine
         to a new state and fires all the stuff it
         needs to do'''
-        return self.controller.change_to(next)
+        try:
+            return self.controller.change_to(next, transition_id=transition_id)
+        finally:
+            self.invalidate_controller()
+
+
+def prefetch_controllers(objects):
+    '''attaches the controllers of objects (instances of models
+    using StateControllerMixIn) with one query per model, so reading
+    their controller, state or transitions costs no further queries.
+    Returns the objects as a list.'''
+    objects = list(objects)
+    by_model = {}
+    for obj in objects:
+        by_model.setdefault(obj.__class__, []).append(obj)
+
+    for model, instances in by_model.items():
+        content_type = ContentType.objects.get_for_model(model)
+        controllers = StateController.objects.select_related('machine', 'current_state') \
+                                             .filter(content_type_id=content_type.id,
+                                                     object_id__in=[o.pk for o in instances])
+        by_object_id = {c.object_id: c for c in controllers}
+        for obj in instances:
+            obj._controller_cache = by_object_id.get(obj.pk)
+
+    return objects
+
+
+DEFAULT_INITIALIZE_BATCH_SIZE = 1000
+
+
+def bulk_initialize(objects, state_machine, batch_size=None):
+    '''puts objects (instances of models using StateControllerMixIn)
+    under state_machine. For every batch_size objects, the controllers,
+    their initial logs and their empty data are written with three
+    bulk_create calls, by the receivers of after_state_change_batch,
+    sent once per batch; objects not saved yet are inserted first.
+    Instead of initialize_state_machine and after_state_change per
+    object, controllers_initialized is sent once per model.
+
+    Returns the controllers created.'''
+    objects = list(objects)
+    batch_size = batch_size or DEFAULT_INITIALIZE_BATCH_SIZE
+    initial_state = state_machine.initial_state
+
+    by_model = {}
+    for obj in objects:
+        by_model.setdefault(obj.__class__, []).append(obj)
+
+    created = {}
+    with transaction.atomic():
+        for model, instances in by_model.items():
+            unsaved = [o for o in instances if o.pk is None]
+            if unsaved:
+                model.objects.bulk_create(unsaved, batch_size=batch_size)
+
+            content_type = ContentType.objects.get_for_model(model)
+            controllers = created[model] = []
+            for i in range(0, len(instances), batch_size):
+                batch = instances[i:i + batch_size]
+                batch_controllers = StateController.objects.bulk_create(
+                    [StateController(content_type=content_type,
+                                     object_id=obj.pk,
+                                     machine=state_machine,
+                                     current_state=initial_state,
+                                     inner_state=INNER_STATE_IDLE)
+                     for obj in batch])
+                after_state_change_batch.send_robust(sender=StateController,
+                                                     changes=[(c, None, initial_state)
+                                                              for c in batch_controllers])
+
+                for obj, controller in zip(batch, batch_controllers):
+                    obj._controller_cache = controller
+                controllers.extend(batch_controllers)
+
+            if mirror_controlled_state(content_type.id,
+                                       [o.pk for o in instances],
+                                       current_state=initial_state,
+                                       inner_state=INNER_STATE_IDLE):
+                for obj in instances:
+                    obj.current_state = initial_state
+                    obj.inner_state = INNER_STATE_IDLE
+
+    for model, controllers in created.items():
+        controllers_initialized.send_robust(sender=model,
+                                            controllers=controllers,
+                                            state_machine=state_machine,
+                                            initial_state=initial_state)
+
+    return [c for controllers in created.values() for c in controllers]
+
+
+class StateControlledQuerySet(models.QuerySet):
+
+    '''QuerySet for models using StateControllerMixIn'''
+
+    def _controllers(self):
+        content_type = ContentType.objects.get_for_model(self.model)
+        return StateController.objects.filter(content_type_id=content_type.id,
+                                              object_id=OuterRef('pk'))
+
+    def with_workflow_state(self):
+        '''annotates workflow_state_id, workflow_inner_state,
+        workflow_machine_id and workflow_data_id (the latest data of
+        the current state), so objects can be filtered and ordered by
+        state in a single query'''
+        controllers = self._controllers()
+        content_type = ContentType.objects.get_for_model(self.model)
+        data = StateControllerData.objects.filter(controller__content_type_id=content_type.id,
+                                                  controller__object_id=OuterRef('pk'),
+                                                  state_id=OuterRef('workflow_state_id')) \
+                                          .order_by('-date_created')
+        return self.annotate(workflow_state_id=Subquery(controllers.values('current_state_id')[:1]),
+                             workflow_inner_state=Subquery(controllers.values('inner_state')[:1]),
+                             workflow_machine_id=Subquery(controllers.values('machine_id')[:1])) \
+                   .annotate(workflow_data_id=Subquery(data.values('id')[:1]))
+
+    def sync_workflow_state(self):
+        '''rewrites the denormalized state columns from the
+        controllers, with a single UPDATE'''
+        controllers = self._controllers()
+        return self.update(current_state=Subquery(controllers.values('current_state_id')[:1]),
+                           inner_state=Subquery(controllers.values('inner_state')[:1]))
+
+
+class DenormalizedStateControllerMixIn(StateControllerMixIn, models.Model):
+
+    '''StateControllerMixIn that mirrors the controller's current_state
+    and inner_state onto the controlled model's own table.
+
+    The columns are written by the workflow whenever the controller
+    changes and must not be edited directly.'''
+
+    current_state = models.ForeignKey(State,
+                                      verbose_name=_('Current State'),
+                                      related_name='+',
+                                      null=True,
+                                      blank=True,
+                                      editable=False,
+                                      on_delete=models.PROTECT)
+
+    inner_state = models.CharField(verbose_name=_('Inner State'),
+                                   choices=INNER_STATE_CHOICES,
+                                   default=INNER_STATE_IDLE,
+                                   editable=False,
+                                   max_length=32)
+
+    objects = StateControlledQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+def mirror_controlled_state(content_type_id, object_ids, **fields):
+    '''copies fields to the controlled objects of content_type_id that
+    use DenormalizedStateControllerMixIn. Returns the rows updated.'''
+    model = ContentType.objects.get_for_id(content_type_id).model_class()
+    if model is None or not issubclass(model, DenormalizedStateControllerMixIn):
+        return 0
+
+    return model._base_manager.filter(pk__in=object_ids).update(**fields)
+
+
+def mirror_controllers_state(controllers, **fields):
+    '''mirror_controlled_state for many (content_type_id, object_id)
+    pairs, with one UPDATE per content type'''
+    by_content_type = {}
+    for content_type_id, object_id in controllers:
+        by_content_type.setdefault(content_type_id, []).append(object_id)
+
+    for content_type_id, object_ids in by_content_type.items():
+        mirror_controlled_state(content_type_id, object_ids, **fields)
 
 
 class TransitionLog(DateCreatedMixIn):
 
+    # indexed by the (controller, date_created) index
     controller = models.ForeignKey(StateController,
                                    verbose_name=_('State Controller'),
-                                   related_name='transition_logs')
+                                   related_name='transition_logs',
+                                   db_index=False)
 
     from_state = models.ForeignKey(State,
                                    verbose_name=_('From State'),
@@ -343,3 +960,140 @@ class TransitionLog(DateCreatedMixIn):
         verbose_name = _('Transition Log')
         verbose_name_plural = _('Transition Logs')
         ordering = ('-date_created', )
+        index_together = (('controller', 'date_created'), )
+
+
+class DailyTransitionCount(models.Model):
+
+    '''number of transitions of a day, per machine and
+    edge, computed from the logs by partitions.rollup'''
+
+    day = models.DateField(verbose_name=_('Day'))
+
+    machine = models.ForeignKey(StateMachine,
+                                verbose_name=_('State Machine'),
+                                related_name='+',
+                                on_delete=models.CASCADE)
+
+    from_state = models.ForeignKey(State,
+                                   verbose_name=_('From State'),
+                                   related_name='+',
+                                   null=True,
+                                   on_delete=models.CASCADE)
+
+    to_state = models.ForeignKey(State,
+                                 verbose_name=_('To State'),
+                                 related_name='+',
+                                 null=True,
+                                 on_delete=models.CASCADE)
+
+    count = models.PositiveIntegerField(verbose_name=_('Count'))
+
+    class Meta:
+
+        verbose_name = _('Daily Transition Count')
+        verbose_name_plural = _('Daily Transition Counts')
+        ordering = ('-day', )
+        index_together = (('machine', 'day'),
+                          ('day', ), )
+
+
+class TransitionExecution(DateCreatedMixIn):
+
+    '''One run of a transition: when it started, how long it took,
+    its celery task and, when it failed, why. The tasks it ran are
+    its TaskExecutions.'''
+
+    controller = models.ForeignKey(StateController,
+                                   verbose_name=_('State Controller'),
+                                   related_name='executions')
+
+    transition = models.ForeignKey(Transition,
+                                   verbose_name=_('Transition'),
+                                   related_name='executions',
+                                   null=True,
+                                   on_delete=models.SET_NULL)
+
+    from_state = models.ForeignKey(State,
+                                   verbose_name=_('From State'),
+                                   related_name='+',
+                                   null=True)
+
+    to_state = models.ForeignKey(State,
+                                 verbose_name=_('To State'),
+                                 related_name='+',
+                                 null=True)
+
+    trace_id = models.CharField(verbose_name=_('Trace Id'),
+                                help_text=_('transition_id of the instrumentation events of the run.'),
+                                max_length=32,
+                                blank=True,
+                                db_index=True)
+
+    task_id = models.CharField(verbose_name=_('Task Id'),
+                               max_length=255,
+                               null=True,
+                               blank=True)
+
+    result = models.CharField(verbose_name=_('Result'),
+                              max_length=16,
+                              choices=RESULT_CHOICES,
+                              default=RESULT_RUNNING)
+
+    error = models.TextField(verbose_name=_('Error'),
+                             blank=True)
+
+    started_at = models.DateTimeField(verbose_name=_('Started At'))
+
+    duration = models.FloatField(verbose_name=_('Duration'),
+                                 help_text=_('In seconds.'),
+                                 null=True,
+                                 blank=True)
+
+    class Meta:
+
+        verbose_name = _('Transition Execution')
+        verbose_name_plural = _('Transition Executions')
+        ordering = ('-date_created', )
+        # failure rate per transition over a period
+        index_together = (('transition', 'date_created', 'result'), )
+
+
+class TaskExecution(models.Model):
+
+    execution = models.ForeignKey(TransitionExecution,
+                                  verbose_name=_('Transition Execution'),
+                                  related_name='tasks',
+                                  on_delete=models.CASCADE)
+
+    name = models.CharField(verbose_name=_('Name'),
+                            max_length=255)
+
+    phase = models.CharField(verbose_name=_('Phase'),
+                             max_length=16)
+
+    task_id = models.CharField(verbose_name=_('Task Id'),
+                               max_length=255,
+                               null=True,
+                               blank=True)
+
+    result = models.CharField(verbose_name=_('Result'),
+                              max_length=16,
+                              choices=RESULT_CHOICES)
+
+    error = models.TextField(verbose_name=_('Error'),
+                             blank=True)
+
+    started_at = models.DateTimeField(verbose_name=_('Started At'))
+
+    duration = models.FloatField(verbose_name=_('Duration'),
+                                 help_text=_('In seconds.'))
+
+    class Meta:
+
+        verbose_name = _('Task Execution')
+        verbose_name_plural = _('Task Executions')
+        ordering = ('started_at', 'id')
+        # slowest tasks of a period, overall and per task
+        index_together = (('started_at', 'duration'),
+                          ('name', 'started_at'), )
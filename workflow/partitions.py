@@ -0,0 +1,198 @@
+# coding: utf-8
+'''Monthly partitioning, retention and daily rollups of TransitionLog.
+
+``convert()`` turns the log table into a table partitioned by month of
+``date_created`` (Postgres 11 or later), with a default partition for
+rows outside the monthly ones. ``ensure_partitions()`` creates the
+partitions of the coming months and ``drop_expired()`` drops whole
+partitions older than ``WORKFLOW_TRANSITION_LOG_RETENTION_MONTHS``
+instead of deleting their rows. ``rollup()`` aggregates the logs of a
+day into DailyTransitionCount, which dashboards should query instead
+of the raw log.
+'''
+import re
+import logging
+from datetime import date, datetime, time, timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITIONS_AHEAD = 2
+
+PARTITION_NAME = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def _table():
+    from .models import TransitionLog
+    return TransitionLog._meta.db_table
+
+
+def retention_months():
+    '''months of logs kept, or None to keep them forever'''
+    return getattr(settings, 'WORKFLOW_TRANSITION_LOG_RETENTION_MONTHS', None)
+
+
+def partitions_ahead():
+    return getattr(settings, 'WORKFLOW_TRANSITION_LOG_PARTITIONS_AHEAD', DEFAULT_PARTITIONS_AHEAD)
+
+
+def add_months(month, count):
+    '''first day of the month count months after month'''
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_of(value):
+    return date(value.year, value.month, 1)
+
+
+def partition_name(month):
+    return '{0}_y{1:04d}m{2:02d}'.format(_table(), month.year, month.month)
+
+
+def _bound(day):
+    '''aware start of day, in the current time zone'''
+    value = datetime.combine(day, time.min)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value)
+    return value
+
+
+def is_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [_table()])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def partitions():
+    '''{first day of the month: partition name} of the monthly partitions'''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT c.relname FROM pg_inherits i '
+                       'JOIN pg_class c ON c.oid = i.inhrelid '
+                       'WHERE i.inhparent = %s::regclass', [_table()])
+        names = [row[0] for row in cursor.fetchall()]
+
+    result = {}
+    for name in names:
+        match = PARTITION_NAME.search(name)
+        if match:
+            result[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return result
+
+
+def _create_partition(cursor, month):
+    cursor.execute('CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} '
+                   'FOR VALUES FROM (%s) TO (%s)'.format(partition_name(month), _table()),
+                   [_bound(month), _bound(add_months(month, 1))])
+
+
+def ensure_partitions(ahead=None, today=None):
+    '''creates the partitions of the current and of the next
+    ahead months. Returns the names of the partitions created'''
+    ahead = partitions_ahead() if ahead is None else ahead
+    current = month_of(today or timezone.localtime(timezone.now()).date())
+    existing = partitions()
+    created = []
+    with connection.cursor() as cursor:
+        for i in range(ahead + 1):
+            month = add_months(current, i)
+            if month not in existing:
+                _create_partition(cursor, month)
+                created.append(partition_name(month))
+    return created
+
+
+def drop_expired(retention=None, today=None):
+    '''drops the monthly partitions entirely older than retention
+    months. Returns the names of the partitions dropped'''
+    retention = retention_months() if retention is None else retention
+    if not retention or not is_partitioned():
+        return []
+
+    cutoff = add_months(month_of(today or timezone.localtime(timezone.now()).date()), -retention)
+    dropped = []
+    with connection.cursor() as cursor:
+        for month, name in sorted(partitions().items()):
+            if add_months(month, 1) <= cutoff:
+                cursor.execute('DROP TABLE {0}'.format(name))
+                dropped.append(name)
+    return dropped
+
+
+@transaction.atomic
+def convert(ahead=None):
+    '''recreates the log table partitioned by month, moving its
+    rows. Locks the table while running; meant for a maintenance
+    window. Does nothing if the table is already partitioned.'''
+    from .models import State, StateController
+    if is_partitioned():
+        return False
+
+    table = _table()
+    legacy = '{0}_legacy'.format(table)
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE {0} RENAME TO {1}'.format(table, legacy))
+        cursor.execute('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) '
+                       'PARTITION BY RANGE (date_created)'.format(table, legacy))
+        cursor.execute('ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id'.format(table))
+        cursor.execute('CREATE TABLE {0}_default PARTITION OF {0} DEFAULT'.format(table))
+
+        cursor.execute('SELECT min(date_created) FROM {0}'.format(legacy))
+        oldest = cursor.fetchone()[0]
+        current = month_of(timezone.localtime(timezone.now()).date())
+        month = month_of(timezone.localtime(oldest).date()) if oldest else current
+        while month <= current:
+            _create_partition(cursor, month)
+            month = add_months(month, 1)
+
+        cursor.execute('INSERT INTO {0} SELECT * FROM {1}'.format(table, legacy))
+        cursor.execute('DROP TABLE {0}'.format(legacy))
+
+        # unique constraints of partitioned tables must hold the partition key
+        cursor.execute('ALTER TABLE {0} ADD PRIMARY KEY (id, date_created)'.format(table))
+        cursor.execute('CREATE INDEX {0}_controller_date_idx ON {0} '
+                       '(controller_id, date_created DESC)'.format(table))
+        for column, target in (('controller_id', StateController._meta.db_table),
+                               ('from_state_id', State._meta.db_table),
+                               ('to_state_id', State._meta.db_table)):
+            cursor.execute('ALTER TABLE {0} ADD FOREIGN KEY ({1}) REFERENCES {2} (id) '
+                           'DEFERRABLE INITIALLY DEFERRED'.format(table, column, target))
+
+    ensure_partitions(ahead)
+    return True
+
+
+@transaction.atomic
+def rollup(day):
+    '''(re)computes the DailyTransitionCount rows of day'''
+    from .models import DailyTransitionCount, StateController
+    DailyTransitionCount.objects.filter(day=day).delete()
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO {0} (day, machine_id, from_state_id, to_state_id, count) '
+                       'SELECT %s, c.machine_id, l.from_state_id, l.to_state_id, count(*) '
+                       'FROM {1} l JOIN {2} c ON c.id = l.controller_id '
+                       'WHERE l.date_created >= %s AND l.date_created < %s '
+                       'GROUP BY c.machine_id, l.from_state_id, l.to_state_id'
+                       .format(DailyTransitionCount._meta.db_table,
+                               _table(),
+                               StateController._meta.db_table),
+                       [day, _bound(day), _bound(day + timedelta(days=1))])
+        return cursor.rowcount
+
+
+def maintain(today=None):
+    '''rolls up yesterday and today, creates the coming partitions
+    and drops the expired ones, in this order'''
+    today = today or timezone.localtime(timezone.now()).date()
+    for day in (today - timedelta(days=1), today):
+        rollup(day)
+
+    created = ensure_partitions(today=today) if is_partitioned() else []
+    dropped = drop_expired(today=today)
+    if created or dropped:
+        logger.info('Transition log partitions created: %s, dropped: %s', created, dropped)
+    return created, dropped
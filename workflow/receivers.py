@@ -1,7 +1,16 @@
 # coding: utf-8
 import logging
+from django.db import connection
 from django.dispatch import receiver
+from django.utils import timezone
+from . import data_cache
+from . import data_storage
+from .choices import (DATA_POLICY_EMPTY,
+                      DATA_POLICY_MERGE,
+                      INNER_STATE_IDLE, )
+from .transition_log import get_transition_log_sink
 from .signals import (after_state_change,
+                      after_state_change_batch,
                       initialize_state_machine, )
 
 
@@ -22,6 +31,15 @@ def initialize_state_controller(sender, **kwargs):
         logger.error(u'Criação de StateController falhou.\n{0}'.format(ex.message))
         return
 
+    if hasattr(controlled, 'invalidate_controller'):
+        controlled.invalidate_controller()
+
+    if c.mirror(current_state=initial_state, inner_state=INNER_STATE_IDLE):
+        controlled.current_state = initial_state
+        controlled.inner_state = INNER_STATE_IDLE
+
+    after_state_change_batch.send_robust(StateController,
+                                         changes=[(c, None, initial_state)])
     after_state_change.send_robust(sender,
                                    controlled=controlled,
                                    controller=c,
@@ -29,30 +47,129 @@ def initialize_state_controller(sender, **kwargs):
                                    current=initial_state)
 
 
-@receiver(after_state_change)
+def log_state_changes(changes):
+    '''sends one TransitionLog for each (controller, previous,
+    current) in changes to the configured transition log sink'''
+    get_transition_log_sink().write(changes)
+
+
+# defaults whose top level key is missing from the previous data,
+# as a snapshot (p.data) or as a delta (b.data patched by p.patch)
+_MISSING_DEFAULTS = (
+    "(SELECT COALESCE(jsonb_object_agg(d.key, d.value), '{{}}'::jsonb) "
+    "FROM jsonb_each(s.data_defaults) d WHERE NOT ({0}))")
+_IN_SNAPSHOT = "p.data ? d.key"
+_IN_DELTA = ("(p.patch ? d.key AND p.patch -> d.key <> 'null'::jsonb) "
+             "OR (NOT p.patch ? d.key AND b.data ? d.key)")
+
+CARRY_FORWARD = """
+INSERT INTO {data} (date_created, date_updated, controller_id, state_id, data, base_id, patch, version)
+SELECT %s, %s, c.controller_id, c.state_id,
+       CASE WHEN s.data_policy = '{empty}' OR p.id IS NULL
+                 THEN CASE WHEN s.data_policy = '{merge}' THEN s.data_defaults ELSE '{{}}'::jsonb END
+            WHEN p.base_id IS NOT NULL OR %s THEN '{{}}'::jsonb
+            WHEN s.data_policy = '{merge}' THEN s.data_defaults || p.data
+            ELSE p.data END,
+       CASE WHEN s.data_policy = '{empty}' OR p.id IS NULL THEN NULL
+            WHEN p.base_id IS NOT NULL THEN p.base_id
+            WHEN %s THEN p.id END,
+       CASE WHEN s.data_policy = '{empty}' OR p.id IS NULL THEN NULL
+            WHEN p.base_id IS NOT NULL AND s.data_policy = '{merge}'
+                 THEN COALESCE(p.patch, '{{}}'::jsonb) || {missing_in_delta}
+            WHEN p.base_id IS NOT NULL THEN COALESCE(p.patch, '{{}}'::jsonb)
+            WHEN %s AND s.data_policy = '{merge}' THEN {missing_in_snapshot}
+            WHEN %s THEN '{{}}'::jsonb END,
+       0
+FROM (VALUES {values}) AS c (controller_id, previous_id, state_id)
+JOIN {state} s ON s.id = c.state_id
+LEFT JOIN LATERAL (SELECT d.id, d.data, d.base_id, d.patch
+                   FROM {data} d
+                   WHERE d.controller_id = c.controller_id
+                   AND d.state_id = c.previous_id
+                   ORDER BY d.date_created DESC, d.id DESC
+                   LIMIT 1) p ON TRUE
+LEFT JOIN {data} b ON b.id = p.base_id
+"""
+
+
+def create_state_data(changes):
+    '''creates the StateControllerData of the new state for each
+    (controller, previous, current) in changes, following the
+    data_policy of the new state, with a single INSERT ... SELECT:
+    the data is carried forward in the database, never in Python.
+
+    copy keeps the latest data of the previous state, empty starts
+    over and merge adds the data_defaults of the new state missing
+    from the previous data. In delta storage the new rows reference
+    the previous snapshot instead of copying it.'''
+    from .models import State, StateControllerData
+    if not changes:
+        return
+
+    delta = data_storage.storage_mode() == data_storage.STORAGE_DELTA
+    values = []
+    params = []
+    for controller, previous, current in changes:
+        values.append('(%s::integer, %s::integer, %s::integer)')
+        params.extend([controller.id, getattr(previous, 'id', None), current.id])
+
+    sql = CARRY_FORWARD.format(data=StateControllerData._meta.db_table,
+                               state=State._meta.db_table,
+                               empty=DATA_POLICY_EMPTY,
+                               merge=DATA_POLICY_MERGE,
+                               missing_in_delta=_MISSING_DEFAULTS.format(_IN_DELTA),
+                               missing_in_snapshot=_MISSING_DEFAULTS.format(_IN_SNAPSHOT),
+                               values=', '.join(values))
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [now, now, delta, delta, delta, delta] + params)
+
+    # the new state's entry is stale and the previous state's is no longer current
+    keys = set()
+    for controller, previous, current in changes:
+        keys.add((controller.id, current.id))
+        if previous is not None:
+            keys.add((controller.id, previous.id))
+    data_cache.invalidate(keys)
+
+
+@receiver(after_state_change_batch)
 def log_on_state_change(sender, **kwargs):
-    from .models import TransitionLog
-    controller = kwargs.get('controller')
-    from_state = kwargs.get('previous', None)
-    to_state = kwargs.get('current', None)
-    TransitionLog.objects.create(controller=controller,
-                                 from_state=from_state,
-                                 to_state=to_state)
+    log_state_changes(kwargs.get('changes', []))
 
 
-@receiver(after_state_change)
+@receiver(after_state_change_batch)
 def create_state_data_on_state_change(sender, **kwargs):
-    from .models import StateControllerData
-    controller = kwargs.get('controller')
-    state = kwargs.get('current')
-    previous = kwargs.get('previous')
-    try:
-        data = StateControllerData.objects.filter(controller=controller,
-                                                  state=previous).latest('date_created')
-        data = data.data
-        StateControllerData.objects.create(controller=controller,
-                                           state=state,
-                                           data=data)
-    except:
-        StateControllerData.objects.create(controller=controller,
-                                           state=state)
+    create_state_data(kwargs.get('changes', []))
+
+
+def bump_on_graph_change(sender, instance, **kwargs):
+    '''bumps the version of the FSMs whose graph instance belongs to'''
+    from .models import (AvailableTask,
+                         State,
+                         Transition,
+                         bump_machine_versions, )
+    if sender is Transition:
+        bump_machine_versions(pk=instance.machine_id)
+    elif sender is State:
+        # the data schema of the transitions entering it
+        bump_machine_versions(transitions__to_state__id=instance.pk)
+    elif sender is AvailableTask:
+        bump_machine_versions(transitions__tasks__id=instance.pk)
+    else:
+        bump_machine_versions(transitions__id=instance.transition_id)
+
+
+def bump_on_permissions_change(sender, instance, action, reverse, pk_set, **kwargs):
+    '''bumps the version of the FSMs whose transitions
+    had permissions added or removed'''
+    from .models import bump_machine_versions
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        bump_machine_versions(pk=instance.machine_id)
+    elif action == 'pre_clear':
+        bump_machine_versions(transitions__permissions__id=instance.pk)
+    elif pk_set:
+        bump_machine_versions(transitions__id__in=pk_set)
@@ -0,0 +1,106 @@
+# coding: utf-8
+import inspect
+import logging
+import importlib
+import threading
+from django.apps import apps
+
+
+logger = logging.getLogger(__name__)
+
+
+def task_path(cls):
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+
+class TaskRegistry(object):
+
+    '''Process wide registry of task classes.
+
+    Classes are indexed by their dotted path (AvailableTask.klass) and by
+    their celery task name. The registry is populated by scanning the
+    tasks module of every installed app once, at WorkflowApp.ready(), and
+    paths missing from the scan are imported and cached on first use.'''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_klass = {}
+        self._by_name = {}
+        self._discovered = None
+
+    def register(self, cls, klass=None):
+        with self._lock:
+            self._by_klass[klass or task_path(cls)] = cls
+            if getattr(cls, 'name', None):
+                self._by_name[cls.name] = cls
+        return cls
+
+    def scan(self):
+        '''imports the tasks module of every installed app and
+        returns {dotted path: class} of all BaseTask subclasses'''
+        from .tasks import BaseTask
+        discovered = {}
+        for app_config in apps.get_app_configs():
+            try:
+                module = importlib.import_module('{0}.tasks'.format(app_config.name))
+            except ImportError:
+                continue
+            members = inspect.getmembers(module,
+                                         predicate=lambda x: inspect.isclass(x) and issubclass(x, BaseTask))
+            for member_name, cls in members:
+                # {'foo.bar.Task': 'class <foo.bar.Task>'}
+                discovered['{0}.{1}'.format(cls.__module__, member_name)] = cls
+        return discovered
+
+    def populate(self):
+        '''scans the installed apps, unless already done'''
+        with self._lock:
+            if self._discovered is None:
+                self._discovered = self.scan()
+                for klass, cls in self._discovered.items():
+                    self.register(cls, klass)
+            return self._discovered
+
+    def discovered(self):
+        '''{dotted path: class} of the tasks found in the installed apps'''
+        return dict(self.populate())
+
+    def get(self, klass):
+        '''task class for a dotted path, importing it on a miss'''
+        try:
+            return self._by_klass[klass]
+        except KeyError:
+            pass
+
+        parts = klass.split('.')
+        try:
+            module = importlib.import_module('.'.join(parts[:-1]))
+            cls = getattr(module, parts[-1])
+        except Exception:
+            raise ValueError('Cannot load task {0}'.format(klass))
+
+        return self.register(cls, klass)
+
+    def get_by_name(self, name):
+        '''task class for a celery task name'''
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise ValueError('Unknown task {0}'.format(name))
+
+    def invalidate(self, klass=None):
+        '''forgets one dotted path or, by default, everything;
+        the next populate() scans the installed apps again'''
+        with self._lock:
+            if klass is None:
+                self._by_klass.clear()
+                self._by_name.clear()
+                self._discovered = None
+                return
+
+            cls = self._by_klass.pop(klass, None)
+            if cls is not None and self._by_name.get(getattr(cls, 'name', None)) is cls:
+                del self._by_name[cls.name]
+
+
+registry = TaskRegistry()
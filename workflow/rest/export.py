@@ -0,0 +1,56 @@
+# coding: utf-8
+'''Streaming exports of querysets as CSV or NDJSON.
+
+Rows are read with ``iterator()``, a server-side cursor on Postgres,
+and written as they are read, so the memory used does not depend on the
+number of rows exported.
+'''
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import six
+
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+
+CONTENT_TYPES = {FORMAT_CSV: 'text/csv',
+                 FORMAT_NDJSON: 'application/x-ndjson'}
+
+
+class Echo(object):
+
+    '''file-like object returning what is written to it'''
+
+    def write(self, value):
+        return value
+
+
+def _text(value):
+    if value is None:
+        return ''
+    value = value.isoformat() if hasattr(value, 'isoformat') else six.text_type(value)
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def csv_lines(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_text(v) for v in row])
+
+
+def ndjson_lines(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def stream(queryset, fields, output=FORMAT_CSV, filename='export'):
+    '''a StreamingHttpResponse with fields (as understood by
+    values_list) of every row of queryset'''
+    rows = queryset.values_list(*fields).iterator()
+    lines = ndjson_lines(fields, rows) if output == FORMAT_NDJSON else csv_lines(fields, rows)
+    response = StreamingHttpResponse(lines, content_type=CONTENT_TYPES.get(output, CONTENT_TYPES[FORMAT_CSV]))
+    response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(filename, output)
+    return response
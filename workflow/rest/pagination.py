@@ -0,0 +1,13 @@
+# coding: utf-8
+from rest_framework.pagination import CursorPagination
+
+
+class TransitionLogCursorPagination(CursorPagination):
+
+    '''keyset pagination over (date_created, id): every page costs the
+    same, however deep, and rows logged meanwhile do not shift pages'''
+
+    ordering = ('-date_created', '-id', )
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -0,0 +1,241 @@
+# coding: utf-8
+'''Compiled and incremental JSON schema validation of state data.
+
+Schemas are registered on the target State (``data_schema``) or, to
+override it, on the Transition. ``compile_schema`` builds the validator
+of a schema once per process and keeps it under the schema's hash.
+
+The schema of a transition is read from the compiled graph of its
+machine (see ``graph``), along with its hash.
+
+``validate_data`` remembers, per controller and schema, the data version
+it last found valid and a hash of each of its top level values that some
+sub-schema constrains. When the version did not change the data is not
+even read; otherwise only the constrained keys whose value changed are
+validated against their sub-schemas, plus the object level keywords
+(``required``, ``minProperties``...) on the whole key set. Hashing still
+serializes every constrained value once per new version, which is far
+cheaper than validating it but proportional to its size. Schemas whose
+root combines sub-schemas (``$ref``, ``allOf``, ``dependencies``...) are
+always validated in full and their versions hash nothing.
+'''
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from jsonschema.validators import validator_for
+
+
+DEFAULT_SIZE = 1024
+
+# root keywords that may constrain any key, or the keys together
+COMPOSITE = ('$ref',
+             'allOf',
+             'anyOf',
+             'oneOf',
+             'not',
+             'if',
+             'then',
+             'else',
+             'dependencies',
+             'dependentSchemas',
+             'unevaluatedProperties', )
+
+# root keywords that only constrain the value of each key
+PER_KEY = ('properties',
+           'patternProperties',
+           'additionalProperties', )
+
+
+def schema_hash(schema):
+    return hashlib.sha1(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def value_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def error_of(error):
+    '''the structured form of a jsonschema ValidationError'''
+    return {'path': list(error.path),
+            'message': error.message,
+            'validator': error.validator,
+            'schema_path': list(error.schema_path)}
+
+
+class CompiledSchema(object):
+
+    '''A schema with its validator and the parts used to validate a
+    few keys of an object without walking the others.'''
+
+    def __init__(self, schema, digest=None):
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        self.schema = schema
+        self.hash = digest or schema_hash(schema)
+        self.validator = cls(schema)
+        self.incremental = isinstance(schema, dict) and not any(k in schema for k in COMPOSITE)
+        if self.incremental:
+            self.shallow = {k: v for k, v in schema.items() if k not in PER_KEY}
+            self.properties = schema.get('properties', {})
+            self.patterns = [(re.compile(p), s) for p, s in schema.get('patternProperties', {}).items()]
+            self.additional = schema.get('additionalProperties', True)
+            self._constrained = {}
+
+    def errors(self, data):
+        '''every violation of data'''
+        return [error_of(e) for e in self.validator.iter_errors(data)]
+
+    def subschemas(self, key):
+        '''the sub-schemas that apply to the value of key'''
+        matched = []
+        if key in self.properties:
+            matched.append(self.properties[key])
+        matched.extend(s for regex, s in self.patterns if regex.search(key))
+        if not matched:
+            matched.append(self.additional)
+        return matched
+
+    def constrains(self, key):
+        '''if some sub-schema may reject the value of key'''
+        constrained = self._constrained.get(key)
+        if constrained is None:
+            constrained = any(s is not True and s != {} for s in self.subschemas(key))
+            self._constrained[key] = constrained
+        return constrained
+
+    def errors_for(self, data, keys):
+        '''the violations of data found validating the values of keys
+        only. data is expected to be valid for the other keys'''
+        if not self.incremental or not isinstance(data, dict):
+            return self.errors(data)
+
+        errors = [error_of(e) for e in self.validator.descend(data, self.shallow)]
+        for key in keys:
+            for schema in self.subschemas(key):
+                if schema is True or schema == {}:
+                    continue
+                if schema is False:
+                    errors.append({'path': [key],
+                                   'message': u'Additional properties are not allowed '
+                                              u'({0!r} was unexpected)'.format(key),
+                                   'validator': 'additionalProperties',
+                                   'schema_path': ['additionalProperties']})
+                    continue
+                errors.extend(error_of(e) for e in self.validator.descend(data[key], schema, path=key))
+        return errors
+
+
+_compiled = {}
+_lock = threading.Lock()
+
+
+def compile_schema(schema, digest=None):
+    '''the CompiledSchema of schema, compiled once per process.
+    digest, when known, saves hashing the schema again.
+    Raises jsonschema.SchemaError if the schema is invalid'''
+    if isinstance(schema, CompiledSchema):
+        return schema
+
+    digest = digest or schema_hash(schema)
+    compiled = _compiled.get(digest)
+    if compiled is None:
+        compiled = CompiledSchema(schema, digest)
+        with _lock:
+            compiled = _compiled.setdefault(digest, compiled)
+    return compiled
+
+
+class ValidatedVersions(object):
+
+    '''LRU of the data each controller last passed a schema with:
+    (controller id, schema hash) -> (data id, version, key hashes)'''
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or getattr(settings, 'WORKFLOW_SCHEMA_CACHE_SIZE', DEFAULT_SIZE)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, controller_id, digest):
+        key = (controller_id, digest)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        return entry
+
+    def set(self, controller_id, digest, data_id, version, hashes):
+        key = (controller_id, digest)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (data_id, version, hashes)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+validated = ValidatedVersions()
+
+
+def reset():
+    '''forgets the compiled schemas and the validated versions'''
+    with _lock:
+        _compiled.clear()
+    validated.clear()
+
+
+def validate(schema, data, controller_id=None, data_id=None, version=None):
+    '''the list of violations of data, each a dict with its path,
+    message, validator and schema_path. With controller_id only the
+    keys changed since its last valid data are validated'''
+    compiled = compile_schema(schema)
+    previous = validated.get(controller_id, compiled.hash) if controller_id else None
+    if previous is not None and previous[:2] == (data_id, version):
+        return []
+
+    hashes = None
+    if compiled.incremental and isinstance(data, dict):
+        hashes = {k: value_hash(v) for k, v in data.items() if compiled.constrains(k)}
+
+    if previous is not None and previous[2] is not None and hashes is not None:
+        old = previous[2]
+        errors = compiled.errors_for(data, [k for k, h in hashes.items() if old.get(k) != h])
+    else:
+        errors = compiled.errors(data)
+
+    if controller_id and not errors:
+        validated.set(controller_id, compiled.hash, data_id, version, hashes)
+    return errors
+
+
+def schema_for(controller, next):
+    '''the CompiledSchema of the transition of controller to next,
+    falling back to the one of the next state, or None'''
+    transition = controller.machine.graph.transition(controller.current_state_id, next.id)
+    if transition is None:
+        return compile_schema(next.data_schema) if next.data_schema else None
+
+    if transition.data_schema is None:
+        return None
+    return compile_schema(transition.data_schema, transition.schema_hash)
+
+
+def validate_data(controller, schema):
+    '''validates the current data of controller against schema,
+    reading it only if it changed since it was last found valid'''
+    compiled = compile_schema(schema)
+    current = controller.current_data_version()
+    if current is None:
+        return compiled.errors({})
+
+    previous = validated.get(controller.id, compiled.hash)
+    if previous is not None and previous[:2] == tuple(current):
+        return []
+
+    data = controller.current_data
+    return validate(compiled, data.data, controller.id, data.pk, data.version)
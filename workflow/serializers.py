@@ -3,12 +3,17 @@ from django.db.models import Q
 from django.db import transaction
 from rest_framework import serializers
 from rest_framework.reverse import reverse
+from jsonschema import SchemaError
 from .fsm import GoFSMUpdater
+from .schemas import compile_schema
 from .models import (StateMachine,
                      State,
                      Action,
                      Transition,
                      TransitionLog,
+                     DailyTransitionCount,
+                     TransitionExecution,
+                     TaskExecution,
                      AvailableTask,
                      TransitionTask,
                      StateController)
@@ -55,6 +60,9 @@ class StateMachineSerializer(LinkSerializer):
     class Meta:
         model = StateMachine
         fields = '__all__'
+        # bumped on every graph change; a stale value written back
+        # would match graphs other processes already compiled
+        read_only_fields = ('version', )
 
 
 class ActionSerializer(LinkSerializer):
@@ -70,6 +78,16 @@ class ActionSerializer(LinkSerializer):
         fields = ('id', 'name', )
 
 
+def validate_schema(value):
+    '''rejects data schemas that are not valid JSON schemas'''
+    if value:
+        try:
+            compile_schema(value)
+        except SchemaError as ex:
+            raise serializers.ValidationError(ex.message)
+    return value
+
+
 class StateSerializer(LinkSerializer):
 
     text_actions = serializers.SerializerMethodField(read_only=True)
@@ -96,6 +114,9 @@ class StateSerializer(LinkSerializer):
 
         return instance
 
+    def validate_data_schema(self, value):
+        return validate_schema(value)
+
     def get_text_actions(self, obj):
 
         action_serializer = ActionSerializer(obj.actions.all(), many=True)
@@ -115,7 +136,10 @@ class StateSerializer(LinkSerializer):
                   'code',
                   'description',
                   'actions',
-                  'text_actions')
+                  'text_actions',
+                  'data_policy',
+                  'data_defaults',
+                  'data_schema')
 
 
 class TransitionSerializer(LinkSerializer):
@@ -124,6 +148,9 @@ class TransitionSerializer(LinkSerializer):
 
     to_state = StateSerializer()
 
+    def validate_data_schema(self, value):
+        return validate_schema(value)
+
     def get_links(self, obj):
         return {
             'self': reverse('transition-detail',
@@ -191,6 +218,59 @@ class TransitionLogSerializer(LinkSerializer):
         fields = '__all__'
 
 
+class TaskExecutionSerializer(LinkSerializer):
+
+    def get_links(self, obj):
+        request = self.context['request']
+        return {
+            'self': reverse('taskexecution-detail',
+                            kwargs={'pk': obj.pk},
+                            request=request),
+            'execution': reverse('transitionexecution-detail',
+                                 kwargs={'pk': obj.execution_id},
+                                 request=request)
+        }
+
+    class Meta:
+
+        model = TaskExecution
+        fields = '__all__'
+
+
+class DailyTransitionCountSerializer(serializers.ModelSerializer):
+
+    class Meta:
+
+        model = DailyTransitionCount
+        fields = '__all__'
+
+
+class ExecutedTaskSerializer(serializers.ModelSerializer):
+
+    class Meta:
+
+        model = TaskExecution
+        exclude = ('execution', )
+
+
+class TransitionExecutionSerializer(LinkSerializer):
+
+    tasks = ExecutedTaskSerializer(many=True, read_only=True)
+
+    def get_links(self, obj):
+        request = self.context['request']
+        return {
+            'self': reverse('transitionexecution-detail',
+                            kwargs={'pk': obj.pk},
+                            request=request)
+        }
+
+    class Meta:
+
+        model = TransitionExecution
+        fields = '__all__'
+
+
 class StateControllerSerializerMixIn(LinkSerializer):
 
     def get_links(self, obj):
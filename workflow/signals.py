@@ -4,3 +4,9 @@ import django.dispatch
 initialize_state_machine = django.dispatch.Signal(providing_args=['controlled', 'state_machine', 'initial_state'])
 before_state_change = django.dispatch.Signal(providing_args=['controlled', 'controller', 'current', 'next'])
 after_state_change = django.dispatch.Signal(providing_args=['controlled', 'controller', 'previous', 'current'])
+# changes: list of (controller, current, next) before and of
+# (controller, previous, current) after the state changes
+before_state_change_batch = django.dispatch.Signal(providing_args=['changes'])
+after_state_change_batch = django.dispatch.Signal(providing_args=['changes'])
+controllers_reaped = django.dispatch.Signal(providing_args=['controllers'])
+controllers_initialized = django.dispatch.Signal(providing_args=['controllers', 'state_machine', 'initial_state'])
@@ -1,17 +1,42 @@
 # coding: utf-8
 import inspect
 import logging
-import importlib
+from collections import namedtuple
 from django.conf import settings
+from django.db import connection
 from celery import group, chain
 from celery import current_app
-from .choices import INNER_STATE_RUNNING
-from .models import AvailableTask
-from .tasks import BaseTask, ChangeStateTask
+from .choices import (EXECUTION_CELERY,
+                      INNER_STATE_IDLE,
+                      INNER_STATE_RUNNING, )
+from .executions import start_execution
+from .executors import get_executor
+from .instrumentation import (timer,
+                              new_transition_id,
+                              PHASE_DISPATCH,
+                              PHASE_RUNNER,
+                              PHASE_VALIDATION, )
+from .models import (AvailableTask,
+                     StateMachine,
+                     StateController,
+                     lease_expiry,
+                     mirror_controllers_state, )
+from .tasks import (BaseTask,
+                    BulkChangeStateTask,
+                    ChangeStateTask,
+                    PipelineTask, )
+from .registry import registry as default_registry
+from .signals import (before_state_change,
+                      before_state_change_batch, )
 
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BULK_CHUNK_SIZE = 500
+
+PIPELINE_CHAIN = 'chain'
+PIPELINE_INLINE = 'inline'
+
 
 def is_subclass(o):
     return inspect.isclass(o) and issubclass(o, BaseTask)
@@ -20,17 +45,7 @@ def is_subclass(o):
 class AvailableTaskLoader(object):
 
     def _get_subclasses(self):
-        task_dict = {}
-        for app in settings.INSTALLED_APPS:
-            try:
-                mod = __import__('%s.%s' % (app, 'tasks'))
-            except:
-                continue
-            members = inspect.getmembers(mod.tasks, predicate=lambda x: inspect.isclass(x) and issubclass(x, BaseTask))
-            for m in members:
-                # {'foo.bar.Task': 'class <foo.bar.Task>'}
-                task_dict['{0}.{1}'.format(m[1].__module__, m[0])] = m[1]
-        return task_dict
+        return default_registry.discovered()
 
     def load(self):
         subcls = self._get_subclasses()
@@ -53,11 +68,13 @@ class AvailableTaskLoader(object):
                                full_name,
                                ex.message)
 
-        self._prune()
+        self._prune(subcls)
 
-    def _prune(self):
+    def _prune(self, subcls=None):
         '''removes all the unecessary tasks'''
-        tasks = set([member for member in self._get_subclasses().keys()])
+        if subcls is None:
+            subcls = self._get_subclasses()
+        tasks = set(subcls.keys())
         existing = set(AvailableTask.objects.all().values_list('klass', flat=True))
         stale = existing - tasks
         for s in stale:
@@ -68,23 +85,23 @@ class AvailableTaskLoader(object):
 
 class TaskLoader(object):
 
+    '''Resolves task classes through the process wide registry.'''
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else default_registry
+
     def load_task(self, task):
 
-        parts = task.split('.')
+        return self.registry.get(task)
+
+    def load_task_by_name(self, name):
 
-        try:
-            module_name = '.'.join(parts[:-1])
-            klass_name = parts[-1]
-            module = importlib.import_module(module_name)
-            klass = getattr(module, klass_name)
-            return klass
-        except:
-            raise ValueError('Cannot load task {0}'.format(task))
+        return self.registry.get_by_name(name)
 
 
 class TaskRunner(object):
 
-    def __init__(self, controller, next, task_loader=None):
+    def __init__(self, controller, next, task_loader=None, transition_id=None):
 
         '''initializes a task'''
 
@@ -95,54 +112,228 @@ class TaskRunner(object):
             raise ValueError('Next state cannot be null')
 
         self.task_loader = task_loader if task_loader is not None else TaskLoader()
-
-        # supports passing controlled or controller objects
-        if hasattr(controller, 'controller'):
-            self.controller = controller.controller
-            self.controlled = controller
-        else:
-            self.controller = controller
-            self.controlled = controller.content_object
-
-        self.next = next
-        self.transition = self.get_transition()
-        self.initialize_tasks()
+        # shared by the instrumentation events of every phase
+        self.transition_id = transition_id or new_transition_id()
+
+        with timer(PHASE_RUNNER, self.transition_id):
+            # supports passing controlled or controller objects
+            if hasattr(controller, 'controller'):
+                self.controller = controller.controller
+                self.controlled = controller
+            else:
+                self.controller = controller
+                self.controlled = controller.content_object
+
+            self.next = next
+            self.transition = self.get_transition()
+            self.initialize_tasks()
 
     def get_transition(self):
-        transitions = self.controller.machine.transitions.filter(from_state=self.controller.current_state,
-                                                                 to_state=self.next)
-        if transitions.count() != 1:
+        graph = self.controller.machine.graph
+        transition = graph.transition(self.controller.current_state_id,
+                                      self.next.id)
+        if transition is None:
             raise ValueError('invalid transition for this taskrunner')
 
-        return transitions.first()
+        return transition
 
     def initialize_tasks(self):
 
         '''loads and initializes all the tasks'''
-        self.tasks = [self.task_loader.load_task(t.klass)()
-                      for t in self.transition.tasks.all()]
+        self.tasks = [self.task_loader.load_task(klass)()
+                      for klass in self.transition.tasks]
         self.tasks.append(ChangeStateTask())
 
         self.validation_tasks = [self.task_loader.load_task(t.validation_class)()
                                  for t in self.tasks if t.validation_class and
                                  t.validation_class != '']
 
-    def run(self):
+    def is_inline(self):
+        '''if the transition can run as a single PipelineTask'''
+        mode = getattr(settings, 'WORKFLOW_PIPELINE_MODE', PIPELINE_CHAIN)
+        if mode != PIPELINE_INLINE:
+            return False
+
+        return all(getattr(t, 'inline', True) for t in self.tasks + self.validation_tasks)
+
+    def get_execution(self):
+        '''the execution strategy of the transition: the transition's,
+        then the machine's and, for transitions made only of
+        lightweight tasks, WORKFLOW_LIGHTWEIGHT_EXECUTION'''
+        if self.transition.execution:
+            return self.transition.execution
+
+        machine = self.controller.machine
+        if machine.execution:
+            return machine.execution
 
-        '''executes the tasks'''
+        if all(getattr(t, 'lightweight', False) for t in self.tasks + self.validation_tasks):
+            return getattr(settings, 'WORKFLOW_LIGHTWEIGHT_EXECUTION', EXECUTION_CELERY)
+
+        return EXECUTION_CELERY
+
+    def build(self, execution_id=None):
+
+        '''the celery signature of the transition. execution_id is
+        the TransitionExecution the tasks of a chain report to'''
         cid = self.controller.id
         nsi = self.next.id
+        tid = self.transition_id
 
-        validation = group([v.s(cid=cid, nsi=nsi)
+        if self.is_inline():
+            return PipelineTask().s(cid=cid,
+                                    nsi=nsi,
+                                    tid=tid,
+                                    tasks=list(self.transition.tasks))
+
+        validation = group([v.s(cid=cid, nsi=nsi, tid=tid, eid=execution_id, phase=PHASE_VALIDATION)
                             for v in self.validation_tasks])
 
-        tasks = chain([t.s(cid=cid, nsi=nsi)
+        tasks = chain([t.s(cid=cid, nsi=nsi, tid=tid, eid=execution_id)
                        for t in self.tasks])
         if len(validation.tasks) > 0:
             job = chain(validation, tasks)
         else:
             job = tasks
+        return job
+
+    def send_before_state_change(self):
+        sender = self.controller.__class__
+        current = self.controller.current_state
+        before_state_change_batch.send_robust(sender=sender,
+                                              changes=[(self.controller, current, self.next)])
+        before_state_change.send_robust(sender=sender,
+                                        controlled=self.controlled,
+                                        controller=self.controller,
+                                        current=current,
+                                        next=self.next)
+
+    def run(self):
+
+        '''executes the tasks. Returns False, without dispatching
+        anything or sending before_state_change, when another request
+        already claimed the controller'''
+        with timer(PHASE_DISPATCH, self.transition_id):
+            if not self.controller.claim(self.transition_id):
+                return False
+
+            self.send_before_state_change()
+
+            execution_id = None
+            if not self.is_inline():
+                execution_id = start_execution(self.controller,
+                                               self.next,
+                                               trace_id=self.transition_id)
+            job = self.build(execution_id)
+            self.controller.mirror(inner_state=INNER_STATE_RUNNING)
+            return get_executor(self.get_execution()).execute(job)
+
+
+BulkChangeResult = namedtuple('BulkChangeResult', ['result', 'accepted', 'rejected'])
+
+
+class BulkTaskRunner(object):
+
+    '''Changes the state of many controllers at once.
+
+    All the controllers are validated with one query, claimed with a
+    single UPDATE and their transitions are dispatched as a group of
+    BulkChangeStateTask, each handling a chunk of controllers. The
+    tasks run in the chunk's worker, so transitions holding a task
+    with inline = False, which must run in its own celery message,
+    are rejected.'''
+
+    def __init__(self, controllers, next, user=None, chunk_size=None, transition_id=None):
+
+        if not next:
+            raise ValueError('Next state cannot be null')
+
+        self.transition_id = transition_id or new_transition_id()
+        self.controllers = controllers
+        self.next = next
+        self.user = user
+        self.objects = {}
+        self.task_loader = TaskLoader()
+        self._bulk = {}
+        self.chunk_size = chunk_size or getattr(settings,
+                                                'WORKFLOW_BULK_CHUNK_SIZE',
+                                                DEFAULT_BULK_CHUNK_SIZE)
+
+    def is_bulk(self, transition):
+        '''if all the tasks of transition can run in a chunk's worker'''
+        if transition.id not in self._bulk:
+            try:
+                tasks = [self.task_loader.load_task(klass) for klass in transition.tasks]
+                tasks += [self.task_loader.load_task(t.validation_class)
+                          for t in tasks if t.validation_class]
+            except ValueError as ex:
+                logger.warning('Transition %s cannot be loaded. %s', transition.id, ex)
+                tasks = None
+            self._bulk[transition.id] = tasks is not None and \
+                all(getattr(t, 'inline', True) for t in tasks)
+        return self._bulk[transition.id]
+
+    def validate(self):
+        '''splits the controllers in accepted controller ids and
+        rejected object ids, using the compiled graphs'''
+        rows = list(self.controllers.values_list('id',
+                                                 'content_type_id',
+                                                 'object_id',
+                                                 'machine_id',
+                                                 'current_state_id',
+                                                 'inner_state'))
+        machines = StateMachine.objects.in_bulk(set(r[3] for r in rows))
+
+        accepted = []
+        rejected = []
+        for cid, content_type_id, object_id, machine_id, current_state_id, inner_state in rows:
+            transition = machines[machine_id].graph.transition(current_state_id,
+                                                               self.next.id)
+            if inner_state != INNER_STATE_IDLE or transition is None or \
+                    (self.user is not None and not transition.is_available(self.user)) or \
+                    not self.is_bulk(transition):
+                rejected.append(object_id)
+            else:
+                accepted.append(cid)
+                self.objects[cid] = (content_type_id, object_id)
+        return accepted, rejected
+
+    def claim(self, controller_ids):
+        '''flips the controllers to running for this run with a
+        single UPDATE, returning the ids that were still idle'''
+        if not controller_ids:
+            return []
+
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {0} SET inner_state = %s, task_id = %s, lease_expires_at = %s '
+                           'WHERE id = ANY(%s) AND inner_state = %s '
+                           'RETURNING id'.format(StateController._meta.db_table),
+                           [INNER_STATE_RUNNING, self.transition_id, lease_expiry(),
+                            list(controller_ids), INNER_STATE_IDLE])
+            return [row[0] for row in cursor.fetchall()]
+
+    def chunks(self, controller_ids):
+        for i in range(0, len(controller_ids), self.chunk_size):
+            yield controller_ids[i:i + self.chunk_size]
+
+    def run(self):
 
-        self.controller.inner_state = INNER_STATE_RUNNING
-        self.controller.save()
-        return job.delay()
+        '''validates, claims and dispatches the state changes'''
+        with timer(PHASE_RUNNER, self.transition_id):
+            accepted, rejected = self.validate()
+
+        with timer(PHASE_DISPATCH, self.transition_id, controllers=len(accepted)):
+            claimed = self.claim(accepted)
+            if len(claimed) != len(accepted):
+                lost = set(accepted) - set(claimed)
+                rejected.extend(self.objects[cid][1] for cid in lost)
+            mirror_controllers_state([self.objects[cid] for cid in claimed],
+                                     inner_state=INNER_STATE_RUNNING)
+
+            if not claimed:
+                return BulkChangeResult(None, 0, rejected)
+
+            job = group([BulkChangeStateTask().s(cids=chunk, nsi=self.next.id, tid=self.transition_id)
+                         for chunk in self.chunks(sorted(claimed))])
+            result = get_executor(EXECUTION_CELERY).execute(job)
+            return BulkChangeResult(result, len(claimed), rejected)
@@ -1,11 +1,28 @@
 # coding: utf-8
 from __future__ import absolute_import
 import logging
+from django.db import transaction
 from .models import (State,
-                     StateController, )
+                     StateController,
+                     mirror_controllers_state, )
 from celery import current_app
-from .choices import INNER_STATE_IDLE
-from .signals import after_state_change
+from .choices import (INNER_STATE_IDLE,
+                      INNER_STATE_RUNNING, )
+from .exceptions import (LeaseLost,
+                         SchemaValidationError, )
+from .executions import (ExecutionRecorder,
+                         record_task,
+                         save_executions, )
+from .instrumentation import (timer,
+                              PHASE_COMMIT,
+                              PHASE_TASK,
+                              PHASE_VALIDATION, )
+from .registry import registry
+from .schemas import (schema_for,
+                      validate_data, )
+from .signals import (after_state_change,
+                      after_state_change_batch,
+                      before_state_change_batch, )
 logger = logging.getLogger(__name__)
 
 
@@ -15,21 +32,51 @@ class BaseTask(current_app.Task):
     validation_class = ''
     name = 'Base Task'
     description = ''
+    # tasks that must run in their own celery message (e.g. on
+    # another queue) are never merged into an inline pipeline
+    inline = True
+    # lightweight tasks may run synchronously, in the caller's process
+    lightweight = False
+    controller = None
+    # shared by the tasks of an inline pipeline
+    context = None
+    # instrumentation phase, overridden per signature with phase=
+    phase = PHASE_TASK
+    transition_id = None
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        logger.error(exc.message)
-        if self.controller:
+        logger.error(exc)
+        # a controller reaped or claimed again belongs to another run
+        if self.controller and self.controller.owned(self.transition_id) \
+                                              .update(inner_state=INNER_STATE_IDLE,
+                                                      task_id=None,
+                                                      lease_expires_at=None):
             self.controller.inner_state = INNER_STATE_IDLE
             self.controller.task_id = None
-            self.controller.save()
+            self.controller.lease_expires_at = None
+            self.controller.mirror(inner_state=INNER_STATE_IDLE)
 
     def run(self, *args, **kwargs):
         controller_id = kwargs.pop('cid', None)
         next_id = kwargs.pop('nsi', None)
-        self._load_data(controller_id, next_id)
-        self.controller.task_id = self.request.get('id')
-        self.controller.save()
-        return self._run()
+        execution_id = kwargs.pop('eid', None)
+        self.transition_id = kwargs.pop('tid', None)
+        phase = kwargs.pop('phase', None) or self.phase
+        with timer(phase, self.transition_id, task=self.name):
+            self._load_data(controller_id, next_id)
+            self.context = {}
+            with record_task(execution_id, self, phase, self.request.get('id')):
+                self.heartbeat()
+                return self._run()
+
+    def heartbeat(self):
+        '''renews the lease of the controller. Tasks whose _run() may
+        take longer than WORKFLOW_LEASE_SECONDS should call it every
+        now and then. Raises LeaseLost if the controller was reaped
+        or claimed by another run, which must stop this one.'''
+        if not self.controller.heartbeat(self.transition_id):
+            raise LeaseLost('Controller {0} is no longer running for {1}.'.format(self.controller.id,
+                                                                                 self.transition_id))
 
     def _load_data(self, controller_id, next_id):
 
@@ -44,14 +91,32 @@ class BaseTask(current_app.Task):
 
 class ValidateSchemaTask(BaseTask):
 
+    '''Validates the current data against the JSON schema of the
+    transition, or of the next state, unless ``schema`` is set.
+
+    Schemas are compiled once per process and only the keys changed
+    since the data last passed are validated again. Raises
+    SchemaValidationError with the list of violations.'''
+
+    name = 'Validate Schema'
+    description = 'Validates the data against the JSON schema of the next state.'
     schema = None
 
+    def get_schema(self):
+        return self.schema or schema_for(self.controller, self.next)
+
     def _run(self):
 
-        if self.schema:
-            errors = self.schema.validate(self.controller.current_data.data)
-            if len(errors) > 0:
-                raise ValueError('Schema Invalid')
+        schema = self.get_schema()
+        if not schema:
+            return True
+
+        if hasattr(schema, 'validate'):
+            errors = schema.validate(self.controller.current_data.data)
+        else:
+            errors = validate_data(self.controller, schema)
+        if len(errors) > 0:
+            raise SchemaValidationError(errors)
 
         return True
 
@@ -61,15 +126,262 @@ class ChangeStateTask(BaseTask):
     name = 'Change State'
     description = 'Changes the current state to the next.'
     public = False
+    lightweight = True
+    phase = PHASE_COMMIT
 
     def _run(self):
-        self.controller.inner_state = INNER_STATE_IDLE
-        self.controller.current_state = self.next
-        self.controller.task_id = None
-        self.controller.save()
-        after_state_change.send_robust(sender=self.controller.content_object.__class__,
-                                       controlled=self.controller.content_object,
+        with transaction.atomic():
+            # only the run that claimed the controller may commit it
+            changed = self.controller.owned(self.transition_id) \
+                                     .update(current_state=self.next,
+                                             inner_state=INNER_STATE_IDLE,
+                                             task_id=None,
+                                             lease_expires_at=None)
+            if not changed:
+                raise LeaseLost('Controller {0} is no longer running for {1}.'.format(self.controller.id,
+                                                                                     self.transition_id))
+            self.controller.inner_state = INNER_STATE_IDLE
+            self.controller.current_state = self.next
+            self.controller.task_id = None
+            self.controller.lease_expires_at = None
+            self.controller.mirror(current_state=self.next,
+                                   inner_state=INNER_STATE_IDLE)
+        controlled = self.controller.content_object
+        if hasattr(controlled, 'invalidate_controller'):
+            controlled.invalidate_controller()
+        after_state_change_batch.send_robust(sender=StateController,
+                                             changes=[(self.controller, self.previous, self.next)])
+        after_state_change.send_robust(sender=controlled.__class__,
+                                       controlled=controlled,
                                        controller=self.controller,
                                        previous=self.previous,
                                        current=self.next)
         return True
+
+
+class PipelineTask(BaseTask):
+
+    '''Runs all the tasks of a transition in a single celery message.
+
+    The controller and the next state are loaded once and handed to
+    every task, along with a context dict they share; validations run
+    first and the state change is committed at the end.'''
+
+    name = 'Transition Pipeline'
+    description = 'Runs the tasks of a transition in sequence.'
+    public = False
+
+    def run(self, *args, **kwargs):
+        tasks = kwargs.pop('tasks', list())
+        controller_id = kwargs.pop('cid', None)
+        next_id = kwargs.pop('nsi', None)
+        self.transition_id = kwargs.pop('tid', None)
+        self._load_data(controller_id, next_id)
+        self.context = {}
+
+        instances = [registry.get(klass)() for klass in tasks]
+        validations = [registry.get(t.validation_class)()
+                       for t in instances if t.validation_class]
+        instances.append(ChangeStateTask())
+
+        recorder = ExecutionRecorder(self.controller,
+                                     self.previous,
+                                     self.next,
+                                     trace_id=self.transition_id,
+                                     task_id=self.request.get('id'))
+        steps = [(t, PHASE_VALIDATION) for t in validations] + \
+                [(t, t.phase) for t in instances]
+        try:
+            for task, phase in steps:
+                self.heartbeat()
+                task.controller = self.controller
+                task.previous = self.previous
+                task.next = self.next
+                task.context = self.context
+                task.transition_id = self.transition_id
+                with timer(phase, self.transition_id, task=task.name), recorder.task(task, phase):
+                    task._run()
+        finally:
+            recorder.save()
+
+        return True
+
+
+class BulkChangeStateTask(BaseTask):
+
+    '''Moves a chunk of controllers to the next state.
+
+    The tasks of each controller's transition run in this worker, one
+    controller after the other, and share a context dict; transitions
+    holding a task with inline = False fail. The state change, the logs
+    and the state data of the whole chunk are then written with bulk
+    queries. Per-object state change signals are not sent.'''
+
+    name = 'Bulk Change State'
+    description = 'Changes the current state of many controllers to the next.'
+    public = False
+    # controllers processed between two renewals of the chunk's leases
+    heartbeat_every = 50
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        logger.error(exc)
+        controllers = StateController.objects.filter(id__in=kwargs.get('cids', list()),
+                                                     inner_state=INNER_STATE_RUNNING,
+                                                     task_id=kwargs.get('tid'))
+        pairs = list(controllers.values_list('content_type_id', 'object_id'))
+        controllers.update(inner_state=INNER_STATE_IDLE,
+                           task_id=None,
+                           lease_expires_at=None)
+        mirror_controllers_state(pairs, inner_state=INNER_STATE_IDLE)
+
+    def run(self, *args, **kwargs):
+        from .task_runner import TaskLoader
+        controller_ids = kwargs.pop('cids', list())
+        next_id = kwargs.pop('nsi', None)
+        self.transition_id = kwargs.pop('tid', None)
+        self.task_loader = TaskLoader()
+        self.next = State.objects.get(id=next_id)
+        controllers = StateController.objects.filter(id__in=controller_ids,
+                                                     inner_state=INNER_STATE_RUNNING,
+                                                     task_id=self.transition_id) \
+                                             .select_related('machine', 'current_state')
+        controllers = list(controllers)
+        before_state_change_batch.send_robust(sender=StateController,
+                                              changes=[(c, c.current_state, self.next)
+                                                       for c in controllers])
+        changed = []
+        failed = []
+        self.recorders = []
+        with timer(PHASE_TASK, self.transition_id, task=self.name, controllers=len(controller_ids)):
+            for i, controller in enumerate(controllers):
+                if i and i % self.heartbeat_every == 0:
+                    StateController.objects.heartbeat(controller_ids, self.transition_id)
+                if self._run_transition(controller):
+                    changed.append(controller)
+                else:
+                    failed.append(controller)
+
+        with timer(PHASE_COMMIT, self.transition_id, task=self.name, controllers=len(changed)):
+            return self._commit(changed, failed)
+
+    def _run_transition(self, controller):
+        '''runs the validations and tasks of controller's
+        transition, returning if all of them succeeded'''
+        transition = controller.machine.graph.transition(controller.current_state_id,
+                                                         self.next.id)
+        if transition is None:
+            logger.warning('Controller %s has no transition to %s.',
+                           controller.id,
+                           self.next.id)
+            return False
+
+        recorder = ExecutionRecorder(controller,
+                                     controller.current_state,
+                                     self.next,
+                                     transition=transition,
+                                     trace_id=self.transition_id,
+                                     task_id=self.request.get('id'))
+        self.recorders.append(recorder)
+        # shared by the tasks of this controller's transition
+        context = {}
+        try:
+            tasks = [self.task_loader.load_task(klass)() for klass in transition.tasks]
+            validations = [self.task_loader.load_task(t.validation_class)()
+                           for t in tasks if t.validation_class]
+            if not all(getattr(t, 'inline', True) for t in tasks + validations):
+                logger.warning('Transition %s of controller %s has tasks that cannot run in bulk.',
+                               transition.id,
+                               controller.id)
+                return False
+            steps = [(t, PHASE_VALIDATION) for t in validations] + \
+                    [(t, t.phase) for t in tasks]
+            for task, phase in steps:
+                task.controller = controller
+                task.previous = controller.current_state
+                task.next = self.next
+                task.context = context
+                task.transition_id = self.transition_id
+                with recorder.task(task, phase):
+                    task._run()
+        except Exception as ex:
+            logger.error('Transition of controller %s to %s failed. %s',
+                         controller.id,
+                         self.next.id,
+                         ex)
+            return False
+
+        return True
+
+    def _commit(self, changed, failed):
+        '''commits the controllers still running for this run,
+        returning how many changed state'''
+        with transaction.atomic():
+            # controllers reaped, or claimed again, meanwhile are left alone
+            owned = set(StateController.objects.select_for_update()
+                                               .filter(id__in=[c.id for c in changed + failed],
+                                                       inner_state=INNER_STATE_RUNNING,
+                                                       task_id=self.transition_id)
+                                               .values_list('id', flat=True))
+            if len(owned) < len(changed) + len(failed):
+                logger.warning('%s controllers were no longer running for %s.',
+                               len(changed) + len(failed) - len(owned),
+                               self.transition_id)
+            changed = [c for c in changed if c.id in owned]
+            failed = [c for c in failed if c.id in owned]
+            changes = [(c, c.current_state, self.next) for c in changed]
+            if changed:
+                StateController.objects.filter(id__in=[c.id for c in changed]) \
+                                       .update(current_state=self.next,
+                                               inner_state=INNER_STATE_IDLE,
+                                               task_id=None,
+                                               lease_expires_at=None)
+                mirror_controllers_state([(c.content_type_id, c.object_id) for c in changed],
+                                         current_state=self.next,
+                                         inner_state=INNER_STATE_IDLE)
+            if failed:
+                StateController.objects.filter(id__in=[c.id for c in failed]) \
+                                       .update(inner_state=INNER_STATE_IDLE,
+                                               task_id=None,
+                                               lease_expires_at=None)
+                mirror_controllers_state([(c.content_type_id, c.object_id) for c in failed],
+                                         inner_state=INNER_STATE_IDLE)
+            if changes:
+                after_state_change_batch.send_robust(sender=StateController,
+                                                     changes=changes)
+            save_executions(self.recorders)
+        return len(changed)
+
+
+class ReapStuckControllersTask(BaseTask):
+
+    '''Resets the controllers left running by workers that died
+    mid-transition. Meant to be scheduled periodically.'''
+
+    name = 'Reap Stuck Controllers'
+    description = 'Resets running controllers whose lease expired.'
+    public = False
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        logger.error(exc)
+
+    def run(self, *args, **kwargs):
+        return StateController.objects.reap()
+
+
+class MaintainTransitionLogTask(BaseTask):
+
+    '''Rolls up the transition logs into daily counts and, when the
+    log is partitioned, creates the coming monthly partitions and
+    drops the expired ones. Meant to be scheduled daily.'''
+
+    name = 'Maintain Transition Log'
+    description = 'Rolls up and partitions the transition log.'
+    public = False
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        logger.error(exc)
+
+    def run(self, *args, **kwargs):
+        from .partitions import maintain
+        created, dropped = maintain()
+        return {'created': created, 'dropped': dropped}
@@ -0,0 +1,230 @@
+# coding: utf-8
+from django.contrib.contenttypes.models import ContentType
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from workflow import data_storage
+from workflow.data_cache import LocalDataCache, set_data_cache, reset_data_cache
+from workflow.exceptions import VersionConflict
+from workflow.receivers import create_state_data
+from workflow.models import (StateMachine,
+                             State,
+                             StateController,
+                             StateControllerData, )
+
+
+class MergePatchTestCase(SimpleTestCase):
+
+    def test_round_trip(self):
+
+        source = {'a': 1, 'b': {'c': 2, 'd': [1, 2]}, 'e': 'x'}
+        target = {'a': 1, 'b': {'c': 3, 'd': [1, 2]}, 'f': True}
+        patch = data_storage.diff(source, target)
+
+        self.assertEqual({'b': {'c': 3}, 'e': None, 'f': True}, patch)
+        self.assertEqual(target, data_storage.apply(source, patch))
+        self.assertEqual('x', source['e'])
+
+    def test_null_values_are_not_encodable(self):
+
+        self.assertIsNone(data_storage.diff({'a': 1}, {'a': None}))
+        self.assertEqual({'a': [None]}, data_storage.diff({}, {'a': [None]}))
+
+    def test_should_compact(self):
+
+        self.assertFalse(data_storage.should_compact({'a': 'x' * 100}, {}))
+        self.assertTrue(data_storage.should_compact({'a': 1}, {'b': 'x' * 100}))
+
+
+@override_settings(WORKFLOW_DATA_STORAGE='delta')
+class DeltaStorageTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state_a = State.objects.create(code='foo', description='foo')
+        self.state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=self.state_a)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=self.state_a.id,
+                                                         machine=machine,
+                                                         current_state=self.state_a)
+        self.snapshot = StateControllerData.objects.create(controller=self.controller,
+                                                           state=self.state_a,
+                                                           data={'big': 'x' * 1000, 'n': 1})
+
+    def test_carry_forward_references_snapshot(self):
+
+        create_state_data([(self.controller, self.state_a, self.state_b)])
+        row = StateControllerData.objects.get(state=self.state_b)
+
+        self.assertEqual(self.snapshot.id, row.base_id)
+        self.assertEqual({}, row.patch)
+        self.assertEqual(self.snapshot.data, row.data)
+
+    def test_edit_stores_patch(self):
+
+        create_state_data([(self.controller, self.state_a, self.state_b)])
+        row = StateControllerData.objects.get(state=self.state_b)
+        row.data['n'] = 2
+        row.save()
+
+        row = StateControllerData.objects.get(pk=row.pk)
+        self.assertEqual({'n': 2}, row.patch)
+        self.assertEqual(2, row.data['n'])
+        self.assertEqual(1000, len(row.data['big']))
+        self.assertEqual({}, StateControllerData.objects.filter(pk=row.pk)
+                                                        .values_list('data', flat=True)[0])
+
+    def test_compact(self):
+
+        create_state_data([(self.controller, self.state_a, self.state_b)])
+        row = StateControllerData.objects.get(state=self.state_b)
+        StateControllerData.objects.filter(pk=row.pk).update(patch={'n': 'y' * 800})
+
+        self.assertEqual(1, data_storage.compact(ratio=0.5))
+        row = StateControllerData.objects.get(pk=row.pk)
+        self.assertTrue(row.is_snapshot)
+        self.assertEqual('y' * 800, row.data['n'])
+
+
+class DataPolicyTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state_a = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=self.state_a)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=self.state_a.id,
+                                                         machine=machine,
+                                                         current_state=self.state_a)
+        StateControllerData.objects.create(controller=self.controller,
+                                           state=self.state_a,
+                                           data={'old': True})
+        StateControllerData.objects.create(controller=self.controller,
+                                           state=self.state_a,
+                                           data={'n': 1, 'keep': 'x'})
+
+    def enter(self, code, **fields):
+        state = State.objects.create(code=code, description=code, **fields)
+        create_state_data([(self.controller, self.state_a, state)])
+        return StateControllerData.objects.get(state=state)
+
+    def test_copy(self):
+        self.assertEqual({'n': 1, 'keep': 'x'}, self.enter('copy').data)
+
+    def test_empty(self):
+        self.assertEqual({}, self.enter('empty', data_policy='empty').data)
+
+    def test_merge(self):
+        row = self.enter('merge', data_policy='merge', data_defaults={'n': 0, 'new': []})
+        self.assertEqual({'n': 1, 'keep': 'x', 'new': []}, row.data)
+
+    def test_without_previous_data(self):
+        state = State.objects.create(code='merge', description='merge',
+                                     data_policy='merge', data_defaults={'new': 1})
+        create_state_data([(self.controller, None, state), (self.controller, None, self.state_a)])
+        self.assertEqual({'new': 1}, StateControllerData.objects.get(state=state).data)
+
+    @override_settings(WORKFLOW_DATA_STORAGE='delta')
+    def test_merge_delta(self):
+        StateControllerData.objects.create(controller=self.controller,
+                                           state=self.state_a,
+                                           data={'n': 1, 'keep': 'x', 'big': 'x' * 1000})
+        row = self.enter('copy')
+        row.data['n'] = 2
+        del row.data['keep']
+        row.save()
+        self.assertIsNotNone(row.base_id)
+
+        state = State.objects.create(code='merge', description='merge',
+                                     data_policy='merge', data_defaults={'n': 0, 'keep': 'y', 'new': 1})
+        create_state_data([(self.controller, row.state, state)])
+        merged = StateControllerData.objects.get(state=state)
+        self.assertEqual(row.base_id, merged.base_id)
+        self.assertEqual({'n': 2, 'keep': 'y', 'new': 1, 'big': 'x' * 1000}, merged.data)
+
+
+class PatchDataTestCase(TransactionTestCase):
+
+    def setUp(self):
+        state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=state)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=state.id,
+                                                         machine=machine,
+                                                         current_state=state)
+        self.data = StateControllerData.objects.create(controller=self.controller,
+                                                       state=state,
+                                                       data={'a': 1, 'b': {'c': 1}})
+
+    def test_patch(self):
+
+        with self.assertNumQueries(3):
+            pk, version = StateControllerData.objects.patch(self.controller,
+                                                            {'b': 2, 'd': None})
+
+        self.assertEqual(self.data.id, pk)
+        self.assertEqual(1, version)
+        self.assertEqual({'a': 1, 'b': 2, 'd': None},
+                         StateControllerData.objects.get(pk=pk).data)
+
+    def test_patch_version_conflict(self):
+
+        StateControllerData.objects.patch(self.controller, {'a': 2}, version=0)
+        self.assertRaises(VersionConflict,
+                          StateControllerData.objects.patch,
+                          self.controller, {'a': 3}, version=0)
+        self.assertEqual(2, StateControllerData.objects.get(pk=self.data.pk).data['a'])
+
+
+class DataCacheTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=self.state)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=self.state.id,
+                                                         machine=machine,
+                                                         current_state=self.state)
+        self.data = StateControllerData.objects.create(controller=self.controller,
+                                                       state=self.state,
+                                                       data={'a': 1})
+        set_data_cache(LocalDataCache())
+
+    def tearDown(self):
+        reset_data_cache()
+
+    def fresh(self):
+        return StateController.objects.get(pk=self.controller.pk)
+
+    def test_read_through(self):
+        self.assertEqual({'a': 1}, self.fresh().current_data.data)
+
+        controller = self.fresh()
+        with self.assertNumQueries(0):
+            data = controller.current_data
+            self.assertEqual((self.data.id, self.data.version), controller.current_data_version())
+        self.assertEqual({'a': 1}, data.data)
+
+        data.data['a'] = 2
+        data.save()
+        self.assertEqual({'a': 2}, self.fresh().current_data.data)
+        self.assertEqual(1, StateControllerData.objects.get(pk=self.data.pk).version)
+
+    def test_patch_invalidates(self):
+        self.fresh().current_data
+        StateControllerData.objects.patch(self.controller, {'b': 1})
+        self.assertEqual({'a': 1, 'b': 1}, self.fresh().current_data.data)
+
+    def test_state_change_invalidates(self):
+        self.fresh().current_data
+        create_state_data([(self.controller, self.state, self.state)])
+        self.assertNotEqual(self.data.id, self.fresh().current_data.id)
+
+    def test_lru(self):
+        cache = LocalDataCache(max_size=2)
+        for i in range(3):
+            cache.set(i, 1, {'id': i})
+        cache.get(1, 1)
+        cache.set(3, 1, {'id': 3})
+        self.assertIsNone(cache.get(0, 1))
+        self.assertIsNone(cache.get(2, 1))
+        self.assertEqual({'id': 1}, cache.get(1, 1))
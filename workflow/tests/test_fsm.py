@@ -0,0 +1,92 @@
+# coding: utf-8
+import json
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from workflow.fsm import GoFSMUpdater
+from workflow.models import (StateMachine,
+                             State,
+                             Action,
+                             AvailableTask,
+                             Transition, )
+
+
+def representation(size, tasks=None, actions=None):
+    nodes = [{'key': i, 'text': 'state-{0}'.format(i), 'actions': actions or []}
+             for i in range(size)]
+    nodes[0]['type'] = 'initial'
+    links = [{'from': i, 'to': i + 1, 'text': 'go-{0}'.format(i), 'tasks': tasks or []}
+             for i in range(size - 1)]
+    return {'representation': json.dumps({'nodeDataArray': nodes,
+                                          'linkDataArray': links})}
+
+
+class GoFSMUpdaterTestCase(TransactionTestCase):
+
+    def test_update_creates_graph(self):
+
+        machine = StateMachine.objects.create(name='machine')
+        task = AvailableTask.objects.create(name='foo', klass='foo.bar.Foo')
+        action = Action.objects.create(name='foo')
+        GoFSMUpdater().update(machine, representation(4, [task.id], [action.id]))
+
+        machine.refresh_from_db()
+        self.assertEqual('state-0', machine.initial_state.code)
+        self.assertEqual(1, machine.version)
+        self.assertEqual(3, machine.transitions.count())
+        for transition in machine.transitions.all():
+            self.assertEqual([task.id], [t.id for t in transition.tasks.all()])
+        self.assertEqual(4, State.objects.filter(actions=action).count())
+
+    def test_update_keeps_unchanged_transitions(self):
+
+        machine = StateMachine.objects.create(name='machine')
+        updater = GoFSMUpdater()
+        updater.update(machine, representation(3))
+        before = set(machine.transitions.values_list('id', flat=True))
+
+        updater.update(machine, representation(4))
+        after = set(machine.transitions.values_list('id', flat=True))
+
+        self.assertTrue(before.issubset(after))
+        self.assertEqual(3, len(after))
+
+    def test_update_keeps_transition_fields(self):
+
+        machine = StateMachine.objects.create(name='machine')
+        updater = GoFSMUpdater()
+        updater.update(machine, representation(2))
+        schema = {'type': 'object'}
+        machine.transitions.update(execution='sync', data_schema=schema)
+
+        task = AvailableTask.objects.create(name='foo', klass='foo.bar.Foo')
+        updater.update(machine, representation(2, [task.id]))
+
+        transition = machine.transitions.get()
+        self.assertEqual([task.id], [t.id for t in transition.tasks.all()])
+        self.assertEqual('sync', transition.execution)
+        self.assertEqual(schema, transition.data_schema)
+
+    def test_update_query_count_is_bounded(self):
+
+        updater = GoFSMUpdater()
+        counts = []
+        for size in (3, 60):
+            machine = StateMachine.objects.create(name='machine-{0}'.format(size))
+            with CaptureQueriesContext(connection) as ctx:
+                updater.update(machine, representation(size))
+            counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(59, Transition.objects.filter(machine__name='machine-60').count())
+
+    def test_update_bumps_version_once(self):
+
+        machine = StateMachine.objects.create(name='machine')
+        updater = GoFSMUpdater()
+        updater.update(machine, representation(5))
+        task = AvailableTask.objects.create(name='foo', klass='foo.bar.Foo')
+        updater.update(machine, representation(5, [task.id]))
+
+        machine.refresh_from_db()
+        self.assertEqual(2, machine.version)
@@ -0,0 +1,93 @@
+# coding: utf-8
+from django.test import TransactionTestCase
+from django.contrib.auth.models import Permission
+from workflow import graph as workflow_graph
+from workflow.models import (StateMachine,
+                             State,
+                             AvailableTask,
+                             TransitionTask,
+                             Transition, )
+
+
+class CompiledGraphTestCase(TransactionTestCase):
+
+    def setUp(self):
+        workflow_graph.invalidate()
+        self.state_a = State.objects.create(code='foo', description='foo')
+        self.state_b = State.objects.create(code='bar', description='bar')
+        self.state_c = State.objects.create(code='baz', description='baz')
+        self.machine = StateMachine.objects.create(name='machine',
+                                                   initial_state=self.state_a)
+        self.transition_ab = Transition.objects.create(machine=self.machine,
+                                                       from_state=self.state_a,
+                                                       to_state=self.state_b)
+        self.transition_ac = Transition.objects.create(machine=self.machine,
+                                                       from_state=self.state_a,
+                                                       to_state=self.state_c)
+
+    def test_compile(self):
+
+        at1 = AvailableTask.objects.create(name='foo', klass='foo.bar.Foo')
+        at2 = AvailableTask.objects.create(name='bar', klass='foo.bar.Bar')
+        TransitionTask.objects.create(transition=self.transition_ab, task=at2, order=1)
+        TransitionTask.objects.create(transition=self.transition_ab, task=at1, order=0)
+        permission = Permission.objects.all()[0]
+        self.transition_ac.permissions.add(permission)
+
+        graph = self.machine.graph
+        self.assertEqual(2, len(graph))
+        self.assertEqual(self.state_a.id, graph.initial_state_id)
+        self.assertEqual(set([self.state_b.id, self.state_c.id]),
+                         set(t.to_state_id for t in graph.next(self.state_a.id)))
+        self.assertEqual((), graph.next(self.state_b.id))
+        self.assertEqual(('foo.bar.Foo', 'foo.bar.Bar'),
+                         graph.tasks(self.transition_ab.id))
+        self.assertEqual(('{0}.{1}'.format(permission.content_type.app_label,
+                                           permission.codename), ),
+                         graph.permissions(self.transition_ac.id))
+        self.assertIsNone(graph.transition(self.state_b.id, self.state_a.id))
+
+    def test_next_uses_graph(self):
+
+        graph = self.machine.graph
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.next(self.state_a.id), self.machine.next(self.state_a))
+            self.assertEqual((), self.machine.next(self.state_b.id))
+
+    def test_cached_per_version(self):
+
+        graph = self.machine.graph
+        with self.assertNumQueries(0):
+            self.assertIs(graph, self.machine.graph)
+
+        self.machine.bump_version()
+        new_graph = self.machine.graph
+        self.assertIsNot(graph, new_graph)
+        self.assertEqual(2, len(new_graph))
+
+    def fresh_graph(self):
+        return StateMachine.objects.get(pk=self.machine.pk).graph
+
+    def test_changes_bump_version(self):
+
+        graph = self.fresh_graph()
+        transition = Transition.objects.create(machine=self.machine,
+                                               from_state=self.state_b,
+                                               to_state=self.state_c)
+        new_graph = self.fresh_graph()
+        self.assertIsNot(graph, new_graph)
+        self.assertEqual(3, len(new_graph))
+
+        at = AvailableTask.objects.create(name='foo', klass='foo.bar.Foo')
+        TransitionTask.objects.create(transition=transition, task=at)
+        self.assertEqual(('foo.bar.Foo', ), self.fresh_graph().tasks(transition.id))
+
+        at.delete()
+        self.assertEqual((), self.fresh_graph().tasks(transition.id))
+
+        permission = Permission.objects.all()[0]
+        transition.permissions.add(permission)
+        self.assertEqual(1, len(self.fresh_graph().permissions(transition.id)))
+
+        permission.transition_set.clear()
+        self.assertEqual((), self.fresh_graph().permissions(transition.id))
@@ -11,7 +11,11 @@ from workflow.models import (StateMachine,
                              TransitionLog,
                              StateController,
                              StateControllerData,
-                             StateControllerMixIn, )
+                             StateControllerMixIn,
+                             DenormalizedStateControllerMixIn,
+                             bulk_initialize,
+                             prefetch_controllers, )
+from workflow.signals import controllers_initialized
 User = get_user_model()
 
 
@@ -21,6 +25,12 @@ class FakeTicket(StateControllerMixIn,
     foo = models.CharField(max_length=10)
 
 
+class FakeDenormalizedTicket(DenormalizedStateControllerMixIn,
+                             fake_models.FakeModel):
+
+    foo = models.CharField(max_length=10)
+
+
 @FakeTicket.fake_me
 class StateControllerMixInTestCase(TransactionTestCase):
 
@@ -69,6 +79,42 @@ class StateControllerMixInTestCase(TransactionTestCase):
         self.assertDictEqual({}, fake.current_data.data)
         self.assertEqual(state.id, fake.current_state.id)
 
+    def test_controller_is_cached(self):
+
+        state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=state)
+        fake = FakeTicket(foo='oi')
+        fake.save(state_machine=machine)
+        fake = FakeTicket.objects.get(pk=fake.pk)
+
+        with self.assertNumQueries(1):
+            controller = fake.controller
+            self.assertIs(controller, fake.controller)
+            self.assertEqual(state.id, fake.current_state.id)
+            self.assertEqual(machine.id, fake.controller.machine.id)
+
+        controller.machine.graph
+        with self.assertNumQueries(0):
+            self.assertEqual((), controller.next())
+            self.assertEqual((), fake.next)
+
+        fake.refresh_from_db()
+        self.assertIsNot(controller, fake.controller)
+
+    def test_prefetch_controllers(self):
+
+        state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=state)
+        for i in range(3):
+            FakeTicket(foo=str(i)).save(state_machine=machine)
+        FakeTicket(foo='none').save()
+
+        with self.assertNumQueries(2):
+            tickets = prefetch_controllers(FakeTicket.objects.all())
+            states = [t.current_state for t in tickets]
+
+        self.assertEqual(3, len([s for s in states if s is not None]))
+
 
 class TransitionModelTestCase(TransactionTestCase):
 
@@ -109,3 +155,88 @@ class TransitionModelTestCase(TransactionTestCase):
         self.assertTrue(transition_ab.is_available(user))
         self.assertFalse(transition_bc.is_available(user))
         self.assertEqual(1, len(machine.next_for_user(state_a, user)))
+
+    def test_next_for_user_batches_permissions(self):
+
+        state_a = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine')
+        permissions = Permission.objects.all()[:3]
+        user = mommy.make(User)
+        user.user_permissions.add(permissions[0])
+        for i, permission in enumerate(permissions):
+            state = State.objects.create(code='to-{0}'.format(i))
+            transition = Transition.objects.create(machine=machine,
+                                                   from_state=state_a,
+                                                   to_state=state)
+            transition.permissions.add(permission)
+        user = User.objects.get(pk=user.pk)
+        user.get_all_permissions()
+        machine.graph
+
+        with self.assertNumQueries(0):
+            available = machine.next_for_user(state_a, user)
+
+        self.assertEqual(1, len(available))
+        self.assertEqual(set([available[0].to_state_id]),
+                         machine.transitions_available_to(state_a, user))
+
+
+@FakeDenormalizedTicket.fake_me
+class DenormalizedStateControllerMixInTestCase(TransactionTestCase):
+
+    def test_state_is_mirrored(self):
+
+        state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=state)
+
+        fake = FakeDenormalizedTicket(foo='oi')
+        fake.save(state_machine=machine)
+        self.assertEqual(state.id, fake.current_state_id)
+
+        fake = FakeDenormalizedTicket.objects.get(pk=fake.pk)
+        self.assertEqual(state.id, fake.current_state_id)
+        self.assertEqual('idle', fake.inner_state)
+
+    def test_bulk_initialize(self):
+
+        state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=state)
+        sent = []
+
+        def receiver(sender, **kwargs):
+            sent.append((sender, len(kwargs['controllers'])))
+        controllers_initialized.connect(receiver)
+        try:
+            tickets = [FakeDenormalizedTicket(foo=str(i)) for i in range(5)]
+            controllers = bulk_initialize(tickets, machine, batch_size=2)
+        finally:
+            controllers_initialized.disconnect(receiver)
+
+        self.assertEqual([(FakeDenormalizedTicket, 5)], sent)
+        self.assertEqual(5, len(controllers))
+        self.assertEqual(5, TransitionLog.objects.filter(controller__in=controllers,
+                                                         from_state=None,
+                                                         to_state=state).count())
+        self.assertEqual(5, StateControllerData.objects.filter(controller__in=controllers,
+                                                               state=state).count())
+        self.assertEqual(5, FakeDenormalizedTicket.objects.filter(current_state=state,
+                                                                  inner_state='idle').count())
+        with self.assertNumQueries(0):
+            self.assertEqual(state.id, tickets[0].controller.current_state.id)
+
+    def test_with_workflow_state(self):
+
+        state = State.objects.create(code='foo', description='foo')
+        machine = StateMachine.objects.create(name='machine', initial_state=state)
+        for i in range(3):
+            FakeDenormalizedTicket(foo=str(i)).save(state_machine=machine)
+
+        with self.assertNumQueries(1):
+            tickets = list(FakeDenormalizedTicket.objects.with_workflow_state()
+                                                         .filter(workflow_state_id=state.id)
+                                                         .order_by('workflow_state_id'))
+
+        self.assertEqual(3, len(tickets))
+        for ticket in tickets:
+            self.assertEqual(machine.id, ticket.workflow_machine_id)
+            self.assertEqual(ticket.controller.current_data.id, ticket.workflow_data_id)
@@ -0,0 +1,127 @@
+# coding: utf-8
+from django.contrib.contenttypes.models import ContentType
+from django.test import SimpleTestCase, TransactionTestCase
+from workflow import schemas
+from workflow.exceptions import SchemaValidationError
+from workflow.tasks import ValidateSchemaTask
+from workflow.models import (StateMachine,
+                             State,
+                             Transition,
+                             StateController,
+                             StateControllerData, )
+
+
+SCHEMA = {'type': 'object',
+          'required': ['a'],
+          'properties': {'a': {'type': 'integer'},
+                         'b': {'type': 'string'}},
+          'additionalProperties': False}
+
+
+class SchemaTestCase(SimpleTestCase):
+
+    def tearDown(self):
+        schemas.reset()
+
+    def test_compiled_once(self):
+
+        compiled = schemas.compile_schema(SCHEMA)
+        self.assertIs(compiled, schemas.compile_schema(dict(SCHEMA)))
+        self.assertTrue(compiled.incremental)
+        self.assertFalse(schemas.compile_schema({'allOf': [SCHEMA]}).incremental)
+
+    def test_structured_errors(self):
+
+        errors = schemas.validate(SCHEMA, {'a': 'x', 'c': 1})
+        self.assertEqual([[], ['a']], sorted(e['path'] for e in errors))
+        self.assertEqual(set(['additionalProperties', 'type']), set(e['validator'] for e in errors))
+
+    def test_only_changed_keys(self):
+
+        compiled = schemas.compile_schema(SCHEMA)
+        errors = compiled.errors_for({'a': 1, 'b': 2}, ['a'])
+        self.assertEqual([], errors)
+
+        errors = compiled.errors_for({'b': 2, 'c': 1}, ['c'])
+        self.assertEqual([[], ['c']], sorted(e['path'] for e in errors))
+
+    def test_constrained_keys(self):
+
+        compiled = schemas.compile_schema(SCHEMA)
+        self.assertTrue(compiled.constrains('a'))
+        self.assertTrue(compiled.constrains('c'))
+
+        compiled = schemas.compile_schema({'type': 'object',
+                                           'properties': {'a': {'type': 'integer'}}})
+        self.assertFalse(compiled.constrains('c'))
+
+    def test_incremental(self):
+
+        self.assertEqual([], schemas.validate(SCHEMA, {'a': 1, 'b': 'x'}, 1, 1, 0))
+        self.assertEqual([], schemas.validate(SCHEMA, {'a': 'not read'}, 1, 1, 0))
+
+        errors = schemas.validate(SCHEMA, {'a': 1, 'b': 2}, 1, 1, 1)
+        self.assertEqual([['b']], [e['path'] for e in errors])
+
+        errors = schemas.validate(SCHEMA, {'b': 'x'}, 1, 1, 2)
+        self.assertEqual(['required'], [e['validator'] for e in errors])
+
+
+class ValidateSchemaTaskTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state_a = State.objects.create(code='foo', description='foo')
+        self.state_b = State.objects.create(code='bar', description='bar', data_schema=SCHEMA)
+        machine = StateMachine.objects.create(name='machine', initial_state=self.state_a)
+        self.transition = Transition.objects.create(machine=machine,
+                                                    from_state=self.state_a,
+                                                    to_state=self.state_b)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=self.state_a.id,
+                                                         machine=machine,
+                                                         current_state=self.state_a)
+        self.data = StateControllerData.objects.create(controller=self.controller,
+                                                       state=self.state_a,
+                                                       data={'a': 'x'})
+
+    def tearDown(self):
+        schemas.reset()
+
+    def task(self):
+        task = ValidateSchemaTask()
+        task.controller = StateController.objects.get(pk=self.controller.pk)
+        task.next = self.state_b
+        return task
+
+    def test_state_schema(self):
+
+        with self.assertRaises(SchemaValidationError) as raised:
+            self.task()._run()
+        self.assertEqual(['a'], raised.exception.errors[0]['path'])
+
+        self.data.data = {'a': 1}
+        self.data.save()
+        self.assertTrue(self.task()._run())
+
+        # unchanged data is not read again
+        task = self.task()
+        with self.assertNumQueries(2):
+            self.assertTrue(task._run())
+
+    def test_state_schema_change(self):
+
+        self.data.data = {'a': 1}
+        self.data.save()
+        self.assertTrue(self.task()._run())
+
+        self.state_b.data_schema = {'type': 'object', 'required': ['c']}
+        self.state_b.save()
+        self.assertRaises(SchemaValidationError, self.task()._run)
+
+    def test_transition_schema(self):
+
+        self.transition.data_schema = {'type': 'object', 'required': ['c']}
+        self.transition.save()
+        with self.assertRaises(SchemaValidationError) as raised:
+            self.task()._run()
+        self.assertEqual('required', raised.exception.errors[0]['validator'])
@@ -1,20 +1,30 @@
 # coding: utf-8
-from django.db import models
+from datetime import timedelta
+from django.db import connection, models, transaction
+from django.utils import timezone
 from django.test import TransactionTestCase, override_settings
 from workflow.task_runner import (TaskLoader,)
 from django_fake_model import models as fake_models
 from workflow.task_runner import TaskRunner
-from workflow.tasks import BaseTask, ValidateSchemaTask
+from workflow.registry import TaskRegistry
+from workflow.instrumentation import MemorySink, QueryCounter, set_sink, reset_sink
+from workflow.signals import (controllers_reaped,
+                              before_state_change,
+                              after_state_change,
+                              after_state_change_batch, )
+from workflow.exceptions import LeaseLost
+from workflow.tasks import BaseTask, ChangeStateTask, PipelineTask, ValidateSchemaTask
 from workflow.models import (StateMachine,
                              State,
                              AvailableTask,
                              TransitionTask,
                              Transition,
                              TransitionLog,
+                             TransitionExecution,
                              StateController,
                              StateControllerData,
                              StateControllerMixIn, )
-from celery.result import AsyncResult
+from celery.result import AsyncResult, EagerResult
 from celery import current_app
 
 
@@ -48,9 +58,38 @@ class MockClassB(BaseTask):
         return True
 
 
+class MockContext(BaseTask):
+    name = 'mockcontext'
+
+    def _run(self):
+        self.context['transition'] = self.transition_id
+        return True
+
+
+class MockContextReader(BaseTask):
+    name = 'mockcontextreader'
+    # the context each run found, keyed by controller id
+    seen = {}
+
+    def _run(self):
+        self.seen[self.controller.id] = dict(self.context)
+        return True
+
+
+class MockQueued(BaseTask):
+    name = 'mockqueued'
+    inline = False
+
+    def _run(self):
+        return True
+
+
 current_app.tasks.register(MockValidation)
 current_app.tasks.register(MockClassA)
 current_app.tasks.register(MockClassB)
+current_app.tasks.register(MockContext)
+current_app.tasks.register(MockContextReader)
+current_app.tasks.register(MockQueued)
 
 
 class TaskLoaderTestCase(TransactionTestCase):
@@ -201,3 +240,381 @@ class TaskRunnerTestCase(TransactionTestCase):
         self.assertIsInstance(result, AsyncResult)
         fake = FakeControlled.objects.all()[0]
         self.assertEqual(fake.current_state.id, state_b.id)
+
+    @override_settings(WORKFLOW_PIPELINE_MODE='inline')
+    def test_run_inline(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=state_a)
+
+        transition = Transition.objects.create(machine=machine,
+                                               from_state=state_a,
+                                               to_state=state_b)
+        at1 = AvailableTask.objects.create(name='foo', klass='workflow.tests.test_task_runner.MockClassA')
+        at2 = AvailableTask.objects.create(name='bar', klass='workflow.tests.test_task_runner.MockClassB')
+        TransitionTask.objects.create(transition=transition, task=at1, order=0)
+        TransitionTask.objects.create(transition=transition, task=at2, order=1)
+
+        fake = FakeControlled()
+        fake.save(state_machine=machine)
+
+        runner = TaskRunner(fake, state_b)
+        job = runner.build()
+        self.assertEqual(PipelineTask.name, job.task)
+        self.assertEqual([at1.klass, at2.klass], job.kwargs['tasks'])
+
+        result = runner.run()
+        self.assertIsInstance(result, AsyncResult)
+        fake = FakeControlled.objects.all()[0]
+        self.assertEqual(fake.current_state.id, state_b.id)
+        self.assertEqual(1, TransitionLog.objects.filter(to_state=state_b).count())
+
+        execution = TransitionExecution.objects.get(controller=runner.controller)
+        self.assertEqual('success', execution.result)
+        self.assertEqual(transition.id, execution.transition_id)
+        self.assertEqual(['validationa', 'validationa', 'mocka', 'mockb', 'Change State'],
+                         [t.name for t in execution.tasks.all()])
+        self.assertEqual(['validation', 'validation', 'task', 'task', 'commit'],
+                         [t.phase for t in execution.tasks.all()])
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+@FakeControlled.fake_me
+class BulkTaskRunnerTestCase(TransactionTestCase):
+
+    def test_bulk_change_to(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=state_a)
+        transition = Transition.objects.create(machine=machine,
+                                               from_state=state_a,
+                                               to_state=state_b)
+        at = AvailableTask.objects.create(name='foo', klass='workflow.tests.test_task_runner.MockClassA')
+        TransitionTask.objects.create(transition=transition, task=at)
+
+        for i in range(5):
+            FakeControlled(foo=str(i)).save(state_machine=machine)
+        running = FakeControlled.objects.all()[0]
+        StateController.objects.filter(id=running.controller.id).update(inner_state='running')
+
+        result = StateController.objects.bulk_change_to(FakeControlled.objects.all(),
+                                                        state_b)
+
+        self.assertEqual(4, result.accepted)
+        self.assertEqual([running.id], result.rejected)
+        self.assertEqual(4, StateController.objects.filter(current_state=state_b,
+                                                           inner_state='idle').count())
+        self.assertEqual(4, TransitionLog.objects.filter(to_state=state_b).count())
+        self.assertEqual(4, StateControllerData.objects.filter(state=state_b).count())
+
+    def test_bulk_rejects_queued_tasks(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=state_a)
+        transition = Transition.objects.create(machine=machine,
+                                               from_state=state_a,
+                                               to_state=state_b)
+        at = AvailableTask.objects.create(name='queued', klass='workflow.tests.test_task_runner.MockQueued')
+        TransitionTask.objects.create(transition=transition, task=at)
+        fake = FakeControlled(foo='0')
+        fake.save(state_machine=machine)
+
+        result = StateController.objects.bulk_change_to(FakeControlled.objects.all(),
+                                                        state_b)
+
+        self.assertEqual(0, result.accepted)
+        self.assertEqual([fake.id], result.rejected)
+        self.assertEqual(state_a.id, StateController.objects.get(pk=fake.controller.pk).current_state_id)
+
+    def test_bulk_dispatch_on_commit(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=state_a)
+        Transition.objects.create(machine=machine,
+                                  from_state=state_a,
+                                  to_state=state_b)
+        for i in range(2):
+            FakeControlled(foo=str(i)).save(state_machine=machine)
+
+        with transaction.atomic():
+            result = StateController.objects.bulk_change_to(FakeControlled.objects.all(),
+                                                            state_b)
+            self.assertIsNotNone(result.result.id)
+            self.assertEqual(2, StateController.objects.filter(current_state=state_a,
+                                                               inner_state='running').count())
+
+        self.assertEqual(2, StateController.objects.filter(current_state=state_b,
+                                                           inner_state='idle').count())
+
+    def test_bulk_tasks_share_context(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=state_a)
+        transition = Transition.objects.create(machine=machine,
+                                               from_state=state_a,
+                                               to_state=state_b)
+        writer = AvailableTask.objects.create(name='context',
+                                              klass='workflow.tests.test_task_runner.MockContext')
+        reader = AvailableTask.objects.create(name='reader',
+                                              klass='workflow.tests.test_task_runner.MockContextReader')
+        TransitionTask.objects.create(transition=transition, task=writer, order=0)
+        TransitionTask.objects.create(transition=transition, task=reader, order=1)
+        for i in range(2):
+            FakeControlled(foo=str(i)).save(state_machine=machine)
+        MockContextReader.seen.clear()
+
+        result = StateController.objects.bulk_change_to(FakeControlled.objects.all(),
+                                                        state_b)
+
+        self.assertEqual(2, result.accepted)
+        self.assertEqual(2, StateController.objects.filter(current_state=state_b).count())
+        controller_ids = set(StateController.objects.values_list('id', flat=True))
+        self.assertEqual(controller_ids, set(MockContextReader.seen))
+        # written by MockContext, which runs first
+        for context in MockContextReader.seen.values():
+            self.assertEqual(['transition'], list(context))
+            self.assertIsNotNone(context['transition'])
+
+    @override_settings(WORKFLOW_BULK_CHUNK_SIZE=2)
+    def test_batch_signal_per_chunk(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=state_a)
+        Transition.objects.create(machine=machine,
+                                  from_state=state_a,
+                                  to_state=state_b)
+        for i in range(4):
+            FakeControlled(foo=str(i)).save(state_machine=machine)
+
+        batches = []
+        single = []
+
+        def batch_receiver(sender, **kwargs):
+            batches.append(len(kwargs['changes']))
+
+        def receiver(sender, **kwargs):
+            single.append(kwargs['controller'])
+        after_state_change_batch.connect(batch_receiver)
+        after_state_change.connect(receiver)
+        try:
+            StateController.objects.bulk_change_to(FakeControlled.objects.all(), state_b)
+        finally:
+            after_state_change_batch.disconnect(batch_receiver)
+            after_state_change.disconnect(receiver)
+
+        self.assertEqual([2, 2], batches)
+        self.assertEqual([], single)
+        self.assertEqual(4, TransitionLog.objects.filter(to_state=state_b).count())
+
+
+class TaskRegistryTestCase(TransactionTestCase):
+
+    def test_get_is_cached(self):
+
+        registry = TaskRegistry()
+        task = 'workflow.tests.test_task_runner.MockClassA'
+        self.assertIs(MockClassA, registry.get(task))
+        self.assertIn(task, registry._by_klass)
+        self.assertIs(MockClassA, registry.get_by_name('mocka'))
+
+        registry.invalidate(task)
+        self.assertNotIn(task, registry._by_klass)
+        self.assertRaises(ValueError, registry.get_by_name, 'mocka')
+
+    def test_populate_scans_once(self):
+
+        registry = TaskRegistry()
+        discovered = registry.populate()
+        self.assertIn('workflow.tasks.ChangeStateTask', discovered)
+        self.assertIs(discovered, registry.populate())
+
+        registry.invalidate()
+        self.assertIsNot(discovered, registry.populate())
+
+
+@FakeControlled.fake_me
+class ExecutionTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state_a = State.objects.create(code='foo', description='foo')
+        self.state_b = State.objects.create(code='bar', description='bar')
+        self.machine = StateMachine.objects.create(name='machine',
+                                                   initial_state=self.state_a)
+        self.transition = Transition.objects.create(machine=self.machine,
+                                                    from_state=self.state_a,
+                                                    to_state=self.state_b)
+        self.fake = FakeControlled()
+        self.fake.save(state_machine=self.machine)
+
+    def test_taskless_transition_runs_synchronously(self):
+
+        runner = TaskRunner(self.fake, self.state_b)
+        self.assertEqual('celery', runner.get_execution())
+
+        with self.settings(WORKFLOW_LIGHTWEIGHT_EXECUTION='sync'):
+            self.assertEqual('sync', runner.get_execution())
+            result = runner.run()
+        self.assertIsInstance(result, EagerResult)
+        self.assertIsNotNone(result.id)
+        self.assertEqual(self.state_b.id,
+                         FakeControlled.objects.all()[0].current_state.id)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_dispatch_on_commit(self):
+
+        at = AvailableTask.objects.create(name='foo', klass='workflow.tests.test_task_runner.MockClassA')
+        TransitionTask.objects.create(transition=self.transition, task=at)
+        self.fake.invalidate_controller()
+
+        with transaction.atomic():
+            result = self.fake.change_to(self.state_b)
+            self.assertIsNotNone(result.id)
+            controller = StateController.objects.get(pk=self.fake.controller.pk)
+            self.assertEqual('running', controller.inner_state)
+            self.assertEqual(self.state_a.id, controller.current_state_id)
+
+        controller = StateController.objects.get(pk=controller.pk)
+        self.assertEqual('idle', controller.inner_state)
+        self.assertEqual(self.state_b.id, controller.current_state_id)
+
+    @override_settings(WORKFLOW_LIGHTWEIGHT_EXECUTION='sync')
+    def test_instrumentation(self):
+
+        sink = MemorySink()
+        set_sink(sink)
+        logged = len(connection.queries_log)
+        try:
+            self.fake.change_to(self.state_b, transition_id='t1')
+        finally:
+            reset_sink()
+
+        # the queries are counted, not kept
+        self.assertEqual(logged, len(connection.queries_log))
+
+        self.assertEqual(['runner', 'commit', 'dispatch'], sink.phases('t1'))
+        for event in sink.events:
+            self.assertIsNotNone(event['queries'])
+            self.assertFalse(event['failed'])
+        self.assertEqual('Change State', sink.events[1]['task'])
+
+    def test_query_counter_full_log(self):
+
+        connection.force_debug_cursor = True
+        try:
+            connection.queries_log.extend({'sql': '', 'time': '0'}
+                                          for i in range(connection.queries_limit))
+            with QueryCounter(connection) as ctx:
+                State.objects.count()
+                State.objects.count()
+        finally:
+            connection.force_debug_cursor = False
+            connection.queries_log.clear()
+        self.assertEqual(2, ctx.count)
+
+    @override_settings(WORKFLOW_LIGHTWEIGHT_EXECUTION='sync')
+    def test_chained_execution(self):
+
+        self.fake.change_to(self.state_b, transition_id='t1')
+
+        execution = TransitionExecution.objects.get(trace_id='t1')
+        self.assertEqual('success', execution.result)
+        self.assertEqual(self.transition.id, execution.transition_id)
+        self.assertIsNotNone(execution.duration)
+        self.assertEqual(['Change State'], [t.name for t in execution.tasks.all()])
+
+    def test_concurrent_claim(self):
+
+        first = StateController.objects.get(pk=self.fake.controller.pk)
+        second = StateController.objects.get(pk=self.fake.controller.pk)
+
+        self.assertTrue(first.claim())
+        self.assertFalse(second.claim())
+        self.assertEqual('running', first.inner_state)
+        self.assertEqual('idle', second.inner_state)
+
+    def test_run_lost_claim(self):
+
+        sent = []
+
+        def receiver(sender, **kwargs):
+            sent.append(kwargs['controller'])
+        before_state_change.connect(receiver)
+
+        runner = TaskRunner(self.fake, self.state_b)
+        StateController.objects.filter(pk=runner.controller.pk).update(inner_state='running')
+
+        try:
+            self.assertFalse(runner.run())
+        finally:
+            before_state_change.disconnect(receiver)
+        self.assertEqual([], sent)
+        self.assertEqual(self.state_a.id,
+                         StateController.objects.get(pk=runner.controller.pk).current_state_id)
+
+    def test_reap(self):
+
+        reaped = []
+
+        def receiver(sender, **kwargs):
+            reaped.extend(kwargs['controllers'])
+        controllers_reaped.connect(receiver)
+
+        controller = StateController.objects.get(pk=self.fake.controller.pk)
+        self.assertTrue(controller.claim())
+        self.assertEqual([], StateController.objects.reap())
+
+        StateController.objects.filter(pk=controller.pk) \
+                               .update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([controller.pk], StateController.objects.reap())
+        self.assertEqual([controller.pk], reaped)
+        controllers_reaped.disconnect(receiver)
+
+        controller = StateController.objects.get(pk=controller.pk)
+        self.assertEqual('idle', controller.inner_state)
+        self.assertIsNone(controller.lease_expires_at)
+        self.assertFalse(controller.heartbeat())
+
+    def test_commit_after_lease_lost(self):
+
+        controller = StateController.objects.get(pk=self.fake.controller.pk)
+        self.assertTrue(controller.claim('first'))
+        StateController.objects.filter(pk=controller.pk) \
+                               .update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        StateController.objects.reap()
+        self.assertTrue(StateController.objects.get(pk=controller.pk).claim('second'))
+
+        task = ChangeStateTask()
+        task.controller = controller
+        task.previous = self.state_a
+        task.next = self.state_b
+        task.transition_id = 'first'
+        self.assertRaises(LeaseLost, task.heartbeat)
+        self.assertRaises(LeaseLost, task._run)
+        task.on_failure(LeaseLost(), None, (), {}, None)
+
+        controller = StateController.objects.get(pk=controller.pk)
+        self.assertEqual(self.state_a.id, controller.current_state_id)
+        self.assertEqual('running', controller.inner_state)
+        self.assertEqual('second', controller.task_id)
+
+    def test_execution_policy(self):
+
+        at = AvailableTask.objects.create(name='foo', klass='workflow.tests.test_task_runner.MockClassA')
+        TransitionTask.objects.create(transition=self.transition, task=at)
+        self.assertEqual('celery', TaskRunner(self.fake, self.state_b).get_execution())
+
+        StateMachine.objects.filter(pk=self.machine.pk).update(execution='thread')
+        self.machine.bump_version()
+        self.fake.invalidate_controller()
+        self.assertEqual('thread', TaskRunner(self.fake, self.state_b).get_execution())
+
+        self.transition.execution = 'sync'
+        self.transition.save()
+        self.fake.invalidate_controller()
+        self.assertEqual('sync', TaskRunner(self.fake, self.state_b).get_execution())
@@ -0,0 +1,175 @@
+# coding: utf-8
+import time
+from datetime import date
+from django.db import transaction
+from django.utils import timezone
+from django.test import TransactionTestCase, override_settings
+from django.contrib.contenttypes.models import ContentType
+from workflow import partitions
+from workflow.rest import export
+from workflow.transition_log import (BufferedTransitionLogSink,
+                                     SyncTransitionLogSink,
+                                     get_transition_log_sink,
+                                     reset_transition_log_sink, )
+from workflow.models import (StateMachine,
+                             State,
+                             StateController,
+                             TransitionLog,
+                             DailyTransitionCount, )
+
+
+class TransitionLogSinkTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state_a = State.objects.create(code='foo', description='foo')
+        self.state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=self.state_a)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=self.state_a.id,
+                                                         machine=machine,
+                                                         current_state=self.state_a)
+
+    def tearDown(self):
+        reset_transition_log_sink()
+
+    def test_default_sink_is_sync(self):
+
+        reset_transition_log_sink()
+        self.assertIsInstance(get_transition_log_sink(), SyncTransitionLogSink)
+
+    @override_settings(WORKFLOW_TRANSITION_LOG_SINK='workflow.transition_log.BufferedTransitionLogSink')
+    def test_configured_sink(self):
+
+        reset_transition_log_sink()
+        self.assertIsInstance(get_transition_log_sink(), BufferedTransitionLogSink)
+
+    def test_buffered_flush_on_size(self):
+
+        sink = BufferedTransitionLogSink(max_size=3, max_age=60)
+        entry = (self.controller, self.state_a, self.state_b)
+        sink.write([entry, entry])
+        self.assertEqual(0, TransitionLog.objects.count())
+        self.assertEqual(2, len(sink))
+
+        sink.write([entry])
+        self.assertEqual(3, TransitionLog.objects.count())
+        self.assertEqual(0, len(sink))
+
+    def test_buffered_explicit_flush(self):
+
+        sink = BufferedTransitionLogSink(max_size=100, max_age=60)
+        sink.write([(self.controller, None, self.state_a)])
+        sink.flush()
+
+        log = TransitionLog.objects.get()
+        self.assertIsNone(log.from_state_id)
+        self.assertEqual(self.state_a.id, log.to_state_id)
+
+    def test_buffered_keeps_write_time(self):
+
+        sink = BufferedTransitionLogSink(max_size=100, max_age=60)
+        before = timezone.now()
+        sink.write([(self.controller, self.state_a, self.state_b)])
+        after = timezone.now()
+        time.sleep(0.05)
+        sink.flush()
+
+        log = TransitionLog.objects.get()
+        self.assertTrue(before <= log.date_created <= after)
+
+    def test_buffered_discards_rollback(self):
+
+        sink = BufferedTransitionLogSink(max_size=1, max_age=60)
+        entry = (self.controller, self.state_a, self.state_b)
+        try:
+            with transaction.atomic():
+                sink.write([entry])
+                self.assertEqual(0, len(sink))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(0, len(sink))
+
+        with transaction.atomic():
+            sink.write([entry])
+            self.assertEqual(0, len(sink))
+        self.assertEqual(1, TransitionLog.objects.count())
+        self.assertEqual(0, len(sink))
+
+    def test_buffered_drops_refused(self):
+
+        sink = BufferedTransitionLogSink(max_size=100, max_age=60)
+        sink.write([(self.controller, self.state_a, self.state_b),
+                    (self.controller.id + 1, self.state_a, self.state_b)])
+        sink.flush()
+        self.assertEqual(1, TransitionLog.objects.count())
+        self.assertEqual(0, len(sink))
+
+class TransitionLogExportTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.state_a = State.objects.create(code='foo', description='foo')
+        self.state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine',
+                                              initial_state=self.state_a)
+        self.controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                         object_id=self.state_a.id,
+                                                         machine=machine,
+                                                         current_state=self.state_a)
+        for i in range(3):
+            TransitionLog.objects.create(controller=self.controller,
+                                         from_state=self.state_a,
+                                         to_state=self.state_b)
+
+    def test_csv(self):
+        response = export.stream(TransitionLog.objects.order_by('id'),
+                                 ('id', 'from_state__code', 'to_state__code'))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual('id,from_state__code,to_state__code', lines[0])
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[1].endswith(',foo,bar'))
+
+    def test_ndjson(self):
+        response = export.stream(TransitionLog.objects.order_by('id'),
+                                 ('id', 'to_state__code'),
+                                 output=export.FORMAT_NDJSON)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertIn('"to_state__code": "bar"', lines[0])
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+
+
+class PartitionsTestCase(TransactionTestCase):
+
+    def test_add_months(self):
+        self.assertEqual(date(2018, 1, 1), partitions.add_months(date(2017, 12, 1), 1))
+        self.assertEqual(date(2016, 12, 1), partitions.add_months(date(2017, 3, 1), -3))
+        self.assertEqual('workflow_transitionlog_y2017m03',
+                         partitions.partition_name(date(2017, 3, 1)))
+
+    def test_rollup(self):
+        state_a = State.objects.create(code='foo', description='foo')
+        state_b = State.objects.create(code='bar', description='bar')
+        machine = StateMachine.objects.create(name='machine', initial_state=state_a)
+        controller = StateController.objects.create(content_type=ContentType.objects.get_for_model(State),
+                                                    object_id=state_a.id,
+                                                    machine=machine,
+                                                    current_state=state_a)
+        TransitionLog.objects.create(controller=controller, to_state=state_a)
+        for i in range(2):
+            TransitionLog.objects.create(controller=controller,
+                                         from_state=state_a,
+                                         to_state=state_b)
+
+        today = timezone.localtime(timezone.now()).date()
+        self.assertEqual(2, partitions.rollup(today))
+        self.assertEqual(2, partitions.rollup(today))
+
+        counts = {(c.from_state_id, c.to_state_id): c.count
+                  for c in DailyTransitionCount.objects.filter(day=today, machine=machine)}
+        self.assertEqual({(None, state_a.id): 1, (state_a.id, state_b.id): 2}, counts)
+
+    def test_retention_needs_partitions(self):
+        self.assertFalse(partitions.is_partitioned())
+        self.assertEqual([], partitions.drop_expired(retention=1))
@@ -0,0 +1,202 @@
+# coding: utf-8
+'''Pluggable destinations for TransitionLog entries.
+
+The sink is chosen with the ``WORKFLOW_TRANSITION_LOG_SINK`` setting
+(a dotted path, ``SyncTransitionLogSink`` by default). Entries are
+``(controller, from_state, to_state)`` tuples.
+
+Delivery is at-least-once: a sink never drops an entry it accepted
+while its process is alive, unless the database refuses it (its
+controller or states were deleted), but an entry may be written twice
+when a flush fails after the database committed it, and buffered
+entries are lost if the process is killed without running its
+shutdown hooks.
+'''
+import time
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SINK = 'workflow.transition_log.SyncTransitionLogSink'
+DEFAULT_BUFFER_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5
+INSERT_BATCH_SIZE = 1000
+
+
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+class TransitionLogSink(object):
+
+    def write(self, entries):
+        '''accepts (controller, from_state, to_state) entries'''
+        raise NotImplementedError
+
+    def flush(self):
+        '''persists everything accepted so far'''
+        pass
+
+    def build(self, entries):
+        from .models import TransitionLog
+        return [TransitionLog(controller_id=_pk(controller),
+                              from_state_id=_pk(from_state),
+                              to_state_id=_pk(to_state))
+                for controller, from_state, to_state in entries]
+
+
+class SyncTransitionLogSink(TransitionLogSink):
+
+    '''Writes the entries right away, in the caller's transaction.'''
+
+    def write(self, entries):
+        from .models import TransitionLog
+        TransitionLog.objects.bulk_create(self.build(entries))
+
+
+class BufferedTransitionLogSink(TransitionLogSink):
+
+    '''Buffers the entries of this process and writes them with
+    bulk_create once ``max_size`` entries are waiting or the oldest
+    one is ``max_age`` seconds old. The buffer is also flushed when a
+    celery worker process or the interpreter shuts down.
+
+    Entries written inside a transaction are only accepted once it
+    commits, so a rollback discards them and a flush never writes rows
+    that are not committed yet. They are written outside of that
+    transaction, with the time they were written to the sink as their
+    date_created. Rows the database refuses are logged and dropped.'''
+
+    def __init__(self, max_size=None, max_age=None):
+        self.max_size = max_size or getattr(settings,
+                                            'WORKFLOW_TRANSITION_LOG_BUFFER_SIZE',
+                                            DEFAULT_BUFFER_SIZE)
+        self.max_age = max_age or getattr(settings,
+                                          'WORKFLOW_TRANSITION_LOG_FLUSH_INTERVAL',
+                                          DEFAULT_FLUSH_INTERVAL)
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._oldest = None
+        self._timer = None
+
+        atexit.register(self.flush)
+        try:
+            from celery.signals import worker_process_shutdown
+            worker_process_shutdown.connect(self._on_shutdown, weak=False)
+        except ImportError:
+            pass
+
+    def _on_shutdown(self, *args, **kwargs):
+        self.flush()
+
+    def rows(self, entries):
+        '''(controller id, from state id, to state id, date created)
+        of entries, dated now'''
+        now = timezone.now()
+        return [(_pk(controller), _pk(from_state), _pk(to_state), now)
+                for controller, from_state, to_state in entries]
+
+    def write(self, entries):
+        rows = self.rows(entries)
+        if connection.in_atomic_block:
+            transaction.on_commit(lambda: self._add(rows))
+        else:
+            self._add(rows)
+
+    def _add(self, rows):
+        with self._lock:
+            self._buffer.extend(rows)
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = len(self._buffer) >= self.max_size
+            old = time.time() - self._oldest >= self.max_age
+            if not full and not old:
+                self._schedule()
+                return
+
+        self.flush()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.max_age, self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def insert(self, rows):
+        '''writes rows in one statement, keeping their date_created,
+        which bulk_create would replace with now'''
+        from .models import TransitionLog
+        sql = 'INSERT INTO {0} (controller_id, from_state_id, to_state_id, date_created) ' \
+              'VALUES '.format(TransitionLog._meta.db_table)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql + ', '.join(['(%s, %s, %s, %s)'] * len(rows)),
+                               [value for row in rows for value in row])
+
+    def insert_each(self, rows):
+        '''writes rows one by one, dropping those the database refuses'''
+        for row in rows:
+            try:
+                self.insert([row])
+            except IntegrityError as ex:
+                logger.error('Dropped transition log %s. %s', row, ex)
+
+    def flush(self):
+        with self._lock:
+            pending, self._buffer = self._buffer, []
+            self._oldest = None
+            for i in range(0, len(pending), INSERT_BATCH_SIZE):
+                batch = pending[i:i + INSERT_BATCH_SIZE]
+                try:
+                    try:
+                        self.insert(batch)
+                    except IntegrityError:
+                        self.insert_each(batch)
+                except Exception as ex:
+                    logger.error('Flushing %s transition logs failed. %s', len(pending) - i, ex)
+                    self._buffer = pending[i:] + self._buffer
+                    self._oldest = time.time()
+                    raise
+
+    def __len__(self):
+        return len(self._buffer)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_transition_log_sink():
+    '''the process wide sink configured in WORKFLOW_TRANSITION_LOG_SINK'''
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                path = getattr(settings, 'WORKFLOW_TRANSITION_LOG_SINK', DEFAULT_SINK)
+                _sink = import_string(path)()
+    return _sink
+
+
+def reset_transition_log_sink():
+    '''flushes and drops the current sink; the next call to
+    get_transition_log_sink() reads the settings again'''
+    global _sink
+    with _sink_lock:
+        if _sink is not None:
+            _sink.flush()
+        _sink = None
@@ -5,27 +5,44 @@ from rest_framework import viewsets
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
 from rest_framework import viewsets, status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import BasePermission, IsAuthenticated
 from common.viewsets import DefaultViewSetMixIn
 from .choices import INNER_STATE_RUNNING
+from .exceptions import VersionConflict
+from .instrumentation import (timer,
+                              new_transition_id,
+                              PHASE_REQUEST, )
+from .rest import export
+from .rest.pagination import TransitionLogCursorPagination
 from .rest.responses import INVALID_REQUEST
 from .filters import (StateMachineFilter,
                       ActionFilter,
                       TransitionLogFilter,
+                      DailyTransitionCountFilter,
+                      TransitionExecutionFilter,
+                      TaskExecutionFilter,
                       AvailableTaskFilter,)
 from .models import (StateMachine,
                      State,
                      Action,
                      Transition,
                      TransitionLog,
+                     DailyTransitionCount,
+                     TransitionExecution,
+                     TaskExecution,
                      AvailableTask,
-                     TransitionTask, )
+                     TransitionTask,
+                     StateController,
+                     StateControllerData, )
 from .serializers import (StateMachineSerializer,
                           StateSerializer,
                           ActionSerializer,
                           AvailableTaskSerializer,
                           TransitionSerializer,
                           TransitionLogSerializer,
+                          DailyTransitionCountSerializer,
+                          TransitionExecutionSerializer,
+                          TaskExecutionSerializer,
                           TransitionTaskSerializer, )
 
 
@@ -110,20 +127,167 @@ class TaskViewSet(DefaultViewSetMixIn,
 class TransitionLogViewSet(DefaultViewSetMixIn,
                            viewsets.ModelViewSet):
 
-    queryset = TransitionLog.objects.all()
+    queryset = TransitionLog.objects.select_related('from_state', 'to_state') \
+                                    .prefetch_related('from_state__actions',
+                                                      'to_state__actions')
     serializer_class = TransitionLogSerializer
     filter_class = TransitionLogFilter
     search_fields = ('controller', )
+    pagination_class = TransitionLogCursorPagination
+    export_fields = ('id',
+                     'controller_id',
+                     'controller__content_type_id',
+                     'controller__object_id',
+                     'from_state__code',
+                     'to_state__code',
+                     'date_created', )
+
+    @list_route(methods=['get'])
+    def export(self, request):
+        '''streams the filtered logs as csv or, with
+        ?output=ndjson, as newline delimited json'''
+        output = request.query_params.get('output', export.FORMAT_CSV)
+        if output not in export.CONTENT_TYPES:
+            return INVALID_REQUEST
+
+        queryset = self.filter_queryset(TransitionLog.objects.all()) \
+                       .order_by('-date_created', '-id')
+        return export.stream(queryset,
+                             self.export_fields,
+                             output=output,
+                             filename='transition-logs')
+
+
+class DailyTransitionCountViewSet(DefaultViewSetMixIn,
+                                  viewsets.ReadOnlyModelViewSet):
+
+    queryset = DailyTransitionCount.objects.all()
+    serializer_class = DailyTransitionCountSerializer
+    filter_class = DailyTransitionCountFilter
+
+
+class TransitionExecutionViewSet(DefaultViewSetMixIn,
+                                 viewsets.ReadOnlyModelViewSet):
+
+    queryset = TransitionExecution.objects.prefetch_related('tasks')
+    serializer_class = TransitionExecutionSerializer
+    filter_class = TransitionExecutionFilter
+    ordering_fields = ('date_created', 'started_at', 'duration', )
+
+
+class TaskExecutionViewSet(DefaultViewSetMixIn,
+                           viewsets.ReadOnlyModelViewSet):
+
+    queryset = TaskExecution.objects.all()
+    serializer_class = TaskExecutionSerializer
+    filter_class = TaskExecutionFilter
+    ordering_fields = ('started_at', 'duration', )
+
+
+def data_etag(data_id, version):
+    return '"{0}.{1}"'.format(data_id, version)
+
+
+def parse_data_etag(etag):
+    '''(data id, version) of an ETag built by data_etag'''
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    data_id, version = etag.strip('"').split('.')
+    return int(data_id), int(version)
+
+
+def _function(method):
+    return getattr(method, '__func__', method)
 
 
 class StateControllerViewSetMixIn(object):
 
-    @detail_route(methods=['get', 'put'])
+    def object_permission_checks(self):
+        '''the permissions of this view that check objects'''
+        default = _function(BasePermission.has_object_permission)
+        return [p for p in self.get_permissions()
+                if _function(type(p).has_object_permission) is not default]
+
+    def split_permitted(self, request, queryset):
+        '''(objects of queryset the user may change, ids of the others),
+        checking the same object permissions as get_object() does for
+        the single change. Objects are only loaded when a permission
+        of this view checks objects'''
+        checks = self.object_permission_checks()
+        if not checks:
+            return queryset, []
+
+        permitted = []
+        forbidden = []
+        for obj in queryset.iterator():
+            if all(p.has_object_permission(request, self, obj) for p in checks):
+                permitted.append(obj.pk)
+            else:
+                forbidden.append(obj.pk)
+        return queryset.filter(pk__in=permitted), forbidden
+
+    def patch_data(self, request):
+        '''merges the top level keys of the request into the current
+        data inside the database. An If-Match header holding the
+        ETag of the data makes the update conditional.'''
+        changes = request.data
+        controller = self.controlled.controller
+        if not controller or not isinstance(changes, dict) or not changes:
+            return INVALID_REQUEST
+
+        data_id = version = None
+        if_match = request.META.get('HTTP_IF_MATCH', None)
+        if if_match:
+            try:
+                data_id, version = parse_data_etag(if_match)
+            except ValueError:
+                return INVALID_REQUEST
+
+        try:
+            data_id, new_version = StateControllerData.objects.patch(controller,
+                                                                     changes,
+                                                                     version=version,
+                                                                     data_id=data_id)
+        except StateControllerData.DoesNotExist:
+            return INVALID_REQUEST
+        except VersionConflict:
+            return Response({'status': 'Data was changed by someone else.'},
+                            status=status.HTTP_412_PRECONDITION_FAILED)
+
+        return Response(changes,
+                        status=status.HTTP_200_OK,
+                        headers={'ETag': data_etag(data_id, new_version)})
+
+    def get_data(self, request):
+        '''the current data, with its ETag. Answers 304, without
+        reading the data, when If-None-Match holds the current ETag'''
+        controller = self.controlled.controller
+        if not controller:
+            return INVALID_REQUEST
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match:
+            current = controller.current_data_version()
+            if current is not None:
+                etag = data_etag(*current)
+                tags = [t.strip() for t in if_none_match.split(',')]
+                if etag in tags or 'W/' + etag in tags or '*' in tags:
+                    return Response(status=status.HTTP_304_NOT_MODIFIED,
+                                    headers={'ETag': etag})
+
+        data = controller.current_data
+        return Response(data.data,
+                        status=status.HTTP_200_OK,
+                        headers={'ETag': data_etag(data.id, data.version)})
+
+    @detail_route(methods=['get', 'put', 'patch'])
     def data(self, request, pk=None):
         self.controlled = self.get_object()
+        if request.method == 'PATCH':
+            return self.patch_data(request)
         if request.method == 'GET':
-            data = self.controlled.current_data
-            return Response(data.data, status=status.HTTP_200_OK)
+            return self.get_data(request)
         else:
             try:
                 current_data = self.controlled.current_data
@@ -133,13 +297,20 @@ class StateControllerViewSetMixIn(object):
                 copied.update(request.data)
                 current_data.data = copied
                 current_data.save()
-                return Response(request.data, status=status.HTTP_200_OK)
+                return Response(request.data,
+                                status=status.HTTP_200_OK,
+                                headers={'ETag': data_etag(current_data.id, current_data.version)})
             except:
                 return Response({'message': 'Fail on saving data.'},
                                 status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     @detail_route(methods=['post'])
     def change(self, request, pk=None):
+        transition_id = new_transition_id()
+        with timer(PHASE_REQUEST, transition_id):
+            return self._change(request, transition_id)
+
+    def _change(self, request, transition_id):
         controlled = self.get_object()
         controller = controlled.controller
         if not controller:
@@ -157,14 +328,51 @@ class StateControllerViewSetMixIn(object):
         except:
             return Response({'status': 'State does not exist'},
                             status=status.HTTP_400_BAD_REQUEST)
-        available = controlled.next_for_user(request.user)
-        if int(state_id) not in [s.to_state.id for s in available]:
+        available = controller.transitions_available_to(request.user)
+        if int(state_id) not in available:
             return Response({'status': 'Invalid transition'},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        task = controller.change_to(state)
+        task = controller.change_to(state, transition_id=transition_id)
+        if not task:
+            return Response({'status': 'FSM already running for this project.'},
+                            status=status.HTTP_409_CONFLICT)
+
+        return Response({
+            'status': 'State change requested',
+            'task': task.id,
+            'transition': transition_id
+        })
+
+    @list_route(methods=['post'])
+    def bulk_change(self, request):
+        state_id = request.data.get('state_id', None)
+        if not state_id:
+            return INVALID_REQUEST
+        try:
+            state = State.objects.get(pk=state_id)
+        except:
+            return Response({'status': 'State does not exist'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # changing every filtered object must be asked for explicitly
+        ids = request.data.get('ids', None)
+        if ids is None and request.data.get('all') not in (True, 'true', 'True', '1'):
+            return Response({'status': 'Send the ids to change, or all: true '
+                                       'to change every filtered object'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
 
+        queryset, forbidden = self.split_permitted(request, queryset)
+        result = StateController.objects.bulk_change_to(queryset,
+                                                        state,
+                                                        user=request.user)
         return Response({
             'status': 'State change requested',
-            'task': task.id
+            'task': result.result.id if result.result else None,
+            'accepted': result.accepted,
+            'rejected': result.rejected + forbidden
         })